@@ -9,6 +9,10 @@ if not os.path.isdir(LOG_DIR):
 
 bind = "0.0.0.0:{}".format(PORT)
 workers = 5
+# Build log streams stay open until their build ends: serve requests from
+# threads, so that followers do not hold every worker and starve webhooks
+worker_class = 'gthread'
+threads = 25
 max_requests = 200
 preload_app = True
 chdir = os.path.dirname(__file__)
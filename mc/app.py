@@ -4,12 +4,14 @@ Application factory
 
 import logging.config
 import os
+import threading
+import time
 from mc.models import db
 from celery import Celery
 import jinja2
 from flask import Flask, current_app
 from flask.ext.restful import Api
-from mc.views import GithubListener
+from mc.views import GithubListener, BuildLogStream
 
 
 def create_app(name="mission-control"):
@@ -32,6 +34,7 @@ def create_app(name="mission-control"):
     # Register extensions
     api = Api(app)
     api.add_resource(GithubListener, '/webhooks')
+    api.add_resource(BuildLogStream, '/builds/<int:build_id>/log')
     db.init_app(app)
 
     return app
@@ -77,9 +80,19 @@ def create_celery(app=None):
     return celery
 
 
+# Process-wide jinja2 environments, per template directory
+_jinja2_environments = {}
+_jinja2_lock = threading.Lock()
+
+
 def create_jinja2(template_dir=None):
     """
-    create a jinja2 environment using the FileSystemLoader
+    Returns the jinja2 environment of a template directory, using the
+    FileSystemLoader. The environment is created once per process and shared,
+    so that each template is compiled once rather than once per builder or
+    provisioner. If JINJA2_BYTECODE_DIR is set, compiled templates are also
+    cached on disk across processes. Templates are only reloaded when they
+    change on disk with JINJA2_AUTO_RELOAD, or on refresh_jinja2.
 
     :param template_dir: absolute or relative path with which to look for
         templates
@@ -87,8 +100,159 @@ def create_jinja2(template_dir=None):
     """
     if template_dir is None:
         template_dir = os.path.join(os.path.dirname(__file__), 'templates')
-    loader = jinja2.FileSystemLoader(template_dir)
-    return jinja2.Environment(loader=loader)
+    template_dir = os.path.abspath(template_dir)
+
+    with _jinja2_lock:
+        env = _jinja2_environments.get(template_dir)
+        if env is None:
+            try:
+                config = current_app.config
+            except RuntimeError:  # Outside of application context
+                config = {}
+            bytecode_cache = None
+            if config.get('JINJA2_BYTECODE_DIR'):
+                try:
+                    os.makedirs(config['JINJA2_BYTECODE_DIR'])
+                except OSError:
+                    if not os.path.isdir(config['JINJA2_BYTECODE_DIR']):
+                        raise
+                bytecode_cache = jinja2.FileSystemBytecodeCache(
+                    config['JINJA2_BYTECODE_DIR']
+                )
+            loader = jinja2.FileSystemLoader(template_dir)
+            env = jinja2.Environment(
+                loader=loader,
+                bytecode_cache=bytecode_cache,
+                auto_reload=config.get('JINJA2_AUTO_RELOAD', False),
+                cache_size=-1,
+            )
+            env.signature = templates_signature(template_dir)
+            env.index = TemplateIndex(template_dir)
+            env.checked = time.time()
+            _jinja2_environments[template_dir] = env
+        return env
+
+
+class TemplateIndex(object):
+    """
+    Index of the templates of a template directory, built with one scan of
+    the directory rather than one per builder or provisioner:
+        dockerfiles: repository -> dockerfile template
+        files: repository -> cron/ and etc/ templates of the repository
+        consul: service -> consul provisioning templates
+        postgres: service -> postgres provisioning templates
+    """
+
+    def __init__(self, template_dir):
+        """
+        :param template_dir: template directory
+        """
+        self.template_dir = template_dir
+        self.dockerfiles = {}
+        self.files = {}
+        self.consul = {}
+        self.postgres = {}
+        for root, dirs, files in os.walk(template_dir):
+            dirs.sort()
+            relroot = os.path.relpath(root, template_dir)
+            parts = [] if relroot == '.' else relroot.split(os.sep)
+            for name in sorted(files):
+                if name.startswith('.'):
+                    continue
+                self.add(parts, name)
+
+    def add(self, parts, name):
+        """
+        Adds a template to the index
+        :param parts: directories of the template, relative to template_dir
+        :param name: file name of the template
+        """
+        path = '/'.join(parts + [name])
+        if parts == ['docker', 'dockerfiles'] and \
+                name.endswith('.dockerfile.template'):
+            repo = name[:-len('.dockerfile.template')]
+            self.dockerfiles[repo] = path
+        elif len(parts) >= 3 and parts[0] == 'docker' and \
+                parts[1] in ('cron', 'etc'):
+            self.files.setdefault(parts[2], []).append(path)
+        elif len(parts) >= 2 and parts[0] in ('consul', 'postgres'):
+            getattr(self, parts[0]).setdefault(parts[1], []).append(path)
+
+    def repositories(self):
+        """
+        :return: sorted list of the repositories that have a dockerfile
+        """
+        return sorted(self.dockerfiles)
+
+
+def template_index(template_dir=None):
+    """
+    :param template_dir: template directory; None for the default one
+    :return: the TemplateIndex of the process-wide jinja2 environment of the
+        directory, rebuilt whenever its templates are invalidated
+    """
+    return create_jinja2(template_dir).index
+
+
+def templates_signature(template_dir):
+    """
+    :param template_dir: template directory
+    :return: signature of the paths, sizes and modification times of the
+        files of the directory; changes whenever a template does
+    """
+    signature = []
+    for root, dirs, files in os.walk(template_dir):
+        for name in files:
+            st = os.stat(os.path.join(root, name))
+            signature.append((
+                os.path.relpath(os.path.join(root, name), template_dir),
+                st.st_size, st.st_mtime
+            ))
+    return hash(tuple(sorted(signature)))
+
+
+def invalidate_jinja2(template_dir=None):
+    """
+    Drops the compiled templates of a template directory, in memory and on
+    disk, so that they are compiled again when next used
+
+    :param template_dir: template directory; None for all
+    """
+    with _jinja2_lock:
+        if template_dir is None:
+            environments = _jinja2_environments.values()
+        else:
+            env = _jinja2_environments.get(os.path.abspath(template_dir))
+            environments = [env] if env is not None else []
+        for env in environments:
+            env.cache.clear()
+            if env.bytecode_cache is not None:
+                env.bytecode_cache.clear()
+            env.signature = templates_signature(env.loader.searchpath[0])
+            env.index = TemplateIndex(env.loader.searchpath[0])
+            env.checked = time.time()
+
+
+def refresh_jinja2(template_dir=None, interval=0):
+    """
+    Invalidates the compiled templates of a template directory if any of its
+    templates changed on disk since they were compiled. The directory is
+    scanned at most every `interval` seconds.
+
+    :param template_dir: template directory; None for the default one
+    :param interval: seconds during which the last scan is trusted
+    :return: True if the templates were invalidated
+    """
+    env = create_jinja2(template_dir)
+    if time.time() - env.checked < interval:
+        return False
+    template_dir = env.loader.searchpath[0]
+    signature = templates_signature(template_dir)
+    env.checked = time.time()
+    if signature == env.signature:
+        return False
+    invalidate_jinja2(template_dir)
+    return True
 
 
 def load_config(app, basedir=os.path.dirname(__file__)):
@@ -1,12 +1,264 @@
 from flask import current_app
-from docker import Client
+from dateutil import parser
+from dateutil.tz import tzutc
+from docker import Client, auth
+from docker.errors import NotFound
 from docker.utils import create_host_config
 from mc.app import create_jinja2
-from mc.exceptions import BuildError
+from mc.buildlogs import StatusDecoder, describe
+from mc.contexts import DockerContext
+from mc.exceptions import BuildError, DependencyError
+from mc.utils import StageTimer
+import datetime
 import os
+import hashlib
 import logging
-import tarfile
-import io
+import itertools
+import re
+import threading
+import time
+import requests
+
+
+class DockerClientPool(object):
+    """
+    Process-wide docker clients, one per daemon url. Each client negotiates
+    the API version once and keeps its connections to the daemon alive, and
+    is shared by the builders and runners of the process. The negotiated
+    version outlives the clients, so that the clients re-created in a forked
+    worker do not negotiate again.
+    """
+
+    def __init__(self, factory=None):
+        """
+        :param factory: callable creating a client from base_url and version
+            keyword arguments; docker.Client if None. Tests set it to inject
+            fake clients.
+        """
+        self.factory = factory
+        self.clients = {}
+        self.versions = {}
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+
+    def get(self, base_url=None):
+        """
+        :param base_url: url of the docker daemon; None for the local daemon
+        :return: the shared client of the daemon
+        """
+        factory = self.factory or Client
+        with self.lock:
+            if os.getpid() != self.pid:
+                # Connections must not be shared with the parent process
+                self.clients.clear()
+                self.pid = os.getpid()
+            client = self.clients.get((factory, base_url))
+            if client is None:
+                kwargs = {'version': self.versions.get(base_url, 'auto')}
+                if base_url is not None:
+                    kwargs['base_url'] = base_url
+                client = factory(**kwargs)
+                version = getattr(client, 'api_version', None)
+                if isinstance(version, basestring):
+                    self.versions[base_url] = version
+                self.clients[(factory, base_url)] = client
+            return client
+
+    def clear(self):
+        """
+        Closes and forgets the clients, keeping the negotiated versions
+        """
+        with self.lock:
+            for client in self.clients.values():
+                try:
+                    client.close()
+                except Exception:
+                    pass
+            self.clients.clear()
+
+
+docker_clients = DockerClientPool()
+
+# Pull policies of DockerRunner
+PULL_POLICIES = ('always', 'if-not-present', 'never')
+
+
+def image_reference(image):
+    """
+    :param image: name of an image, with or without a tag
+    :return: name of the image with its tag, :latest if it has none
+    """
+    if '@' in image or ':' in image.rsplit('/', 1)[-1]:
+        return image
+    return '{}:latest'.format(image)
+
+
+class ImageInventory(object):
+    """
+    Images available locally on a docker daemon: the image id (digest) of
+    each tag, listed at most every `ttl` seconds or on refresh, so that
+    runners do not contact the registry for images the daemon already has
+    """
+
+    def __init__(self, client, ttl=300):
+        """
+        :param client: docker.Client of the daemon
+        :param ttl: seconds a listing of the images is trusted for
+        """
+        self.client = client
+        self.ttl = ttl
+        self.images = {}
+        self.listed = None
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """
+        Lists the images of the daemon
+        """
+        images = {}
+        for image in self.client.images():
+            for ref in (image.get('RepoTags') or []) + \
+                    (image.get('RepoDigests') or []):
+                if not ref.startswith('<none>'):
+                    images[ref] = image['Id']
+        with self.lock:
+            self.images = images
+            self.listed = time.time()
+
+    def invalidate(self):
+        """
+        Lists the images again when next used, e.g. after a pull
+        """
+        with self.lock:
+            self.listed = None
+
+    def get(self, image):
+        """
+        :param image: name of the image
+        :return: id of the image, or None if the daemon does not have it
+        """
+        if self.listed is None or time.time() - self.listed > self.ttl:
+            self.refresh()
+        return self.images.get(image_reference(image))
+
+    def __contains__(self, image):
+        return self.get(image) is not None
+
+
+# Image inventories per daemon url
+_image_inventories = {}
+_image_inventories_lock = threading.Lock()
+
+
+def image_inventory(client, ttl=300):
+    """
+    :param client: docker.Client of the daemon
+    :param ttl: seconds a listing of the images is trusted for
+    :return: the process-wide ImageInventory of the daemon of the client
+    """
+    with _image_inventories_lock:
+        key = getattr(client, 'base_url', None)
+        inventory = _image_inventories.get(key)
+        if inventory is None or inventory.client is not client:
+            inventory = _image_inventories[key] = ImageInventory(client, ttl)
+        return inventory
+
+
+# Registry credentials per DOCKER_HOME, loaded once per process
+_registry_auths = {}
+_registry_auths_lock = threading.Lock()
+
+
+def registry_auth(image, docker_home):
+    """
+    Finds the credentials for the registry of an image in the docker config
+    of `docker_home`, without touching the process environment, so that
+    several threads can push and pull at once
+    :param image: full name of the image
+    :param docker_home: directory holding .docker/config.json or .dockercfg
+    :return: auth config dict for docker.Client.push and pull, or None
+    """
+    if not docker_home:
+        return None
+    with _registry_auths_lock:
+        if docker_home not in _registry_auths:
+            configs = {}
+            for path in (os.path.join(docker_home, '.docker', 'config.json'),
+                         os.path.join(docker_home, '.dockercfg')):
+                if os.path.exists(path):
+                    configs = auth.load_config(path) or {}
+                    break
+            _registry_auths[docker_home] = configs
+        configs = _registry_auths[docker_home]
+    repository, _, tag = image.split('@', 1)[0].rpartition(':')
+    if not repository or '/' in tag:  # No tag, but a registry port
+        repository = image.split('@', 1)[0]
+    registry, _ = auth.resolve_repository_name(repository)
+    return auth.resolve_authconfig(configs, registry)
+
+
+def registry_kwargs(image):
+    """
+    Credentials are passed to each push and pull rather than read by the
+    client from $HOME, which is shared by all the threads of the process
+    :param image: full name of the image
+    :return: kwargs of docker.Client.push and pull with the credentials of
+        DOCKER_HOME for the registry of the image, if any
+    """
+    try:
+        docker_home = current_app.config.get('DOCKER_HOME')
+    except RuntimeError:  # Outside of application context
+        docker_home = None
+    auth_config = registry_auth(image, docker_home)
+    return {'auth_config': auth_config} if auth_config else {}
+
+
+def registry_manifest(image, auth_config=None, timeout=10):
+    """
+    Fetches the v2 manifest of an image from its registry, with a bearer
+    token if the registry asks for one
+    :param image: full name of the image
+    :param auth_config: credentials for the registry, as from registry_auth
+    :param timeout: seconds to wait for each request
+    :return: manifest dict, whose layers and config have their compressed
+        size
+    """
+    repository, _, tag = image.rpartition(':')
+    if not repository or '/' in tag:  # No tag, but a registry port
+        repository, tag = image, 'latest'
+    registry, name = auth.resolve_repository_name(repository)
+    if registry in (auth.INDEX_NAME, 'index.docker.io'):
+        registry = 'registry-1.docker.io'
+        if '/' not in name:
+            name = 'library/{}'.format(name)
+    url = 'https://{}/v2/{}/manifests/{}'.format(registry, name, tag)
+    headers = {
+        'Accept': 'application/vnd.docker.distribution.manifest.v2+json'
+    }
+    credentials = None
+    if auth_config and auth_config.get('username'):
+        credentials = (auth_config['username'], auth_config['password'])
+
+    r = requests.get(url, headers=headers, timeout=timeout)
+    if r.status_code == 401:
+        scheme, _, challenge = \
+            r.headers.get('WWW-Authenticate', '').partition(' ')
+        if scheme.lower() == 'bearer':
+            params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+            token = requests.get(
+                params.pop('realm'), params=params, auth=credentials,
+                timeout=timeout,
+            ).json()
+            headers['Authorization'] = 'Bearer {}'.format(
+                token.get('token') or token.get('access_token')
+            )
+            r = requests.get(url, headers=headers, timeout=timeout)
+        else:
+            r = requests.get(
+                url, headers=headers, auth=credentials, timeout=timeout
+            )
+    r.raise_for_status()
+    return r.json()
 
 
 class ECSBuilder(object):
@@ -79,46 +331,209 @@ class DockerImageBuilder(object):
     creating a build context, executing docker build, and executing docker push
     """
 
-    def __init__(self, commit, namespace="adsabs"):
+    def __init__(self, commit, namespace="adsabs", no_cache=True, base=None,
+                 mirror=None, wheelhouse=None, docker_url=None, log=None):
+        """
+        :param commit: mc.models.Commit to build
+        :param namespace: the docker image namespace
+        :param no_cache: pull the base image and build without the layer cache
+        :param base: builder of the image the service image is built FROM
+        :type base: BaseImageBuilder or None
+        :param mirror: local mirror of the repository; if given, the source is
+            sent in the build context instead of cloned within the container
+        :type mirror: mc.mirrors.GitMirror or None
+        :param wheelhouse: pre-built wheels of the requirements; only used
+            with a mirror
+        :type wheelhouse: mc.wheelhouse.Wheelhouse or None
+        :param docker_url: url of the docker daemon to build on; None for the
+            local daemon
+        :param log: log the events of the build and push are stored in
+        :type log: mc.buildlogs.BuildLog or None
+        """
         self.commit = commit
-        self.repo = commit.repository
-        self.templates = create_jinja2()
+        self.setup(
+            commit.repository, namespace=namespace, no_cache=no_cache,
+            mirror=mirror, wheelhouse=wheelhouse, docker_url=docker_url,
+            log=log,
+        )
+        self.base = base or BaseImageBuilder(
+            namespace=namespace, docker_url=docker_url, log=log,
+            refresh=no_cache,
+        )
         self.tag = "{}/{}:{}".format(
             namespace,
             self.repo,
             self.commit.tag if self.commit.tag else self.commit.commit_hash
         )
+
+    def setup(self, repo, namespace="adsabs", no_cache=True, mirror=None,
+              wheelhouse=None, docker_url=None, log=None):
+        """
+        Sets the state shared by the builders of service and base images
+        :param repo: name of the image within the namespace
+        :param namespace: the docker image namespace
+        :param no_cache: pull the base image and build without the layer cache
+        :param mirror: local mirror of the repository, or None
+        :param wheelhouse: pre-built wheels of the requirements, or None
+        :param docker_url: url of the docker daemon to build on; None for the
+            local daemon
+        :param log: log the events of the build and push are stored in
+        """
+        self.repo = repo
+        self.namespace = namespace
+        self.no_cache = no_cache
+        self.mirror = mirror
+        self.wheelhouse = wheelhouse
+        self.docker_url = docker_url
+        self.log = log
+        self.templates = create_jinja2()
         self.files = []
+        self.requirements = None
         self.tarfile = None
         self.built = False
         self.pushed = False
+        self.digest = None
+        self.stats = None
+        self.timer = StageTimer()
+        try:
+            self.logger = current_app.logger
+        except RuntimeError:  # Outside of application context
+            self.logger = logging.getLogger("{}-builder".format(self.repo))
 
     def run(self):
         """
         Shortcut method that calls all the methods in the correct order
         to build and push an image
         """
-        self.render_templates()
-        self.create_docker_context()
-        self.build()
-        self.push()
+        if not self.files:  # Not rendered by fingerprint() yet
+            with self.timer('render'):
+                self.render_templates()
+        if self.base is not None:
+            with self.timer('base'):
+                self.base.ensure()
+        with self.timer('wheels'):
+            self.add_wheels()
+        with self.timer('context'):
+            self.create_docker_context()
+        with self.timer('build'):
+            self.build()
+        with self.timer('push'):
+            self.push()
+        self.stats = self.image_stats()
+
+    def add_wheels(self):
+        """
+        Adds the wheels of the requirements to the rendered files, building
+        the missing ones in the base image, which has to be available. The
+        wheels directory always gets a member, as the Dockerfile copies it
+        even if no wheel could be built.
+        """
+        if self.requirements is None or self.wheelhouse is None:
+            return
+        wheels = self.wheelhouse.wheels(
+            self.requirements, self.client(), self.base.tag
+        )
+        self.files.append({'name': 'wheels/.keep', 'content': u''})
+        for path in wheels:
+            self.files.append({
+                'name': 'wheels/{}'.format(os.path.basename(path)),
+                'path': path,
+            })
+
+    def client(self):
+        """
+        :return: docker.Client of the daemon the image is built on
+        """
+        return docker_clients.get(self.docker_url)
+
+    def retag(self, source):
+        """
+        Tags an image that was already built and pushed for this commit as
+        `self.tag`, then pushes it. The registry already has every layer, so
+        only the new manifest is uploaded. The image only counts as built
+        once it is pushed, so that a failed retag falls back to a build.
+        :param source: full name of the existing image, e.g.
+            adsabs/adsws:<commit_hash>
+        """
+        docker = self.client()
+        with self.timer('retag'):
+            try:
+                docker.inspect_image(source)
+            except NotFound:
+                docker.pull(source, **registry_kwargs(source))
+            repository, tag = self.tag.rsplit(':', 1)
+            if not docker.tag(source, repository, tag=tag, force=True):
+                raise BuildError(
+                    "Failed to tag {} as {}".format(source, self.tag)
+                )
+        with self.timer('push'):
+            self.push()
+        self.built = True
+
+    def fingerprint(self):
+        """
+        Renders the templates if needed, and hashes the commit hash together
+        with the rendered files. The source and the rendered files determine
+        the docker context, so builds with the same fingerprint build the
+        same image. The wheels are not built for it: they are determined by
+        requirements.txt and the base image, which are part of the rendered
+        Dockerfile.
+        :return: hex sha256 of the build context
+        """
+        if not self.files:
+            with self.timer('render'):
+                self.render_templates()
+        h = hashlib.sha256(self.commit.commit_hash)
+        for f in sorted(self.files, key=lambda f: f['name']):
+            h.update(f['name'].encode('utf-8') + '\0')
+            if 'path' in f:
+                h.update(str(os.path.getsize(f['path'])))
+            else:
+                h.update(f['content'].encode('utf-8'))
+                h.update(oct(f.get('mode', 0)))
+            h.update('\0')
+        return h.hexdigest()
 
     def render_templates(self):
         """
         Finds the templates using the app's create_jinja2 loader
         """
 
-        # dockerfile
-        t = self.templates.get_template(
-            'docker/dockerfiles/{}.dockerfile.template'.format(
-                self.repo
+        # requirements.txt is sent on its own, so that the dependencies are
+        # installed in a layer that does not depend on the rest of the source
+        requirements = None
+        if self.mirror is not None:
+            requirements = self.mirror.read(
+                self.commit.commit_hash, 'requirements.txt'
             )
-        )
+
+        self.requirements = requirements
+
+        # dockerfile
+        index = self.templates.index
+        t = self.templates.get_template(index.dockerfiles.get(
+            self.repo,
+            'docker/dockerfiles/{}.dockerfile.template'.format(self.repo)
+        ))
         self.files.append({
             'name': 'Dockerfile',
-            'content': t.render(commit=self.commit),
+            'content': t.render(
+                commit=self.commit,
+                base_image=self.base.tag,
+                source=self.mirror is not None,
+                requirements_hash=hashlib.sha1(requirements).hexdigest()
+                if requirements is not None else None,
+                wheels=requirements is not None and
+                self.wheelhouse is not None,
+            ),
         })
 
+        if requirements is not None:
+            self.files.append({
+                'name': 'requirements.txt',
+                'content': requirements.decode('utf-8'),
+            })
+
         # gunicorn
         t = self.templates.get_template(
             'docker/gunicorn/gunicorn.conf.py'
@@ -156,13 +571,7 @@ class DockerImageBuilder(object):
         })
 
         # cron/, etc/ iif there exists a `self.repo` directory
-        def _filter(p):
-            return ("cron/" in p or "etc/" in p) and (self.repo in p) and \
-                   (not os.path.basename(p).startswith('.'))
-
-        for t in self.templates.list_templates(
-                filter_func=_filter):
-
+        for t in index.files.get(self.repo, []):
             self.files.append({
                 'name': os.path.basename(t),
                 'content': self.templates.get_template(t).render(),
@@ -170,41 +579,43 @@ class DockerImageBuilder(object):
 
     def create_docker_context(self):
         """
-        Creates an in-memory tarfile that will be used as the docker context
+        Creates the docker context, which is streamed to the daemon as the
+        build reads it rather than held in memory. If the builder has a
+        mirror, the commit's tree is added as src/
         """
-
-        self.tarfile = io.BytesIO()
-
-        with tarfile.open(fileobj=self.tarfile, mode="w|") as tar:
-            for f in self.files:
-                tarinfo = tarfile.TarInfo(f['name'])
-                tarinfo.size = len(f['content'])
-                if 'mode' in f:
-                    tarinfo.mode = f['mode']
-                tar.addfile(tarinfo, io.BytesIO(f['content'].encode('utf-8')))
-        self.tarfile.seek(0)  # Reset from EOF
+        if self.mirror is None:
+            self.tarfile = DockerContext(self.files)
+        else:
+            self.tarfile = DockerContext(
+                self.files,
+                mirror=self.mirror,
+                commit_hash=self.commit.commit_hash,
+                prefix='src/',
+            )
 
     def build(self):
         """
         runs docker build with the tarfile context
         """
-        docker = Client(version='auto')
+        docker = self.client()
         status = docker.build(
             fileobj=self.tarfile,
             custom_context=True,
             tag=self.tag,
-            pull=True,
-            nocache=True,
+            pull=self.no_cache,
+            nocache=self.no_cache,
             rm=True,
         )
 
-        for line in status:  # This effectively blocks on `docker build`
-            try:
-                current_app.logger.debug(line)
-            except RuntimeError:  # Outside of application context
-                print line
-        if "successfully built" not in line.lower():
-            raise BuildError("Failed to build {}: {}".format(self.tag, line))
+        events = self.follow(status, 'build')
+        if 'error' in events:
+            raise BuildError("Failed to build {}: {}".format(
+                self.tag, events['error']['error']
+            ))
+        if 'built' not in events:
+            raise BuildError("Failed to build {}: {}".format(
+                self.tag, describe(events['last']) if events else "no output"
+            ))
 
         self.built = True
 
@@ -212,34 +623,196 @@ class DockerImageBuilder(object):
         """
         Runs docker push
         """
-
-        # Need to set HOME such that the .dockercfg file is read from
-        # a non-default location.
-        # See https://github.com/docker/docker/issues/6141
-        try:
-            dh = current_app.config.get('DOCKER_HOME')
-            if dh:
-                #  Is it safe to not reset home after we're done here?
-                os.environ['HOME'] = dh
-        except RuntimeError:
-            pass
-
-        docker = Client(version='auto')
+        docker = self.client()
         status = docker.push(
             self.tag,
             stream=True,
+            **registry_kwargs(self.tag)
         )
 
-        for line in status:  # This effectively blocks on `docker push`
+        events = self.follow(status, 'push')
+        if 'error' in events:
+            raise BuildError("Failed to push {}: {}".format(
+                self.tag, events['error']['error']
+            ))
+        if 'pushed' not in events:
+            raise BuildError("Failed to push {}: {}".format(
+                self.tag, describe(events['last']) if events else "no output"
+            ))
+
+        self.digest = events['pushed'].get('digest')
+        self.pushed = True
+
+    def image_stats(self):
+        """
+        Collects the metadata of the pushed image: its digest, its size and
+        layers from the daemon, its compressed size from the registry if
+        IMAGE_STATS_REGISTRY is set, and the durations of the stages of the
+        build. Metadata that cannot be collected is None.
+        :return: dict of the ImageStats columns
+        """
+        durations = self.timer.durations
+        stats = {
+            'digest': self.digest,
+            'size': None,
+            'compressed_size': None,
+            'layers': None,
+            'render_duration': durations.get('render'),
+            'context_duration': durations.get('context'),
+            'build_duration': durations.get('build'),
+            'push_duration': durations.get('push'),
+        }
+        try:
+            image = self.client().inspect_image(self.tag)
+        except Exception, e:
+            self.logger.warning("Cannot inspect {}: {}".format(self.tag, e))
+            image = {}
+        if isinstance(image.get('Size'), (int, long)):
+            stats['size'] = image['Size']
+        layers = (image.get('RootFS') or {}).get('Layers')
+        if isinstance(layers, list):
+            stats['layers'] = len(layers)
+
+        try:
+            config = current_app.config
+        except RuntimeError:  # Outside of application context
+            config = {}
+        if config.get('IMAGE_STATS_REGISTRY'):
+            try:
+                manifest = registry_manifest(
+                    self.tag, registry_auth(self.tag, config.get('DOCKER_HOME'))
+                )
+                stats['compressed_size'] = manifest['config']['size'] + sum(
+                    layer['size'] for layer in manifest['layers']
+                )
+            except Exception, e:
+                self.logger.warning(
+                    "Cannot fetch the manifest of {}: {}".format(self.tag, e)
+                )
+        return stats
+
+    def follow(self, status, stage):
+        """
+        Decodes the status stream of docker build or push into events as it
+        arrives, logs them and stores them in the build log
+        :param status: status stream of docker build or push
+        :param stage: name of the stage, recorded on each event
+        :return: dict of the last event of each type, and of the last event
+            as 'last'; empty if the stream was empty
+        """
+        decoder = StatusDecoder()
+        events = {}
+        # Iterating effectively blocks on `docker build`/`docker push`
+        for chunk in itertools.chain(status, [None]):
+            for event in decoder.close() if chunk is None \
+                    else decoder.feed(chunk):
+                event['stage'] = stage
+                events[event['type']] = events['last'] = event
+                if self.log is not None:
+                    self.log.write(event)
+                if event['type'] != 'progress':
+                    self.logger.debug(describe(event))
+        if self.log is not None:
+            self.log.flush()
+        return events
+
+
+class BaseImageBuilder(DockerImageBuilder):
+    """
+    Builds the image that every service image is built FROM: the OS packages
+    and python tooling of `docker/python-base.template`. The image is tagged
+    with a content hash of the rendered Dockerfile, so that it is only rebuilt
+    and pushed when the template changes.
+    """
+
+    template = 'docker/python-base.template'
+
+    # (daemon, image) known to be available, so that each worker checks only
+    # once per daemon
+    available = set()
+
+    def __init__(self, namespace="adsabs", name="python-base",
+                 docker_url=None, log=None, refresh=False, max_age=None):
+        """
+        :param namespace: the docker image namespace
+        :param name: the docker image name
+        :param docker_url: url of the docker daemon; None for the local daemon
+        :param log: log the events of the build and push are stored in
+        :param refresh: pull the image, and rebuild it if it is older than
+            max_age, e.g. for the fresh builds of service images
+        :param max_age: seconds a refreshed image is trusted for;
+            BASE_IMAGE_MAX_AGE if None
+        """
+        # The base image itself is always built from a pulled image, without
+        # the layer cache
+        self.setup(name, namespace=namespace, no_cache=True,
+                   docker_url=docker_url, log=log)
+        self.commit = None
+        self.base = None
+        self.refresh = refresh
+        if max_age is None:
             try:
-                current_app.logger.debug(line)
+                max_age = current_app.config.get(
+                    'BASE_IMAGE_MAX_AGE', 24 * 60 * 60
+                )
             except RuntimeError:  # Outside of application context
-                print line
+                max_age = 24 * 60 * 60
+        self.max_age = max_age
+        self.dockerfile = self.templates.get_template(self.template).render()
+        self.hash = hashlib.sha1(
+            self.dockerfile.encode('utf-8')
+        ).hexdigest()[:12]
+        self.tag = "{}/{}:{}".format(namespace, name, self.hash)
 
-        if not ("pushing tag" in line.lower() or "digest: sha256" in line.lower()):
-            raise BuildError("Failed to push {}: {}".format(self.tag, line))
+    def render_templates(self):
+        """
+        The context of the base image is its Dockerfile only
+        """
+        self.files = [{'name': 'Dockerfile', 'content': self.dockerfile}]
 
-        self.pushed = True
+    def ensure(self):
+        """
+        Makes sure that the image is available to the docker daemon: locally,
+        pulled from the registry or, failing both, built and pushed. With
+        refresh, the image is pulled even if available locally, and rebuilt
+        if it was created more than max_age seconds ago.
+        :return: True if the image had to be built
+        """
+        if not self.refresh and (self.docker_url, self.tag) in self.available:
+            return False
+
+        docker = self.client()
+        image = None if self.refresh else self.inspect(docker)
+        if image is None:
+            # Errors of a pull are reported in its output, not raised
+            docker.pull(self.tag, **registry_kwargs(self.tag))
+            image = self.inspect(docker)
+        built = False
+        if image is None or self.refresh and self.age(image) > self.max_age:
+            self.logger.info("Building base image {}".format(self.tag))
+            self.run()
+            built = True
+        self.available.add((self.docker_url, self.tag))
+        return built
+
+    def inspect(self, docker):
+        """
+        :param docker: docker.Client of the daemon
+        :return: the inspected image, or None if the daemon does not have it
+        """
+        try:
+            return docker.inspect_image(self.tag)
+        except NotFound:
+            return None
+
+    @staticmethod
+    def age(image):
+        """
+        :param image: inspected image
+        :return: seconds since the image was created
+        """
+        created = parser.parse(image['Created'])
+        return (datetime.datetime.now(tzutc()) - created).total_seconds()
 
 
 class DockerRunner(object):
@@ -248,11 +821,18 @@ class DockerRunner(object):
     the container, then tearing down the container
     """
 
-    def __init__(self, image, name, command=None, **kwargs):
+    def __init__(self, image, name, command=None, pull_policy=None,
+                 refresh=False, environment=None, labels=None, **kwargs):
         """
         :param image: full name of the docker image to pull
         :param name: name of the container in `docker run --name`
         :param command: command for the container in `docker run <> command`
+        :param pull_policy: one of PULL_POLICIES; DOCKER_PULL_POLICY if None
+        :param refresh: list the images of the daemon again rather than
+            trust the image inventory
+        :param environment: dict of the environment variables of the
+            container
+        :param labels: dict of the labels of the container
         :param mem_limit: Memory limit to enforce on the container
         :param kwargs: keyword args to pass direclty to
             docker.utils.create_host_config
@@ -260,9 +840,25 @@ class DockerRunner(object):
         self.image = image
         self.name = name
         self.command = command
+        self.environment = environment
+        self.labels = labels
         self.host_config = create_host_config(**kwargs)
 
-        self.client = Client(version='auto')
+        try:
+            config = current_app.config
+        except RuntimeError:  # Outside of application context
+            config = {}
+        self.pull_policy = pull_policy or \
+            config.get('DOCKER_PULL_POLICY', 'if-not-present')
+        if self.pull_policy not in PULL_POLICIES:
+            raise ValueError("Unknown pull policy {}".format(self.pull_policy))
+
+        self.client = docker_clients.get()
+        self.inventory = image_inventory(
+            self.client, config.get('DOCKER_IMAGE_INVENTORY_TTL', 300)
+        )
+        if refresh:
+            self.inventory.refresh()
         self.running = None
         self.container = None
         try:
@@ -274,16 +870,32 @@ class DockerRunner(object):
 
     def setup(self):
         """
-        Pull the image and create a container with host_config
+        Pull the image according to the pull policy, and create a container
+        with host_config
         :return: None
         """
-        self.client.pull(self.image)
-        self.logger.debug("Pulled {}".format(self.image))
+        if self.pull_policy == 'always' or (
+                self.pull_policy == 'if-not-present' and
+                self.image not in self.inventory):
+            self.client.pull(self.image, **registry_kwargs(self.image))
+            self.inventory.invalidate()
+            self.logger.debug("Pulled {}".format(self.image))
+        elif self.image not in self.inventory:
+            raise DependencyError(
+                "Image {} is not available locally and its pull policy is "
+                "never".format(self.image)
+            )
+        kwargs = {}
+        if self.environment:
+            kwargs['environment'] = self.environment
+        if self.labels:
+            kwargs['labels'] = self.labels
         self.container = self.client.create_container(
             image=self.image,
             host_config=self.host_config,
             name=self.name,
-            command=self.command
+            command=self.command,
+            **kwargs
         )
         self.logger.debug("Created container {}".format(self.container['Id']))
 
@@ -0,0 +1,469 @@
+"""
+Structured build logs: decoding of the docker status stream, and chunked,
+compressed storage of the events of each build
+"""
+import bisect
+import json
+import logging
+import os
+import Queue
+import re
+import struct
+import threading
+import time
+import zlib
+
+# Statuses after which nothing is written to the log of a build, unless it
+# runs again: it finished, was superseded, or was requeued
+END_STATUSES = ('finished', 'skipped', 'queued')
+
+
+class StatusDecoder(object):
+    """
+    Incremental decoder of the JSON status stream of `docker build` and
+    `docker push`. Chunks of the stream are fed as they arrive, and need not
+    be aligned with the JSON objects; each decoded object is turned into an
+    event dict with a `type` of:
+      step: a Dockerfile instruction starts; `step`, `steps`, `message`
+      layer: a layer was committed; `layer`
+      built: the image was built; `image`
+      progress: a layer is pulled or pushed; `layer`, `current`, `total`
+      pushed: the image was pushed; `digest`
+      error: the daemon reported an error; `error`
+      output: anything else; `message`
+    Every event after the first step also carries its `step`. Lines that are
+    not JSON, e.g. from daemons predating the JSON stream, are decoded as
+    output lines.
+    """
+
+    step_re = re.compile(r'^Step (\d+)(?:/(\d+))? : (.*)$', re.S)
+    layer_re = re.compile(r'^ ---> ([0-9a-f]{12,})\s*$')
+    built_re = re.compile(r'^Successfully built\s*([0-9a-f]*)', re.I)
+    digest_re = re.compile(r'digest: (sha256\S*)', re.I)
+
+    def __init__(self):
+        self.buffer = u''
+        self.step = None
+        self.decoder = json.JSONDecoder()
+
+    def feed(self, chunk):
+        """
+        :param chunk: data read from the status stream
+        :return: list of the events completed by the chunk
+        """
+        if isinstance(chunk, bytes):
+            chunk = chunk.decode('utf-8', 'replace')
+        self.buffer += chunk
+        events = []
+        while True:
+            buf = self.buffer.lstrip()
+            if not buf:
+                self.buffer = u''
+                break
+            if buf[0] != u'{':
+                line, newline, rest = buf.partition(u'\n')
+                if not newline:  # Wait for the end of the line
+                    self.buffer = buf
+                    break
+                events.append(self.parse_line(line))
+                self.buffer = rest
+                continue
+            try:
+                obj, end = self.decoder.raw_decode(buf)
+            except ValueError:  # Wait for the end of the object
+                self.buffer = buf
+                break
+            events.append(self.parse(obj))
+            self.buffer = buf[end:]
+        return events
+
+    def close(self):
+        """
+        :return: list of the events of the data left at the end of the stream
+        """
+        buf, self.buffer = self.buffer.strip(), u''
+        if not buf:
+            return []
+        return [self.parse_line(line) for line in buf.splitlines()]
+
+    def parse_line(self, line):
+        """
+        :param line: line of a status stream that is not JSON
+        :return: event dict
+        """
+        event = self.parse({'stream': line})
+        if event['type'] == 'output':
+            digest = self.digest_re.search(line)
+            if digest or 'pushing tag' in line.lower():
+                event['type'] = 'pushed'
+                event['digest'] = digest.group(1) if digest else None
+        return event
+
+    def parse(self, obj):
+        """
+        :param obj: decoded JSON status object
+        :return: event dict
+        """
+        event = {'type': 'output'}
+        if obj.get('error') or obj.get('errorDetail'):
+            event['type'] = 'error'
+            event['error'] = obj.get('error') or \
+                obj['errorDetail'].get('message')
+        elif 'stream' in obj:
+            message = obj['stream'].rstrip('\n')
+            event['message'] = message
+            step = self.step_re.match(message)
+            layer = self.layer_re.match(message)
+            built = self.built_re.match(message)
+            if step:
+                self.step = int(step.group(1))
+                event['type'] = 'step'
+                if step.group(2):
+                    event['steps'] = int(step.group(2))
+            elif layer:
+                event['type'] = 'layer'
+                event['layer'] = layer.group(1)
+            elif built:
+                event['type'] = 'built'
+                event['image'] = built.group(1) or None
+        elif 'status' in obj:
+            message = obj['status']
+            event['message'] = message
+            if obj.get('id'):
+                event['layer'] = obj['id']
+            detail = obj.get('progressDetail') or {}
+            digest = self.digest_re.search(message)
+            if detail.get('current') is not None:
+                event['type'] = 'progress'
+                event['current'] = detail['current']
+                event['total'] = detail.get('total')
+            elif digest or 'pushing tag' in message.lower():
+                event['type'] = 'pushed'
+                event['digest'] = digest.group(1) if digest else None
+        elif 'aux' in obj:
+            event['type'] = 'aux'
+            event['message'] = json.dumps(obj['aux'])
+        if self.step is not None:
+            event['step'] = self.step
+        return event
+
+
+def describe(event):
+    """
+    :param event: event dict
+    :return: one line description of the event
+    """
+    if event['type'] == 'error':
+        return u"ERROR: {}".format(event['error'])
+    if event['type'] == 'progress':
+        return u"{} {}: {}/{}".format(
+            event.get('message'), event.get('layer'), event['current'],
+            event.get('total'),
+        )
+    return event.get('message') or u''
+
+
+class BuildLog(object):
+    """
+    Append-only log of the events of one build, stored as a series of zlib
+    compressed chunks of JSON lines in `<build id>.log`, with an index of the
+    chunks in `<build id>.idx`. Each index record holds the number of the
+    first event of the chunk, its number of events, its offset and length in
+    the log file and its uncompressed length, so that a range of events, or
+    the tail of the log, is read by decompressing only the chunks that hold
+    it. A chunk is only indexed once it is completely written, so readers
+    never see partial chunks.
+    """
+
+    record = struct.Struct('<QIQII')
+
+    def __init__(self, directory, build_id, chunk_size=64 * 1024,
+                 flush_interval=None):
+        """
+        :param directory: directory of the build logs; created if needed
+        :param build_id: id of the models.Build
+        :param chunk_size: uncompressed size of the chunks, in bytes
+        :param flush_interval: seconds after which pending events are stored
+            even if their chunk is not full, so that followers of the build
+            see them; None to only store full chunks
+        """
+        self.build_id = build_id
+        self.path = os.path.join(directory, '{}.log'.format(build_id))
+        self.index_path = os.path.join(directory, '{}.idx'.format(build_id))
+        self.chunk_size = chunk_size
+        self.flush_interval = flush_interval
+        self.flushed = time.time()
+        self.pending = []
+        self.pending_size = 0
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+    @classmethod
+    def for_build(cls, config, build_id):
+        """
+        :param config: application config
+        :param build_id: id of the models.Build
+        :return: the BuildLog of the build in BUILD_LOG_DIR, or None if build
+            logs are disabled
+        """
+        if not config.get('BUILD_LOG_DIR'):
+            return None
+        return cls(
+            config['BUILD_LOG_DIR'], build_id,
+            chunk_size=config.get('BUILD_LOG_CHUNK_SIZE', 64 * 1024),
+            flush_interval=config.get('BUILD_LOG_FLUSH_INTERVAL'),
+        )
+
+    def exists(self):
+        """
+        :return: True if any event of the build was stored
+        """
+        return os.path.isfile(self.index_path)
+
+    def write(self, event):
+        """
+        Appends an event; the event is stored once its chunk is full or the
+        log is flushed
+        :param event: event dict
+        """
+        line = json.dumps(event, separators=(',', ':')) + '\n'
+        self.pending.append(line)
+        self.pending_size += len(line)
+        if self.pending_size >= self.chunk_size or (
+                self.flush_interval is not None and
+                time.time() - self.flushed >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """
+        Stores the pending events as a chunk
+        """
+        self.flushed = time.time()
+        if not self.pending:
+            return
+        index = self.index()
+        first = index[-1][0] + index[-1][1] if index else 0
+        data = ''.join(self.pending)
+        chunk = zlib.compress(data)
+        with open(self.path, 'ab') as f:
+            f.seek(0, os.SEEK_END)
+            offset = f.tell()
+            f.write(chunk)
+        with open(self.index_path, 'ab') as f:
+            f.write(self.record.pack(
+                first, len(self.pending), offset, len(chunk), len(data)
+            ))
+        self.pending = []
+        self.pending_size = 0
+
+    close = flush
+
+    def index(self):
+        """
+        :return: list of (first event, number of events, offset, length,
+            uncompressed length) of the stored chunks
+        """
+        try:
+            with open(self.index_path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return []
+        size = self.record.size
+        return [
+            self.record.unpack(data[i:i + size])
+            for i in range(0, len(data) - len(data) % size, size)
+        ]
+
+    def __len__(self):
+        """
+        number of stored events
+        """
+        index = self.index()
+        return index[-1][0] + index[-1][1] if index else 0
+
+    @property
+    def size(self):
+        """
+        uncompressed size of the stored events, in bytes
+        """
+        return sum(record[4] for record in self.index())
+
+    def read(self, start=0, stop=None):
+        """
+        :param start: number of the first event to read
+        :param stop: number of the event to stop at; None for the end
+        :return: list of the stored events [start:stop]
+        """
+        index = self.index()
+        if not index:
+            return []
+        total = index[-1][0] + index[-1][1]
+        stop = total if stop is None else min(stop, total)
+        if start >= stop:
+            return []
+        firsts = [record[0] for record in index]
+        i = bisect.bisect_right(firsts, start) - 1
+        events = []
+        with open(self.path, 'rb') as f:
+            while i < len(index) and index[i][0] < stop:
+                first, _, offset, length, _ = index[i]
+                f.seek(offset)
+                lines = zlib.decompress(f.read(length)).splitlines()
+                for n, line in enumerate(lines, first):
+                    if start <= n < stop:
+                        events.append(json.loads(line))
+                i += 1
+        return events
+
+    def tail(self, n):
+        """
+        :return: list of the last n stored events
+        """
+        total = len(self)
+        return self.read(max(total - n, 0), total)
+
+
+class LogTailer(object):
+    """
+    Follows the log of a build for any number of followers in the process:
+    a single thread reads the chunks stored since it last looked and fans
+    their events out to the queue of each follower. The thread stops once
+    the last status of the build is one of END_STATUSES, or its last
+    follower left. There is one tailer per build and process; use
+    LogTailer.follow.
+    """
+
+    tailers = {}
+    tailers_lock = threading.Lock()
+
+    def __init__(self, log, interval=0.5):
+        """
+        :param log: BuildLog of the build
+        :param interval: seconds between two reads of the log
+        """
+        self.log = log
+        self.interval = interval
+        self.position = 0
+        self.followers = []
+        self.status = None
+        self.finished = False
+        self.lock = threading.Lock()
+        self.thread = None
+        self.logger = logging.getLogger(__name__)
+
+    @classmethod
+    def follow(cls, log, start=0, interval=0.5, keepalive=15):
+        """
+        Follows the log of a build
+        :param log: BuildLog of the build
+        :param start: number of the first event to yield
+        :param interval: seconds between two reads of the log
+        :param keepalive: seconds without events after which None is yielded
+        :return: generator of (event number, event), or None as keepalive,
+            that ends once the build finished, was skipped or requeued
+        """
+        with cls.tailers_lock:
+            tailer = cls.tailers.get(log.path)
+            if tailer is None:
+                tailer = cls.tailers[log.path] = cls(log, interval)
+            backlog, queue = tailer.subscribe(start)
+        return tailer.iterate(backlog, queue, keepalive)
+
+    def subscribe(self, start):
+        """
+        :param start: number of the first event for the follower
+        :return: list of the events the tailer already read, from start, and
+            the follower's queue of the later events
+        """
+        with self.lock:
+            backlog = [
+                (n, event) for n, event in enumerate(
+                    self.log.read(start, self.position), start
+                )
+            ]
+            queue = Queue.Queue()
+            if self.finished:
+                queue.put(None)
+            else:
+                self.followers.append(queue)
+                if self.thread is None:
+                    self.thread = threading.Thread(
+                        target=self.run,
+                        name='tail-build-{}'.format(self.log.build_id)
+                    )
+                    self.thread.daemon = True
+                    self.thread.start()
+        return backlog, queue
+
+    def unsubscribe(self, queue):
+        with self.lock:
+            if queue in self.followers:
+                self.followers.remove(queue)
+
+    def iterate(self, backlog, queue, keepalive):
+        """
+        :return: generator of the backlog then of the queue of a follower
+        """
+        try:
+            for item in backlog:
+                yield item
+            while True:
+                try:
+                    item = queue.get(timeout=keepalive)
+                except Queue.Empty:
+                    yield None
+                    continue
+                if item is None:
+                    return
+                yield item
+        finally:
+            self.unsubscribe(queue)
+
+    def poll(self):
+        """
+        Fans the events stored since the last poll out to the followers
+        :return: True while the build is not finished and has followers
+        """
+        with self.lock:
+            events = self.log.read(self.position)
+            for n, event in enumerate(events, self.position):
+                for queue in self.followers:
+                    queue.put((n, event))
+                if event['type'] == 'status':
+                    self.status = event.get('status')
+            self.position += len(events)
+            # e.g. a requeued build that runs again is still followed
+            self.finished = self.status in END_STATUSES
+            if self.finished:
+                for queue in self.followers:
+                    queue.put(None)
+                del self.followers[:]
+            return not self.finished and bool(self.followers)
+
+    def run(self):
+        try:
+            while True:
+                while self.poll():
+                    time.sleep(self.interval)
+                with self.tailers_lock:
+                    with self.lock:
+                        # A follower may have subscribed since the last poll
+                        if self.followers and not self.finished:
+                            continue
+                        self.tailers.pop(self.log.path, None)
+                        self.thread = None
+                        return
+        except Exception:
+            self.logger.exception(
+                "Failed to tail the log of build {}".format(self.log.build_id)
+            )
+            with self.tailers_lock:
+                with self.lock:
+                    for queue in self.followers:
+                        queue.put(None)
+                    del self.followers[:]
+                    self.tailers.pop(self.log.path, None)
+                    self.thread = None
@@ -3,6 +3,15 @@ GITHUB_SECRET = 'redacted'
 GITHUB_COMMIT_API = 'https://api.github.com/repos/adsabs/{repo}/git/commits/{hash}'
 GITHUB_TAG_FIND_API = 'https://api.github.com/repos/adsabs/{repo}/git/refs/tags/{tag}'
 GITHUB_TAG_GET_API = 'https://api.github.com/repos/adsabs/{repo}/git/tags/{hash}'
+# Acknowledge webhooks as soon as their signature is verified and their payload
+# is spooled to WEBHOOK_SPOOL_DIR; mc.tasks.ingest_webhooks then creates the
+# commits and builds in batches of up to WEBHOOK_INGEST_BATCH_SIZE, collected
+# over WEBHOOK_INGEST_WINDOW seconds
+WEBHOOK_ASYNC = False
+WEBHOOK_SPOOL_DIR = 'spool/webhooks'
+WEBHOOK_INGEST_BATCH_SIZE = 100
+WEBHOOK_INGEST_WINDOW = 1.0
+WEBHOOK_CLAIM_TIMEOUT = 300
 AWS_REGION = 'us-east-1'
 AWS_ACCESS_KEY = 'redacted'
 AWS_SECRET_KEY = 'redacted'
@@ -21,7 +30,80 @@ WATCHED_REPOS = [
     'myads',
 ]
 
-# Local dependencies for the testing environment
+# Docker layer cache policy per repository; the 'default' entry applies to
+# repositories without an entry of their own.
+#   fresh: pull the base image and build without the layer cache
+#   refresh: build with the layer cache, unless the last fresh build of the
+#       repository is older than max_age seconds
+# `manage.py dockerbuild --refresh` forces a fresh build.
+DOCKER_CACHE_POLICIES = {
+    'default': {'policy': 'refresh', 'max_age': 24 * 60 * 60},
+}
+
+# Fresh builds pull the shared base image of the services, and rebuild it
+# once it is older than BASE_IMAGE_MAX_AGE seconds
+BASE_IMAGE_MAX_AGE = 24 * 60 * 60
+
+# Keep a bare mirror of each watched repository in GIT_MIRROR_DIR on the build
+# host, and send the commit's tree in the docker context instead of cloning
+# the repository within the container. Disabled if None.
+GIT_MIRROR_DIR = None
+GIT_MIRROR_URL = 'https://github.com/adsabs/{repo}'
+
+# Build the wheels of each repository's requirements in the base image, keep
+# them in WHEELHOUSE_DIR on the build host and send them in the docker
+# context; only used with GIT_MIRROR_DIR. Requirements without a wheel are
+# installed from PyPI. Least recently used wheels are evicted beyond
+# WHEELHOUSE_MAX_SIZE bytes, once no build is using the wheelhouse. Disabled
+# if None.
+WHEELHOUSE_DIR = None
+WHEELHOUSE_MAX_SIZE = 2 * 1024 ** 3
+
+# Directory holding the .docker/config.json (or .dockercfg) with the registry
+# credentials used to push and pull images; the client's $HOME if None
+DOCKER_HOME = None
+
+# Fetch the manifest of each pushed image from the registry to record its
+# compressed size along with the other image stats of the build
+IMAGE_STATS_REGISTRY = False
+
+# Store the decoded docker build and push events of each build in
+# BUILD_LOG_DIR, as zlib compressed chunks of BUILD_LOG_CHUNK_SIZE bytes, or
+# of the events of BUILD_LOG_FLUSH_INTERVAL seconds. /builds/<id>/log streams
+# them, reading the log of a running build every BUILD_LOG_POLL_INTERVAL
+# seconds. Disabled if None.
+BUILD_LOG_DIR = None
+BUILD_LOG_CHUNK_SIZE = 64 * 1024
+BUILD_LOG_FLUSH_INTERVAL = 1.0
+BUILD_LOG_POLL_INTERVAL = 0.5
+
+# Concurrent builds on the docker daemon, for `manage.py schedulebuilds`: as
+# many as the daemon's CPUs and memory allow at DOCKER_BUILD_CPUS and
+# DOCKER_BUILD_MEMORY bytes per build, at most DOCKER_BUILD_SLOTS (None for no
+# maximum). Builds of the same repository never run concurrently.
+DOCKER_BUILD_SLOTS = None
+DOCKER_BUILD_CPUS = 1
+DOCKER_BUILD_MEMORY = 1024 ** 3
+
+# Docker daemons of the build farm, e.g. ['tcp://build1:2375', ...]; each
+# build is placed on the daemon that last built its repository, or else on
+# the least loaded one, and fails over if its daemon goes away. The slots of
+# each daemon are sized as above, and daemons are health checked at most
+# every DOCKER_HOST_CHECK_INTERVAL seconds. Builds use the local daemon if
+# empty.
+DOCKER_HOSTS = []
+DOCKER_HOST_CHECK_INTERVAL = 30
+
+# Templates are compiled once per process and, if JINJA2_BYTECODE_DIR is set,
+# cached on disk across processes. With JINJA2_AUTO_RELOAD, every use of a
+# template checks whether it changed on disk; otherwise builds check whether
+# the templates changed at most every TEMPLATES_REFRESH_INTERVAL seconds.
+JINJA2_BYTECODE_DIR = None
+JINJA2_AUTO_RELOAD = False
+TEMPLATES_REFRESH_INTERVAL = 60
+
+# Local dependencies for the testing environment; POSTGRES may also hold the
+# PASSWORD of its USERNAME
 DEPENDENCIES = {
     'POSTGRES': {
         'USERNAME': 'postgres',
@@ -33,6 +115,46 @@ DEPENDENCIES = {
     }
 }
 
+# When the dependency containers pull their image: always, if-not-present or
+# never. The images available locally are listed at most every
+# DOCKER_IMAGE_INVENTORY_TTL seconds.
+DOCKER_PULL_POLICY = 'if-not-present'
+DOCKER_IMAGE_INVENTORY_TTL = 300
+
+# Host the ports of the dependency containers of test environments are
+# published on, and seconds each dependency has to become ready
+DEPENDENCIES_HOST = 'localhost'
+DEPENDENCIES_READY_TIMEOUT = 120
+
+# Keep WARM_POOL_SIZE started and provisioned test environments ready per
+# set of dependencies in each worker process, to hand out to new tests. Once a test
+# released its environment, it is destroyed, reset to its provisioned state
+# or reused as is, per WARM_POOL_RESET. Environments idle for longer than
+# WARM_POOL_MAX_IDLE seconds are destroyed, every WARM_POOL_EVICT_INTERVAL
+# seconds. Disabled if 0.
+WARM_POOL_SIZE = 0
+WARM_POOL_MAX_IDLE = 1800
+WARM_POOL_RESET = 'destroy'
+WARM_POOL_EVICT_INTERVAL = 60
+
+# Load the postgres dependency of test environments in process, over one
+# connection per database ('native'), or with the psql scripts of
+# templates/postgres ('script')
+POSTGRES_PROVISIONER = 'native'
+
+# Start the postgres dependency of test environments from a snapshot of the
+# provisioned databases of their services, keyed by a hash of their schema
+# and data files and of the postgres image: 'template' keeps a TEMPLATE
+# database per service on the server and clones it, which requires the
+# servers of a warm pool with WARM_POOL_RESET = 'reset', as every other
+# environment starts a new server; 'image' commits the provisioned container
+# into an image of POSTGRES_SNAPSHOT_REPOSITORY and runs it. Its data
+# directory is POSTGRES_SNAPSHOT_PGDATA, outside of the volume of the
+# postgres image, so that it is committed. Disabled if None.
+POSTGRES_SNAPSHOT = None
+POSTGRES_SNAPSHOT_REPOSITORY = 'adsabs/postgres-snapshot'
+POSTGRES_SNAPSHOT_PGDATA = '/var/lib/postgresql/snapshot'
+
 MC_LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -59,4 +181,11 @@ MC_LOGGING = {
     },
 }
 
+CELERYBEAT_SCHEDULE = {
+    'ingest-webhooks': {
+        'task': 'mc.tasks.ingest_webhooks',
+        'schedule': 5.0,
+    },
+}
+
 SQLALCHEMY_DATABASE_URI = 'sqlite://'
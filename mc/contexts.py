@@ -0,0 +1,107 @@
+"""
+Docker build contexts streamed to the daemon
+"""
+import io
+import os
+import tarfile
+
+
+class DockerContext(object):
+    """
+    Tar build context generated lazily, member by member, as the docker
+    client sends it. Rendered templates are encoded one at a time, on-disk
+    files are read in chunks from their open file, and the tree of the
+    commit is streamed out of the mirror, so that the memory used does not
+    depend on the size of the context. The context can be iterated over more
+    than once; each iteration generates it again.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, files, mirror=None, commit_hash=None, prefix='src/',
+                 chunk_size=None):
+        """
+        :param files: list of dicts with the name and either the content
+            (and optional mode) or the path of the file
+        :param mirror: GitMirror to add the tree of the commit from, or None
+        :param commit_hash: commit whose tree is added
+        :param prefix: path of the tree within the context
+        :param chunk_size: size of the chunks sent to the daemon
+        """
+        self.files = files
+        self.mirror = mirror
+        self.commit_hash = commit_hash
+        self.prefix = prefix
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
+
+    def members(self):
+        """
+        :return: generator of (tarfile.TarInfo, file object or None)
+        """
+        for f in self.files:
+            tarinfo = tarfile.TarInfo(f['name'])
+            if 'path' in f:  # On-disk file
+                st = os.stat(f['path'])
+                tarinfo.size = st.st_size
+                tarinfo.mode = st.st_mode & 07777
+                tarinfo.mtime = st.st_mtime
+                with open(f['path'], 'rb') as fileobj:
+                    yield tarinfo, fileobj
+                continue
+            content = f['content'].encode('utf-8')
+            # The size of a member is that of its encoded bytes
+            tarinfo.size = len(content)
+            if 'mode' in f:
+                tarinfo.mode = f['mode']
+            yield tarinfo, io.BytesIO(content)
+        if self.mirror is not None:
+            for member in self.mirror.members(self.commit_hash, self.prefix):
+                yield member
+
+    def blocks(self):
+        """
+        :return: generator of the tar blocks of the context: the header,
+            content and padding of each member, then the end of archive
+        """
+        for tarinfo, fileobj in self.members():
+            yield tarinfo.tobuf(tarfile.GNU_FORMAT, 'utf-8', 'strict')
+            if fileobj is None or not tarinfo.size:
+                continue
+            remaining = tarinfo.size
+            while remaining:
+                chunk = fileobj.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    raise IOError("{} is shorter than {} bytes".format(
+                        tarinfo.name, tarinfo.size
+                    ))
+                remaining -= len(chunk)
+                yield chunk
+            remainder = tarinfo.size % tarfile.BLOCKSIZE
+            if remainder:
+                yield tarfile.NUL * (tarfile.BLOCKSIZE - remainder)
+        yield tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+
+    def __iter__(self):
+        """
+        :return: generator of chunks of about chunk_size bytes; small members
+            are sent together, and no chunk is empty, which would end a
+            chunked upload
+        """
+        buf, size = [], 0
+        for block in self.blocks():
+            buf.append(block)
+            size += len(block)
+            if size >= self.chunk_size:
+                yield ''.join(buf)
+                buf, size = [], 0
+        if buf:
+            yield ''.join(buf)
+
+    def tobytes(self):
+        """
+        :return: the whole context as a string; for inspection only. It is
+            not named getvalue, which requests would call to size the body
+            of the upload instead of sending it chunked.
+        """
+        return ''.join(self)
@@ -0,0 +1,661 @@
+"""
+Dependency containers of the test environments
+"""
+import collections
+import functools
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+import psycopg2
+import requests
+from flask import current_app
+from mc.builders import DockerRunner
+from mc.exceptions import DependencyError
+from mc.provisioners import dependencies_config
+from mc.utils import StageTimer
+
+# Label of the dependency containers, holding the name of their dependency
+DEPENDENCY_LABEL = 'mc.dependency'
+
+
+def tcp_probe(host, port, timeout=1.0):
+    """
+    :return: True if the port accepts connections
+    """
+    try:
+        socket.create_connection((host, int(port)), timeout).close()
+    except (socket.error, socket.timeout):
+        return False
+    return True
+
+
+def postgres_probe(host, port, timeout=1, dependencies=None):
+    """
+    Like pg_isready, but runs a query: postgres accepts connections while
+    it is still initialising the database, and restarts once it is done
+    :param dependencies: DEPENDENCIES config holding the USERNAME and
+        PASSWORD to connect with; the app's if None
+    :return: True if postgres answers queries
+    """
+    config = dependencies_config(dependencies)['POSTGRES']
+    try:
+        conn = psycopg2.connect(
+            host=host, port=int(port), dbname='postgres',
+            user=config.get('USERNAME', 'postgres'),
+            password=config.get('PASSWORD'),
+            connect_timeout=timeout,
+        )
+    except psycopg2.Error:
+        return False
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT 1')
+        return cursor.fetchone() == (1,)
+    except psycopg2.Error:
+        return False
+    finally:
+        conn.close()
+
+
+def consul_probe(host, port, timeout=1.0):
+    """
+    :return: True if the consul cluster elected a leader, without which its
+        key/value store cannot be written to
+    """
+    try:
+        r = requests.get(
+            'http://{}:{}/v1/status/leader'.format(host, port),
+            timeout=timeout,
+        )
+    except requests.exceptions.RequestException:
+        return False
+    return r.status_code == 200 and bool(r.json())
+
+
+PROBES = {
+    'tcp': tcp_probe,
+    'postgres': postgres_probe,
+    'consul': consul_probe,
+}
+
+
+def wait_until_ready(probe, timeout=60, delay=0.1, max_delay=2.0,
+                     sleep=time.sleep):
+    """
+    Calls a readiness probe until it succeeds, backing off exponentially
+    between attempts
+    :param probe: callable returning True once the dependency is ready
+    :param timeout: seconds to wait at most
+    :param delay: seconds to wait after the first failed attempt
+    :param max_delay: seconds to wait at most between two attempts
+    :param sleep: function used to wait
+    :return: number of attempts
+    :raises DependencyError: if the probe did not succeed in time
+    """
+    deadline = time.time() + timeout
+    attempts = 0
+    while True:
+        attempts += 1
+        if probe():
+            return attempts
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise DependencyError(
+                "Not ready after {} attempts in {}s".format(attempts, timeout)
+            )
+        sleep(min(delay, max_delay, remaining))
+        delay *= 2
+
+
+class TestEnvironment(object):
+    """
+    Starts the dependency containers of a test environment concurrently.
+    Each dependency is a dict with:
+        name: name of the dependency
+        image: docker image to run
+        port: port of the container the dependency listens on
+        probe: name of the readiness probe in PROBES; 'tcp' by default
+        requires: names of the dependencies that have to be ready, and
+            provisioned, before the dependency is provisioned
+        callback: provisions the dependency once it and its requirements are
+            ready; called with the endpoints of the environment
+        reset: restores the provisioned state of the dependency after a
+            test, for reuse by the next one; called with the endpoints
+        snapshot: keeps the provisioned state of the dependency, e.g. by
+            committing its container; called with the endpoints and its
+            DockerRunner once it is provisioned
+        pull_policy: when to pull the image, see PULL_POLICIES
+        runner: keyword arguments of its DockerRunner
+    The environment is ready in about the time of its slowest chain of
+    dependencies, rather than the sum of all of them.
+    """
+
+    def __init__(self, test_id, dependencies, host='localhost', timeout=60,
+                 refresh=False, runner_factory=None):
+        """
+        :param test_id: id of the test run, suffixed to container names
+        :param dependencies: list of dependency dicts
+        :param host: host the containers' ports are published on
+        :param timeout: seconds each dependency has to become ready
+        :param refresh: list the images of the docker daemon again rather
+            than trust its image inventory
+        :param runner_factory: callable creating a DockerRunner
+        """
+        self.test_id = test_id
+        self.dependencies = dict((d['name'], d) for d in dependencies)
+        self.host = host
+        self.timeout = timeout
+        self.refresh = refresh
+        self.runner_factory = runner_factory or DockerRunner
+        self.runners = {}
+        self.endpoints = {}
+        self.timers = dict((name, StageTimer()) for name in self.dependencies)
+        self.errors = {}
+        self.ready_time = None
+        self._done = dict(
+            (name, threading.Event()) for name in self.dependencies
+        )
+        self._lock = threading.Lock()
+        try:
+            self.app = current_app._get_current_object()
+            self.logger = current_app.logger
+        except RuntimeError:  # Outside of application context
+            self.app = None
+            self.logger = logging.getLogger(__name__)
+        for d in dependencies:
+            unknown = set(d.get('requires', [])).difference(self.dependencies)
+            if unknown:
+                raise DependencyError("{} requires unknown {}".format(
+                    d['name'], ', '.join(sorted(unknown))
+                ))
+        self._check_cycles()
+
+    def _check_cycles(self):
+        """
+        :raises DependencyError: if dependencies require each other, which
+            would have them wait for each other forever
+        """
+        # Dependencies after their requirements
+        self.order = []
+
+        def visit(name, path):
+            if name in path:
+                raise DependencyError("Circular requirements: {}".format(
+                    ' -> '.join(path + [name])
+                ))
+            if name in self.order:
+                return
+            for required in self.dependencies[name].get('requires', []):
+                visit(required, path + [name])
+            self.order.append(name)
+
+        for name in sorted(self.dependencies):
+            visit(name, [])
+
+    def start(self):
+        """
+        Starts all the dependencies and waits until they are ready and
+        provisioned. Tears the environment down if any of them failed.
+        :return: self
+        :raises DependencyError: if a dependency failed
+        """
+        start = time.time()
+        threads = [
+            threading.Thread(target=self._run, args=(name,))
+            for name in self.dependencies
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.ready_time = time.time() - start
+
+        if self.errors:
+            self.teardown()
+            raise DependencyError("Test environment {} failed: {}".format(
+                self.test_id, '; '.join(
+                    "{}: {}".format(name, e)
+                    for name, e in sorted(self.errors.items())
+                )
+            ))
+        self.logger.info(
+            "Test environment {} ready in {:.1f}s [{}]".format(
+                self.test_id, self.ready_time, ' '.join(
+                    "{}: {}".format(name, self.timers[name])
+                    for name in sorted(self.dependencies)
+                )
+            )
+        )
+        return self
+
+    def _run(self, name):
+        """
+        Starts, probes and provisions a dependency, in its own thread
+        """
+        try:
+            if self.app is not None:
+                with self.app.app_context():
+                    self._start(name)
+            else:
+                self._start(name)
+        except Exception as e:
+            self.logger.exception(e)
+            with self._lock:
+                self.errors[name] = e
+        finally:
+            self._done[name].set()
+
+    def _start(self, name):
+        dependency = self.dependencies[name]
+        timer = self.timers[name]
+        port = dependency.get('port')
+
+        with timer('create'):
+            kwargs = dict(dependency.get('runner', {}))
+            if 'pull_policy' in dependency:
+                kwargs.setdefault('pull_policy', dependency['pull_policy'])
+            if self.refresh:
+                kwargs.setdefault('refresh', True)
+            if port is not None:
+                kwargs.setdefault('port_bindings', {port: None})
+            kwargs.setdefault('labels', {DEPENDENCY_LABEL: name})
+            runner = self.runner_factory(
+                image=dependency['image'],
+                name='{}-{}'.format(name, self.test_id),
+                **kwargs
+            )
+            with self._lock:
+                self.runners[name] = runner
+        with timer('start'):
+            runner.start()
+
+        if port is not None:
+            host_port = int(runner.client.port(
+                runner.container['Id'], port
+            )[0]['HostPort'])
+            with self._lock:
+                self.endpoints[name] = (self.host, host_port)
+            probe = PROBES[dependency.get('probe', 'tcp')]
+            with timer('ready'):
+                wait_until_ready(
+                    functools.partial(probe, self.host, host_port),
+                    timeout=self.timeout,
+                )
+
+        for required in dependency.get('requires', []):
+            self._done[required].wait()
+            if required in self.errors:
+                raise DependencyError("{} failed".format(required))
+
+        if callable(dependency.get('callback')):
+            with timer('provision'):
+                dependency['callback'](dict(self.endpoints))
+
+        if callable(dependency.get('snapshot')):
+            with timer('snapshot'):
+                dependency['snapshot'](dict(self.endpoints), runner)
+
+    def reset(self):
+        """
+        Restores the provisioned state of the dependencies, requirements
+        first, so that the environment can be used by another test
+        """
+        for name in self.order:
+            reset = self.dependencies[name].get('reset')
+            if callable(reset):
+                with self.timers[name]('reset'):
+                    reset(dict(self.endpoints))
+
+    def rename(self, environment_id):
+        """
+        Renames the containers of the environment after the test it is
+        handed out to, `<dependency>-<test id>`, so that any process can
+        find them, see remove_environment
+        :param environment_id: new id of the environment
+        """
+        for name, runner in self.runners.items():
+            runner.name = '{}-{}'.format(name, environment_id)
+            runner.client.rename(runner.container['Id'], runner.name)
+        self.test_id = environment_id
+
+    def teardown(self):
+        """
+        Stops and removes the containers of the environment
+        """
+        for name, runner in self.runners.items():
+            try:
+                runner.teardown()
+            except Exception as e:
+                self.logger.warning(
+                    "Cannot tear down {}: {}".format(name, e)
+                )
+        self.runners = {}
+
+    def summary(self):
+        """
+        :return: dict of the ready time, and of the endpoint, container and
+            stage durations of each dependency
+        """
+        return {
+            'ready_time': self.ready_time,
+            'dependencies': dict(
+                (name, {
+                    'endpoint': self.endpoints.get(name),
+                    'container': self.runners[name].container['Id']
+                    if name in self.runners else None,
+                    'durations': dict(self.timers[name].durations),
+                })
+                for name in self.dependencies
+            ),
+        }
+
+
+def environment_key(dependencies, services):
+    """
+    :param dependencies: list of dependency dicts
+    :param services: services the dependencies are provisioned for
+    :return: hash of what makes two environments interchangeable: the
+        images, ports, probes, requirements and runner arguments of their
+        dependencies, and the services they are provisioned for
+    """
+    spec = [
+        dict((k, d.get(k)) for k in (
+            'name', 'image', 'port', 'probe', 'requires', 'pull_policy',
+            'runner'
+        ))
+        for d in sorted(dependencies, key=lambda d: d['name'])
+    ]
+    return hashlib.sha256(
+        json.dumps([spec, sorted(services)], sort_keys=True, default=str)
+    ).hexdigest()
+
+
+def remove_environment(client, environment_id):
+    """
+    Stops and removes the dependency containers of a test environment by
+    name, e.g. from a process other than the one whose warm pool handed it
+    out
+    :param client: docker.Client of the daemon running the containers
+    :param environment_id: id of the environment, or of the test it was
+        handed out to
+    :return: number of containers removed
+    """
+    removed = 0
+    for container in client.containers(
+            all=True, filters={'label': DEPENDENCY_LABEL}):
+        name = '/{}-{}'.format(
+            container['Labels'][DEPENDENCY_LABEL], environment_id
+        )
+        if name in (container.get('Names') or []):
+            client.remove_container(container['Id'], force=True)
+            removed += 1
+    return removed
+
+
+class EnvironmentPool(object):
+    """
+    Warm pool of started and provisioned test environments, per environment
+    key. A new test environment is handed an idle one if there is one (a
+    hit), and the pool is then refilled in the background up to `size` idle
+    environments. Once the test is done, the environment is destroyed, reset
+    to its provisioned state or reused as is, according to the reset policy.
+    Environments idle for longer than `max_idle` seconds are destroyed, every
+    `evict_interval` seconds.
+
+    The pool lives in one process: an environment can only be given back to
+    the process that handed it out. Its containers are named after the test
+    though, so that another process can remove them, see
+    remove_environment.
+    """
+
+    RESET_POLICIES = ('destroy', 'reset', 'reuse')
+
+    def __init__(self, size=1, max_idle=1800, reset_policy='destroy',
+                 evict_interval=None):
+        """
+        :param size: number of idle environments to keep per key
+        :param max_idle: seconds an environment may stay idle
+        :param reset_policy: one of RESET_POLICIES
+        :param evict_interval: seconds between evictions of the idle
+            environments in the background; only when environments are
+            handed out if None
+        """
+        if reset_policy not in self.RESET_POLICIES:
+            raise ValueError("Unknown reset policy {}".format(reset_policy))
+        self.size = size
+        self.max_idle = max_idle
+        self.reset_policy = reset_policy
+        # key: [(environment, idle since)]
+        self.idle = collections.defaultdict(list)
+        # test_id: (key, environment)
+        self.in_use = {}
+        self.starting = collections.Counter()
+        self.warming = collections.defaultdict(list)
+        self.counters = collections.defaultdict(collections.Counter)
+        self.factories = {}
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+        self.hostname = socket.gethostname()
+        self._stopped = threading.Event()
+        self._evictor = None
+        if evict_interval:
+            self._evictor = threading.Thread(
+                target=self._evict, args=(evict_interval,)
+            )
+            self._evictor.daemon = True
+            self._evictor.start()
+
+    def _evict(self, interval):
+        while not self._stopped.wait(interval):
+            try:
+                self.evict_idle()
+            except Exception as e:
+                self.logger.warning(
+                    "Cannot evict idle environments: {}".format(e)
+                )
+
+    def acquire(self, key, factory, test_id):
+        """
+        Hands out an environment: an idle one, or a new one if there is none
+        :param key: environment key, see environment_key
+        :param factory: callable starting a new environment, given its id
+        :param test_id: id of the test the environment is for
+        :return: (environment, True if it came from the pool)
+        """
+        self.evict_idle()
+        with self.lock:
+            self.factories[key] = factory
+            idle = self.idle[key]
+            environment = idle.pop()[0] if idle else None
+        hit = environment is not None
+        if hit:
+            try:
+                environment.rename(test_id)
+            except Exception as e:
+                self.logger.warning(
+                    "Cannot hand out idle environment: {}".format(e)
+                )
+                environment.teardown()
+                hit = False
+        with self.lock:
+            self.counters[key]['hits' if hit else 'misses'] += 1
+        if not hit:
+            environment = factory(test_id)
+            with self.lock:
+                self.counters[key]['created'] += 1
+        with self.lock:
+            self.in_use[test_id] = (key, environment)
+        self.fill(key)
+        return environment, hit
+
+    def fill(self, key, wait=False):
+        """
+        Starts environments in the background until `size` of them are idle
+        or starting
+        :param key: environment key
+        :param wait: wait for the environments being started to be ready
+        """
+        threads = []
+        with self.lock:
+            self.warming[key] = [t for t in self.warming[key] if t.is_alive()]
+            factory = self.factories[key]
+            missing = self.size - len(self.idle[key]) - self.starting[key]
+            for _ in range(max(missing, 0)):
+                self.starting[key] += 1
+                threads.append(threading.Thread(
+                    target=self._warm,
+                    # Unique across the processes and hosts sharing a daemon
+                    args=(key, factory, 'warm-{}-{}-{}-{}'.format(
+                        key[:8], self.hostname, os.getpid(),
+                        uuid.uuid4().hex[:8]
+                    )),
+                ))
+            self.warming[key].extend(threads)
+            warming = list(self.warming[key])
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        if wait:
+            for thread in warming:
+                thread.join()
+
+    def prewarm(self, key, factory):
+        """
+        Fills the pool of a key before any test asks for it
+        """
+        with self.lock:
+            self.factories[key] = factory
+        self.fill(key, wait=True)
+
+    def _warm(self, key, factory, warm_id):
+        try:
+            environment = factory(warm_id)
+        except Exception as e:
+            self.logger.warning(
+                "Cannot warm environment {}: {}".format(warm_id, e)
+            )
+            with self.lock:
+                self.starting[key] -= 1
+                self.counters[key]['failed'] += 1
+            return
+        with self.lock:
+            self.starting[key] -= 1
+            self.counters[key]['created'] += 1
+            self.idle[key].append((environment, time.time()))
+
+    def release(self, test_id):
+        """
+        Gives the environment of a test back to the pool, according to the
+        reset policy
+        :param test_id: id of the test the environment was handed out to
+        """
+        with self.lock:
+            key, environment = self.in_use.pop(test_id)
+        keep = self.reset_policy != 'destroy'
+        if self.reset_policy == 'reset':
+            try:
+                environment.reset()
+            except Exception as e:
+                self.logger.warning(
+                    "Cannot reset environment of {}: {}".format(test_id, e)
+                )
+                keep = False
+        with self.lock:
+            keep = keep and len(self.idle[key]) < self.size
+            if keep:
+                self.idle[key].append((environment, time.time()))
+                self.counters[key]['recycled'] += 1
+            else:
+                self.counters[key]['destroyed'] += 1
+        if not keep:
+            environment.teardown()
+            self.fill(key)
+
+    def evict_idle(self):
+        """
+        Destroys the environments idle for longer than max_idle
+        """
+        now = time.time()
+        evicted = []
+        with self.lock:
+            for key, idle in self.idle.items():
+                fresh = [(e, t) for e, t in idle if now - t <= self.max_idle]
+                evicted.extend(e for e, t in idle if now - t > self.max_idle)
+                self.counters[key]['evicted'] += len(idle) - len(fresh)
+                self.idle[key] = fresh
+        for environment in evicted:
+            environment.teardown()
+        return len(evicted)
+
+    def close(self):
+        """
+        Destroys the idle environments, once those being started are ready
+        """
+        self._stopped.set()
+        if self._evictor is not None:
+            self._evictor.join()
+        with self.lock:
+            warming = [t for threads in self.warming.values() for t in threads]
+        for thread in warming:
+            thread.join()
+        with self.lock:
+            idle = [e for envs in self.idle.values() for e, _ in envs]
+            self.idle.clear()
+        for environment in idle:
+            environment.teardown()
+
+    def metrics(self):
+        """
+        :return: dict of key: hits, misses, hit rate, and the numbers of
+            idle, starting, in use, created, recycled, destroyed, evicted
+            and failed environments
+        """
+        with self.lock:
+            in_use = collections.Counter(k for k, _ in self.in_use.values())
+            metrics = {}
+            for key in set(self.counters) | set(self.idle):
+                counters = self.counters[key]
+                lookups = counters['hits'] + counters['misses']
+                metrics[key] = dict(
+                    (name, counters[name]) for name in (
+                        'hits', 'misses', 'created', 'recycled', 'destroyed',
+                        'evicted', 'failed'
+                    )
+                )
+                metrics[key].update({
+                    'hit_rate': float(counters['hits']) / lookups
+                    if lookups else None,
+                    'idle': len(self.idle[key]),
+                    'starting': self.starting[key],
+                    'in_use': in_use[key],
+                })
+            return metrics
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def environment_pool(config):
+    """
+    :param config: application config
+    :return: the process-wide EnvironmentPool, or None if WARM_POOL_SIZE is 0
+    """
+    if not config.get('WARM_POOL_SIZE'):
+        return None
+    with _pools_lock:
+        key = (
+            config['WARM_POOL_SIZE'],
+            config.get('WARM_POOL_MAX_IDLE', 1800),
+            config.get('WARM_POOL_RESET', 'destroy'),
+            config.get('WARM_POOL_EVICT_INTERVAL', 60),
+        )
+        if key not in _pools:
+            _pools[key] = EnvironmentPool(*key)
+        return _pools[key]
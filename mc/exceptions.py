@@ -30,4 +30,16 @@ class UnknownRepoError(Exception):
 class UnknownServiceError(Exception):
     """
     Raised when a service is not known to mc
-    """
\ No newline at end of file
+    """
+
+
+class NoDockerHostError(Exception):
+    """
+    Raised when no docker host of the build farm is available
+    """
+
+
+class DependencyError(Exception):
+    """
+    Raised when a dependency of a test environment cannot be started
+    """
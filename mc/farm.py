@@ -0,0 +1,209 @@
+"""
+Build farm of several docker daemons
+"""
+import logging
+import threading
+import time
+import requests
+from requests.packages.urllib3.exceptions import ProtocolError
+from mc.builders import docker_clients
+from mc.exceptions import NoDockerHostError
+from mc.scheduler import BuildScheduler
+
+# Errors meaning that the daemon, rather than the build, went away; a daemon
+# dying while streaming the output of a build or push breaks its chunked
+# response
+HOST_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+    ProtocolError,
+)
+
+
+class DockerHostPool(object):
+    """
+    Pool of docker daemons that builds are placed on. Each build goes to the
+    daemon that last built its repository, whose layer cache is warm, unless
+    that daemon is unhealthy or full; it then goes to the least loaded
+    healthy daemon. Daemons are health checked with `info`, which also sizes
+    their slots, at most every `check_interval` seconds, and right away once
+    a build on them failed with a connection error.
+    """
+
+    def __init__(self, urls, slots=None, cpus_per_build=1,
+                 memory_per_build=1024 ** 3, check_interval=30,
+                 client_factory=None):
+        """
+        :param urls: urls of the docker daemons
+        :param slots: maximum number of concurrent builds per daemon; None
+            for as many as the resources of the daemon allow
+        :param cpus_per_build: CPUs reserved for each build
+        :param memory_per_build: memory reserved for each build, in bytes
+        :param check_interval: seconds a health check is trusted for
+        :param client_factory: callable returning a docker.Client for a url
+        """
+        self.urls = list(urls)
+        self.slots = slots
+        self.cpus_per_build = cpus_per_build
+        self.memory_per_build = memory_per_build
+        self.check_interval = check_interval
+        self.client_factory = client_factory or docker_clients.get
+        self.load = dict((url, 0) for url in self.urls)
+        self.info = dict((url, None) for url in self.urls)
+        self.checked = dict((url, None) for url in self.urls)
+        self.sticky = {}
+        self.logger = logging.getLogger(__name__)
+        self._cond = threading.Condition()
+
+    def check(self, url):
+        """
+        Health checks a daemon
+        :return: True if the daemon is healthy
+        """
+        try:
+            info = self.client_factory(url).info()
+        except Exception as e:
+            self.logger.warning("docker host {} is down: {}".format(url, e))
+            info = None
+        with self._cond:
+            self.info[url] = info
+            self.checked[url] = time.time()
+        return info is not None
+
+    def healthy(self):
+        """
+        :return: urls of the healthy daemons, checking those whose last check
+            is older than check_interval
+        """
+        now = time.time()
+        for url in self.urls:
+            checked = self.checked[url]
+            if checked is None or now - checked > self.check_interval:
+                self.check(url)
+        return [url for url in self.urls if self.info[url] is not None]
+
+    def capacity(self, url=None):
+        """
+        :param url: daemon; None for all the healthy daemons
+        :return: number of concurrent builds the daemon(s) can run
+        """
+        if url is None:
+            return sum(self.capacity(u) for u in self.healthy())
+        if self.checked[url] is None:
+            self.check(url)
+        if self.info[url] is None:
+            return 0
+        return BuildScheduler.capacity(
+            self.info[url], self.slots, self.cpus_per_build,
+            self.memory_per_build
+        )
+
+    def acquire(self, repository, exclude=()):
+        """
+        Places a build on a daemon and counts it in the daemon's load. Waits
+        for a slot if every healthy daemon is full.
+        :param repository: repository of the build
+        :param exclude: urls of daemons not to place the build on
+        :return: url of the daemon
+        :raises NoDockerHostError: if no daemon is healthy
+        """
+        while True:
+            healthy = [url for url in self.healthy() if url not in exclude]
+            if not healthy:
+                raise NoDockerHostError(
+                    "No docker host available for {}".format(repository)
+                )
+            with self._cond:
+                free = [
+                    url for url in healthy
+                    if self.load[url] < self.capacity(url)
+                ]
+                if not free:
+                    self._cond.wait(self.check_interval)
+                    continue
+                url = self.sticky.get(repository)
+                if url not in free:
+                    url = min(free, key=lambda u: (
+                        float(self.load[u]) / self.capacity(u),
+                        self.urls.index(u)
+                    ))
+                self.load[url] += 1
+                self.sticky[repository] = url
+            return url
+
+    def release(self, url, failed=False):
+        """
+        Removes a build from a daemon's load
+        :param url: url of the daemon
+        :param failed: the daemon went away during the build
+        """
+        with self._cond:
+            self.load[url] -= 1
+            if failed:
+                self.info[url] = None
+                self.checked[url] = time.time()
+            self._cond.notify_all()
+
+    def run(self, repository, fn):
+        """
+        Runs a build on a daemon, failing over to another daemon if the
+        daemon goes away during the build
+        :param repository: repository of the build
+        :param fn: callable running the build, given the url of the daemon
+        :return: return value of fn
+        :raises NoDockerHostError: if every daemon failed
+        """
+        failed = set()
+        while True:
+            url = self.acquire(repository, exclude=failed)
+            try:
+                result = fn(url)
+            except HOST_ERRORS as e:
+                self.logger.warning(
+                    "docker host {} went away while building {}: {}".format(
+                        url, repository, e
+                    )
+                )
+                self.release(url, failed=True)
+                failed.add(url)
+                continue
+            except Exception:
+                self.release(url)
+                raise
+            self.release(url)
+            return result
+
+    def utilisation(self):
+        """
+        :return: dict of url: (load, capacity) of the daemons
+        """
+        return dict(
+            (url, (self.load[url], self.capacity(url))) for url in self.urls
+        )
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def docker_host_pool(config):
+    """
+    :param config: application config
+    :return: the process-wide DockerHostPool of DOCKER_HOSTS, or None to build
+        on the local daemon
+    """
+    hosts = config.get('DOCKER_HOSTS')
+    if not hosts:
+        return None
+    with _pools_lock:
+        key = tuple(hosts)
+        if key not in _pools:
+            _pools[key] = DockerHostPool(
+                hosts,
+                slots=config.get('DOCKER_BUILD_SLOTS'),
+                cpus_per_build=config.get('DOCKER_BUILD_CPUS', 1),
+                memory_per_build=config.get('DOCKER_BUILD_MEMORY'),
+                check_interval=config.get('DOCKER_HOST_CHECK_INTERVAL', 30),
+            )
+        return _pools[key]
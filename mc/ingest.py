@@ -0,0 +1,237 @@
+"""
+Webhook ingestion outside of the request/response cycle
+"""
+import os
+import time
+import uuid
+from collections import OrderedDict
+from sqlalchemy import and_, bindparam, func
+from mc.models import db, Commit
+
+
+class WebhookSpool(object):
+    """
+    Directory-backed spool of raw webhook payloads.
+
+    Each payload is written to a temporary file, fsync'd and atomically renamed
+    into place, so a payload that was acknowledged to github survives a crash
+    of the web worker. Consumers claim payloads by renaming them, which allows
+    several ingestion workers to drain the same spool without double
+    processing.
+    """
+
+    suffix = '.json'
+    claimed_suffix = '.claimed'
+
+    def __init__(self, directory):
+        """
+        :param directory: spool directory; created if it does not exist
+        """
+        self.directory = directory
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+    def append(self, data):
+        """
+        Durably append a raw payload to the spool
+        :param data: raw request body
+        :return: the event id of the spooled payload
+        """
+        # Zero padded timestamps keep a lexicographic listing in arrival order
+        event = "{:020.6f}-{}-{}".format(
+            time.time(), os.getpid(), uuid.uuid4().hex[:8]
+        )
+        tmp = os.path.join(self.directory, '.{}'.format(event))
+        with open(tmp, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self._path(event, self.suffix))
+        self._sync_directory()
+        return event
+
+    def pending(self):
+        """
+        :return: sorted list of event ids that have not been claimed yet
+        """
+        return sorted(
+            fn[:-len(self.suffix)] for fn in os.listdir(self.directory)
+            if fn.endswith(self.suffix)
+        )
+
+    def __len__(self):
+        return len(self.pending())
+
+    def claim(self, limit=None):
+        """
+        Claim up to `limit` pending payloads, oldest first
+        :param limit: maximum number of payloads to claim; None for all
+        :return: list of (event id, raw payload) tuples
+        """
+        events = []
+        for event in self.pending():
+            if limit is not None and len(events) >= limit:
+                break
+            claimed = self._path(event, self.claimed_suffix)
+            try:
+                os.rename(self._path(event, self.suffix), claimed)
+            except OSError:  # Claimed by another consumer in the meantime
+                continue
+            os.utime(claimed, None)  # recover() measures from claim time
+            with open(claimed, 'rb') as f:
+                events.append((event, f.read()))
+        return events
+
+    def claim_window(self, limit, window, interval=0.1):
+        """
+        Claim payloads until `limit` are collected or `window` seconds have
+        passed since the first one was claimed, so that a burst of deliveries
+        is ingested together. Returns immediately if the spool is empty.
+        :param limit: maximum number of payloads to claim
+        :param window: collection window in seconds
+        :param interval: polling interval in seconds
+        :return: list of (event id, raw payload) tuples
+        """
+        events = self.claim(limit)
+        if not events:
+            return events
+        deadline = time.time() + window
+        while len(events) < limit and time.time() < deadline:
+            time.sleep(interval)
+            events.extend(self.claim(limit - len(events)))
+        return events
+
+    def ack(self, event):
+        """
+        Remove a claimed payload once it has been processed
+        """
+        os.remove(self._path(event, self.claimed_suffix))
+
+    def release(self, event):
+        """
+        Return a claimed payload to the spool so that it is retried
+        """
+        os.rename(
+            self._path(event, self.claimed_suffix),
+            self._path(event, self.suffix)
+        )
+
+    def recover(self, timeout):
+        """
+        Release claims older than `timeout` seconds; their consumer is assumed
+        to have died before acknowledging them
+        :return: list of released event ids
+        """
+        released = []
+        now = time.time()
+        for fn in os.listdir(self.directory):
+            if not fn.endswith(self.claimed_suffix):
+                continue
+            event = fn[:-len(self.claimed_suffix)]
+            try:
+                if now - os.path.getmtime(os.path.join(self.directory, fn)) \
+                        > timeout:
+                    self.release(event)
+                    released.append(event)
+            except OSError:  # Acked or released concurrently
+                continue
+        return released
+
+    def _path(self, event, suffix):
+        return os.path.join(self.directory, event + suffix)
+
+    def _sync_directory(self):
+        """
+        fsync the spool directory so that the rename itself is durable
+        """
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def merge_commit_rows(rows):
+    """
+    Collapse rows describing the same commit into one row per commit_hash.
+    The first row wins, except that a tag is taken from a later row if no
+    earlier row carried one. Missing columns are set to None so that the rows
+    can be used in a single executemany.
+    :param rows: iterable of dicts of models.Commit column values
+    :return: list of merged rows, in order of first appearance
+    """
+    columns = [c.name for c in Commit.__table__.columns if c.name != 'id']
+    merged = OrderedDict()
+    for row in rows:
+        seen = merged.get(row['commit_hash'])
+        if seen is None:
+            merged[row['commit_hash']] = dict(
+                (column, row.get(column)) for column in columns
+            )
+        elif not seen.get('tag') and row.get('tag'):
+            seen['tag'] = row['tag']
+    return merged.values()
+
+
+def upsert_commits(rows):
+    """
+    Insert commits with a single bulk statement. For commits that already
+    exist, only the tag is updated, and only if the stored commit has none.
+    Uses INSERT ... ON CONFLICT on postgres and INSERT OR IGNORE followed by a
+    bulk UPDATE on sqlite. The caller is responsible for committing the
+    session.
+    :param rows: iterable of dicts of models.Commit column values
+    :return: dict of commit_hash: models.Commit.id
+    """
+    rows = merge_commit_rows(rows)
+    if not rows:
+        return {}
+
+    table = Commit.__table__
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        db.session.execute(postgres_upsert_statement(rows))
+    elif dialect == 'sqlite':
+        db.session.execute(table.insert().prefix_with('OR IGNORE'), rows)
+        tagged = [
+            {'_hash': r['commit_hash'], '_tag': r['tag']}
+            for r in rows if r.get('tag')
+        ]
+        if tagged:
+            db.session.execute(
+                table.update().where(and_(
+                    table.c.commit_hash == bindparam('_hash'),
+                    table.c.tag.is_(None),
+                )).values(tag=bindparam('_tag')),
+                tagged
+            )
+    else:
+        for row in rows:
+            c = Commit.query.filter_by(commit_hash=row['commit_hash']).first()
+            if c is None:
+                db.session.add(Commit(**row))
+            elif not c.tag and row.get('tag'):
+                c.tag = row['tag']
+        db.session.flush()
+
+    hashes = [r['commit_hash'] for r in rows]
+    return dict(
+        db.session.query(Commit.commit_hash, Commit.id)
+        .filter(Commit.commit_hash.in_(hashes))
+    )
+
+
+def postgres_upsert_statement(rows):
+    """
+    :param rows: list of dicts of models.Commit column values
+    :return: a single INSERT ... ON CONFLICT (commit_hash) DO UPDATE statement
+    """
+    from sqlalchemy.dialects.postgresql import insert
+    stmt = insert(Commit.__table__).values(rows)
+    return stmt.on_conflict_do_update(
+        index_elements=['commit_hash'],
+        set_={'tag': func.coalesce(Commit.__table__.c.tag, stmt.excluded.tag)}
+    )
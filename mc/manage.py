@@ -14,8 +14,10 @@ from flask.ext.migrate import Migrate, MigrateCommand
 from flask import current_app
 from mc.models import db, Build, Commit
 from mc.app import create_app
-from mc.tasks import build_docker, register_task_revision, update_service, run_task
-from mc.builders import ECSBuilder
+from mc.tasks import build_docker, queue_build, register_task_revision, \
+    update_service, run_task, schedule_builds, image_regressions, \
+    REGRESSION_METRICS, make_test_environment
+from mc.builders import ECSBuilder, PULL_POLICIES
 from sqlalchemy import or_
 from sqlalchemy.orm.exc import NoResultFound
 
@@ -41,10 +43,15 @@ class BuildDockerImage(Command):
     option_list = (
         Option('--repo', '-r', dest='repo'),
         Option('--commit', '-c', dest='commit_hash'),
-        Option('--tag', '-t', dest='tag')
+        Option('--tag', '-t', dest='tag'),
+        Option('--refresh', dest='refresh', action='store_true',
+               help='build without the docker layer cache'),
+        Option('--force', dest='force', action='store_true',
+               help='build even if an identical image was already pushed'),
     )
 
-    def run(self, repo, commit_hash=None, tag=None, app=app):
+    def run(self, repo, commit_hash=None, tag=None, refresh=False,
+            force=False, app=app):
         with app.app_context():
 
             if tag:
@@ -104,6 +111,7 @@ class BuildDockerImage(Command):
                     tag=tag if tag else None
                 )
             db.session.add(c)
+            queue_build(c, refresh=refresh, force=force)
             db.session.commit()
             build_docker.delay(c.id)
             current_app.logger.info(
@@ -111,6 +119,76 @@ class BuildDockerImage(Command):
             )
 
 
+class ScheduleBuilds(Command):
+    """
+    Runs the queued builds concurrently on the docker daemon
+    """
+    option_list = (
+        Option('--slots', '-s', dest='slots', type=int,
+               help='maximum number of concurrent builds'),
+    )
+
+    def run(self, slots=None, app=app):
+        with app.app_context():
+            schedule_builds(slots=slots)
+
+
+class ImageRegressions(Command):
+    """
+    Lists the builds whose image size or build time jumped relative to the
+    median of the previous builds of their repository
+    """
+    option_list = (
+        Option('--repo', '-r', dest='repo'),
+        Option('--window', '-w', dest='window', type=int, default=10,
+               help='number of previous builds the median is taken over'),
+        Option('--threshold', '-t', dest='threshold', type=float,
+               default=1.5, help='ratio to the median to flag a build at'),
+        Option('--metric', '-m', dest='metrics', action='append',
+               choices=REGRESSION_METRICS.keys(),
+               help='metric to look at; all if not given'),
+    )
+
+    def run(self, repo=None, window=10, threshold=1.5, metrics=None,
+            app=app):
+        with app.app_context():
+            regressions = image_regressions(
+                repository=repo, window=window, threshold=threshold,
+                metrics=metrics,
+            )
+            for r in regressions:
+                print(
+                    "{repository}@{commit} (build {build}): {metric} {value} "
+                    "is {ratio:.2f}x the median {median}".format(**r)
+                )
+        return regressions
+
+
+class MakeTestEnvironment(Command):
+    """
+    Starts and provisions the dependency containers of a test environment
+    """
+    option_list = (
+        Option('--id', '-i', dest='test_id', required=True),
+        Option('--service', '-s', dest='services', action='append',
+               help='service to provision the dependencies for'),
+        Option('--pull-policy', dest='pull_policy', choices=PULL_POLICIES,
+               help='when to pull the images of the dependencies'),
+        Option('--refresh', dest='refresh', action='store_true',
+               help='list the images available locally again'),
+    )
+
+    def run(self, test_id, services=None, pull_policy=None, refresh=False,
+            app=app):
+        config = {'refresh': refresh}
+        if services:
+            config['services'] = services
+        if pull_policy:
+            config['pull_policy'] = pull_policy
+        with app.app_context():
+            return make_test_environment(test_id, config)
+
+
 class MakeDockerrunTemplate(Command):
     """
     Prints a `Dockerrun.aws.json` to stdout
@@ -224,6 +302,9 @@ manager.add_command('register_task_def', RegisterTaskRevision)
 manager.add_command('db', MigrateCommand)
 manager.add_command('createdb', CreateDatabase())
 manager.add_command('dockerbuild', BuildDockerImage)
+manager.add_command('schedulebuilds', ScheduleBuilds)
+manager.add_command('regressions', ImageRegressions)
+manager.add_command('testenv', MakeTestEnvironment)
 manager.add_command('print_task_def', MakeDockerrunTemplate)
 
 
@@ -0,0 +1,144 @@
+"""
+Local git mirrors of the watched repositories
+"""
+import fcntl
+import os
+import subprocess
+import tarfile
+from contextlib import contextmanager
+from mc.exceptions import BuildError
+from mc.utils import StageTimer
+
+
+class GitMirror(object):
+    """
+    Bare mirror of a git repository on the build host. The mirror is cloned
+    once and then fetched incrementally, and only when it does not know the
+    commit to build yet; the tree of that commit is exported from the mirror
+    into the docker build context.
+    """
+
+    def __init__(self, repo, directory, url):
+        """
+        :param repo: name of the repository
+        :param directory: directory holding the mirrors; created if needed
+        :param url: url or path to clone the repository from
+        """
+        self.repo = repo
+        self.url = url
+        self.path = os.path.join(directory, '{}.git'.format(repo))
+        self.timer = StageTimer()
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+    def git(self, *args):
+        """
+        Runs a git command against the mirror
+        :return: output of the command
+        """
+        return subprocess.check_output(
+            ['git', '--git-dir', self.path] + list(args)
+        )
+
+    @contextmanager
+    def lock(self):
+        """
+        Serializes clone and fetch of the mirror between processes
+        """
+        with open('{}.lock'.format(self.path), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def sync(self):
+        """
+        Clones the mirror if it does not exist yet, otherwise fetches the
+        refs that changed upstream
+        """
+        with self.lock():
+            if not os.path.isdir(self.path):
+                with self.timer('clone'):
+                    subprocess.check_call([
+                        'git', 'clone', '--quiet', '--mirror', self.url,
+                        self.path
+                    ])
+            else:
+                with self.timer('fetch'):
+                    self.git('fetch', '--quiet', '--prune', 'origin')
+
+    def has_commit(self, commit_hash):
+        """
+        :return: True if the mirror contains the commit
+        """
+        if not os.path.isdir(self.path):
+            return False
+        try:
+            self.git('cat-file', '-e', '{}^{{commit}}'.format(commit_hash))
+        except subprocess.CalledProcessError:
+            return False
+        return True
+
+    def ensure(self, commit_hash):
+        """
+        Makes sure that the mirror contains the commit, syncing it if not.
+        Works offline if the commit was already fetched.
+        """
+        if self.has_commit(commit_hash):
+            return
+        self.sync()
+        if not self.has_commit(commit_hash):
+            raise BuildError("{}@{} not found in {}".format(
+                self.repo, commit_hash, self.url
+            ))
+
+    def read(self, commit_hash, path):
+        """
+        Reads a file of a commit
+        :param commit_hash: commit to read from
+        :param path: path of the file within the repository
+        :return: content of the file, or None if the commit has no such file
+        """
+        self.ensure(commit_hash)
+        try:
+            return self.git('show', '{}:{}'.format(commit_hash, path))
+        except subprocess.CalledProcessError:
+            return None
+
+    def members(self, commit_hash, prefix='src/'):
+        """
+        Streams the tree of a commit out of the mirror, one member at a time.
+        The tree is read as the consumer takes it, e.g. as the docker daemon
+        receives the context, so the 'export' stage times the whole stream.
+        :param commit_hash: commit to export
+        :param prefix: path of the tree within the archive
+        :return: generator of (tarfile.TarInfo, file object or None); each
+            file object has to be read before the next member is taken
+        """
+        self.ensure(commit_hash)
+        with self.timer('export'):
+            p = subprocess.Popen(
+                ['git', '--git-dir', self.path, 'archive', '--format=tar',
+                 '--prefix={}'.format(prefix), commit_hash],
+                stdout=subprocess.PIPE,
+            )
+            try:
+                with tarfile.open(fileobj=p.stdout, mode='r|') as archive:
+                    for member in archive:
+                        yield (
+                            member,
+                            archive.extractfile(member)
+                            if member.isreg() else None
+                        )
+                if p.wait() != 0:
+                    raise BuildError("Failed to export {}@{}".format(
+                        self.repo, commit_hash
+                    ))
+            finally:
+                if p.poll() is None:  # The consumer stopped early
+                    p.kill()
+                    p.wait()
@@ -2,7 +2,8 @@
 Database models
 """
 
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Boolean
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Boolean, \
+    Float, BigInteger
 from flask.ext.sqlalchemy import SQLAlchemy
 
 db = SQLAlchemy()
@@ -34,3 +35,42 @@ class Build(db.Model):
     timestamp = Column(DateTime)
     built = Column(Boolean)
     pushed = Column(Boolean)
+    # queued, skipped, running, finished
+    status = Column(String)
+    # full name of the image that was pushed, e.g. adsabs/adsws:v1.0.0
+    image = Column(String)
+    # see DOCKER_CACHE_POLICIES; no_cache is set if the layer cache was not used
+    cache_policy = Column(String)
+    no_cache = Column(Boolean)
+    # seconds
+    duration = Column(Float)
+    # sha256 of the commit hash and the rendered docker context; a build is
+    # skipped if a build with the same fingerprint pushed the same image,
+    # unless force is set
+    fingerprint = Column(String, index=True)
+    force = Column(Boolean)
+
+
+class ImageStats(db.Model):
+    """
+    Metadata of the image pushed by a build, to follow the size and build
+    time of the images of each repository over time
+    """
+    id = Column(Integer, primary_key=True)
+    build_id = Column(Integer, ForeignKey('build.id'), unique=True)
+    build = db.relationship(
+        'Build',
+        backref=db.backref('stats', uselist=False)
+    )
+    # registry digest of the pushed image, e.g. sha256:0a1b...
+    digest = Column(String)
+    # bytes, uncompressed as reported by the daemon and compressed as stored
+    # in the registry
+    size = Column(BigInteger)
+    compressed_size = Column(BigInteger)
+    layers = Column(Integer)
+    # seconds
+    render_duration = Column(Float)
+    context_duration = Column(Float)
+    build_duration = Column(Float)
+    push_duration = Column(Float)
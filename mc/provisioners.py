@@ -1,21 +1,42 @@
 """
 Provisioners live here
 """
+import gzip
+import hashlib
+import logging
+import re
 import subprocess
+import time
 from collections import OrderedDict
 import os
+import psycopg2
 from flask import current_app
 
-from mc.app import create_jinja2, create_app
+from mc.app import create_jinja2, create_app, template_index
 from mc.utils import ChangeDir
 from mc.exceptions import UnknownServiceError
 
 
+def dependencies_config(dependencies=None):
+    """
+    :param dependencies: DEPENDENCIES config, e.g. of a test environment
+    :return: the dependencies, or the app's DEPENDENCIES config if None
+    """
+    if dependencies is not None:
+        return dependencies
+    try:
+        config = current_app.config
+    except RuntimeError:  # Outside of application context
+        config = create_app().config
+    return config['DEPENDENCIES']
+
+
 class ScriptProvisioner(object):
     """
     Calls a script via subprocess.Popen
     """
     template_dir = os.path.join(os.path.dirname(__file__), 'templates')
+    name = None
 
     def __init__(self, scripts, shell=False):
         self.scripts = scripts
@@ -43,21 +64,32 @@ class ScriptProvisioner(object):
                 p.wait()
                 self.processes["{}".format(script)] = p
 
+    @classmethod
+    def known_services(cls):
+        """
+        Services the provisioner has templates for, from the template index
+        :return: list of services
+        """
+        if cls.name is None:
+            return []
+        return sorted(getattr(template_index(cls.template_dir), cls.name))
+
 
 class PostgresProvisioner(ScriptProvisioner):
     """
     Provisioner for a postgres database.
     """
 
-    # TODO: This should be based on what templates are discoverable, not
-    # hard coded!
-    _KNOWN_SERVICES = ['adsws', 'metrics', 'biblib', 'graphics', 'recommender']
+    name = 'postgres'
 
-    def __init__(self, services):
+    def __init__(self, services, dependencies=None):
         """
         :param services: iterable of services to provision. Provisioning
             happens in the same order as they are defined
+        :param dependencies: DEPENDENCIES config to connect with; the app's
+            if None
         """
+        self._KNOWN_SERVICES = self.known_services()
         self.processes = OrderedDict()
         self.shell = True
         services = [services] if isinstance(services, basestring) else services
@@ -74,21 +106,18 @@ class PostgresProvisioner(ScriptProvisioner):
             self.services[s] = template.render(
                 database=s,
                 user=s,
-                psql_args=PostgresProvisioner.get_cli_params()
+                psql_args=PostgresProvisioner.get_cli_params(dependencies)
             )
         self.scripts = self.services.values()
 
     @staticmethod
-    def get_cli_params():
+    def get_cli_params(dependencies=None):
         """
         finds the command line parameters necessary to pass to `psql`
+        :param dependencies: DEPENDENCIES config; the app's if None
         :returns string containing psql-specifically formatted params
         """
-        try:
-            config = current_app.config
-        except RuntimeError:  # Outside of application context
-            config = create_app().config
-        config = config['DEPENDENCIES']['POSTGRES']
+        config = dependencies_config(dependencies)['POSTGRES']
 
         cli = "--username {username} --port {port} --host {host}".format(
             username=config.get('USERNAME', 'postgres'),
@@ -98,6 +127,428 @@ class PostgresProvisioner(ScriptProvisioner):
 
         return cli
 
+    @staticmethod
+    def connect(dbname='postgres', dependencies=None):
+        """
+        Connects to the postgres instance as its superuser
+        :param dbname: database to connect to
+        :param dependencies: DEPENDENCIES config; the app's if None
+        :return: psycopg2 connection
+        """
+        config = dependencies_config(dependencies)['POSTGRES']
+        return psycopg2.connect(
+            host=config.get('HOST', 'localhost'),
+            port=config.get('PORT', 5432),
+            user=config.get('USERNAME', 'postgres'),
+            password=config.get('PASSWORD'),
+            dbname=dbname,
+        )
+
+
+class CopyStream(object):
+    """
+    File-like object handing the data of a COPY to psycopg2's copy_expert,
+    counting the bytes read. Given the lines of a dump, it reads them up to
+    the end-of-data marker of the COPY blocks of the dump.
+    """
+
+    def __init__(self, fileobj=None, lines=None):
+        """
+        :param fileobj: file object to read the data from
+        :param lines: iterator over the lines of a dump, positioned after
+            its COPY statement; used instead of fileobj
+        """
+        self.fileobj = fileobj
+        self.lines = lines
+        self.size = 0
+        self._ended = False
+
+    def read(self, size=-1):
+        """
+        :param size: bytes to read at least, unless the data ends; all if
+            negative
+        :return: string of the data, empty once it ended
+        """
+        if self.lines is None:
+            data = self.fileobj.read(size)
+        else:
+            chunks, length = [], 0
+            while not self._ended and (size < 0 or length < size):
+                line = next(self.lines, None)
+                if line is None or line.rstrip('\r\n') == '\\.':
+                    self._ended = True
+                    break
+                chunks.append(line)
+                length += len(line)
+            data = ''.join(chunks)
+        self.size += len(data)
+        return data
+
+
+class PostgresLoader(object):
+    """
+    Provisioner for postgres databases that loads them in process rather
+    than through `psql`: each database is loaded over one connection, its
+    schema (with the COPY blocks of the dump) in a single transaction with
+    its data, and each `<table>.data.sql` file is streamed to COPY, gzipped
+    ones (`.data.sql.gz`) decompressed on the fly. The rows, bytes and
+    duration of each COPY are kept in `stats`.
+    """
+
+    COPY_STATEMENT = re.compile(
+        r'^COPY\s+(?P<table>\S+)(\s+\(.*\))?\s+FROM\s+stdin;\s*$', re.I
+    )
+    # Statements psql carries on after, and that do not change the schema
+    TOLERATED = re.compile(
+        r'^(GRANT|REVOKE|SET|COMMENT\s+ON\s+EXTENSION|'
+        r'ALTER\s.*\sOWNER\s+TO)\s',
+        re.I | re.S
+    )
+    DOLLAR_QUOTE = re.compile(r'\$[A-Za-z_][A-Za-z_0-9]*\$|\$\$')
+    DATA_SUFFIXES = ('.data.sql', '.data.sql.gz')
+    chunk_size = 64 * 1024
+
+    def __init__(self, services, dependencies=None, template_dir=None):
+        """
+        :param services: iterable of services to provision. Provisioning
+            happens in the same order as they are defined
+        :param dependencies: DEPENDENCIES config to connect with; the app's
+            if None
+        :param template_dir: template directory; the provisioners' if None
+        """
+        services = [services] if isinstance(services, basestring) else services
+        self.template_dir = template_dir or ScriptProvisioner.template_dir
+        self.index = template_index(self.template_dir)
+        unknown = set(services).difference(self.index.postgres)
+        if unknown:
+            raise UnknownServiceError("{}".format(unknown))
+        self.services = list(services)
+        self.dependencies = dependencies
+        self.stats = OrderedDict()
+        try:
+            self.logger = current_app.logger
+        except RuntimeError:  # Outside of application context
+            self.logger = logging.getLogger(__name__)
+
+    def __call__(self):
+        """
+        Loads the databases of the services
+        :return: stats, service -> table -> dict of rows, bytes and duration
+        """
+        for s in self.services:
+            self.load(s)
+        return self.stats
+
+    def create(self, service):
+        """
+        Creates the database and the user of a service, owner of the
+        database, unless they exist
+        :param service: service of the database
+        """
+        conn = PostgresProvisioner.connect(dependencies=self.dependencies)
+        conn.autocommit = True
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                'SELECT 1 FROM pg_database WHERE datname = %s', (service,)
+            )
+            if cursor.fetchone() is None:
+                cursor.execute('CREATE DATABASE "{}"'.format(service))
+            cursor.execute(
+                'SELECT 1 FROM pg_roles WHERE rolname = %s', (service,)
+            )
+            if cursor.fetchone() is None:
+                cursor.execute('CREATE USER "{}"'.format(service))
+            cursor.execute('ALTER DATABASE "{}" OWNER TO "{}"'.format(
+                service, service
+            ))
+        finally:
+            conn.close()
+
+    def files(self, service):
+        """
+        :param service: service of the database
+        :return: path of the schema, and list of (table, path) of the data
+            files of the service
+        """
+        schema = os.path.join(
+            self.template_dir, 'postgres', service,
+            '{}.schema.sql'.format(service)
+        )
+        data = [
+            (os.path.basename(path).split('.')[0],
+             os.path.join(self.template_dir, path))
+            for path in self.index.postgres[service]
+            if path.endswith(self.DATA_SUFFIXES)
+        ]
+        return schema, data
+
+    def load(self, service):
+        """
+        Creates and loads the database of a service, rolling it all back if
+        any statement or COPY fails
+        :param service: service of the database
+        """
+        self.create(service)
+        stats = self.stats[service] = OrderedDict()
+        schema, data = self.files(service)
+        start = time.time()
+        conn = PostgresProvisioner.connect(
+            dbname=service, dependencies=self.dependencies
+        )
+        try:
+            with conn:  # One transaction, committed if nothing failed
+                cursor = conn.cursor()
+                with open(schema) as f:
+                    self.apply(cursor, f, stats)
+                for table, path in data:
+                    opener = gzip.open if path.endswith('.gz') else open
+                    with opener(path, 'rb') as f:
+                        self.copy(
+                            cursor, 'COPY "{}" FROM STDIN'.format(table),
+                            table, CopyStream(fileobj=f), stats
+                        )
+        finally:
+            conn.close()
+        self.logger.info("Loaded {} in {:.2f}s: {} rows".format(
+            service, time.time() - start,
+            sum(table['rows'] for table in stats.values())
+        ))
+
+    def statements(self, schema):
+        """
+        Splits a schema dump into its statements, which end with a semicolon
+        at the end of a line outside of dollar quotes, and its COPY blocks
+        :param schema: file object of the dump
+        :return: generator of (statement, table, CopyStream); table and
+            stream are None but for COPY blocks, whose data has to be read
+            before the next statement is
+        """
+        lines = iter(schema)
+        statement, quote = [], None
+        for line in lines:
+            if quote is None and not statement:
+                match = self.COPY_STATEMENT.match(line)
+                if match is not None:
+                    yield (line.strip().rstrip(';'),
+                           match.group('table').strip('"'),
+                           CopyStream(lines=lines))
+                    continue
+                if not line.strip() or line.startswith('--'):
+                    continue
+            statement.append(line)
+            for tag in self.DOLLAR_QUOTE.findall(line):
+                if quote is None:
+                    quote = tag
+                elif tag == quote:
+                    quote = None
+            if quote is None and line.rstrip().endswith(';'):
+                yield ''.join(statement), None, None
+                statement = []
+        if ''.join(statement).strip():
+            yield ''.join(statement), None, None
+
+    def apply(self, cursor, schema, stats):
+        """
+        Runs a schema dump, sending the statements between its COPY blocks
+        at once, and streaming the blocks to COPY. Like psql, a failed
+        privilege, ownership or SET statement, e.g. a GRANT to a role that
+        does not exist, is skipped rather than failing the load; it is run
+        under a savepoint so that the transaction carries on.
+        :param cursor: cursor of the connection to the database
+        :param schema: file object of the dump
+        :param stats: dict the stats of the COPY blocks are added to
+        """
+        batch = []
+
+        def flush():
+            if batch:
+                cursor.execute(''.join(batch))
+                del batch[:]
+
+        for statement, table, stream in self.statements(schema):
+            if stream is not None:
+                flush()
+                self.copy(cursor, statement, table, stream, stats)
+            elif self.TOLERATED.match(statement):
+                flush()
+                cursor.execute('SAVEPOINT provision')
+                try:
+                    cursor.execute(statement)
+                except psycopg2.Error as e:
+                    cursor.execute('ROLLBACK TO SAVEPOINT provision')
+                    self.logger.warning("Skipped {}: {}".format(
+                        statement.strip(), str(e).strip()
+                    ))
+                else:
+                    cursor.execute('RELEASE SAVEPOINT provision')
+            else:
+                batch.append(statement)
+        flush()
+
+    def copy(self, cursor, statement, table, stream, stats):
+        """
+        Streams data to COPY, and adds its rows, bytes and duration to the
+        stats of the table
+        :param cursor: cursor of the connection to the database
+        :param statement: COPY ... FROM STDIN statement
+        :param table: table the data is copied into
+        :param stream: CopyStream of the data
+        :param stats: dict of the stats of the tables of the database
+        """
+        start = time.time()
+        cursor.copy_expert(statement, stream, size=self.chunk_size)
+        duration = time.time() - start
+        table_stats = stats.setdefault(
+            table, {'rows': 0, 'bytes': 0, 'duration': 0.0}
+        )
+        table_stats['rows'] += max(cursor.rowcount, 0)
+        table_stats['bytes'] += stream.size
+        table_stats['duration'] += duration
+        self.logger.info(
+            "Copied {} rows, {} bytes into {} in {:.3f}s ({:.1f} MB/s)".format(
+                cursor.rowcount, stream.size, table, duration,
+                stream.size / 1024.0 ** 2 / max(duration, 1e-6)
+            )
+        )
+
+
+class PostgresSnapshot(object):
+    """
+    Snapshot of the databases of services provisioned by the
+    PostgresProvisioner, keyed by a hash of their provisioning templates and
+    of the postgres image, so that a change to a schema, to a fixture or to
+    the server makes a new snapshot. It is
+    kept either as a TEMPLATE database per service on the postgres server,
+    cloned with `CREATE DATABASE ... TEMPLATE`, or as an image committed
+    from the provisioned postgres container.
+    """
+
+    MODES = ('template', 'image')
+
+    def __init__(self, services, repository='adsabs/postgres-snapshot',
+                 template_dir=None, base=None):
+        """
+        :param services: iterable of services whose databases are kept
+        :param repository: repository of the images of image snapshots
+        :param template_dir: template directory; the provisioners' if None
+        :param base: id of the postgres image the snapshot is made on
+        """
+        services = [services] if isinstance(services, basestring) else services
+        self.services = list(services)
+        self.template_dir = template_dir or ScriptProvisioner.template_dir
+        self.base = base
+        self.key = self.fingerprint()
+        self.repository = repository
+        self.tag = '{}:{}'.format(repository, self.key)
+
+    def fingerprint(self):
+        """
+        :return: hash of the postgres image, of the base template and of
+            the schema and data files of the services
+        """
+        index = template_index(self.template_dir)
+        sha = hashlib.sha256()
+        if self.base:
+            sha.update(self.base + '\0')
+        paths = ['postgres/base.psql.template']
+        for s in sorted(set(self.services)):
+            paths.extend(index.postgres.get(s, []))
+        for path in paths:
+            sha.update(path + '\0')
+            with open(os.path.join(self.template_dir, path), 'rb') as f:
+                for chunk in iter(lambda: f.read(64 * 1024), ''):
+                    sha.update(chunk)
+        return sha.hexdigest()[:12]
+
+    def template_name(self, service):
+        """
+        :param service: service of the database
+        :return: name of the TEMPLATE database of the service
+        """
+        return '{}_snapshot_{}'.format(service, self.key)
+
+    def restore(self, dependencies=None):
+        """
+        Creates the database and user of each service from its TEMPLATE
+        database, replacing any database of the same name
+        :param dependencies: DEPENDENCIES config to connect with; the app's
+            if None
+        :return: False if the TEMPLATE databases do not all exist, in which
+            case nothing is restored
+        """
+        if not self.services:
+            return True
+        conn = PostgresProvisioner.connect(dependencies=dependencies)
+        conn.autocommit = True
+        try:
+            cursor = conn.cursor()
+            names = [self.template_name(s) for s in self.services]
+            cursor.execute(
+                'SELECT datname FROM pg_database WHERE datname IN %s',
+                (tuple(names),)
+            )
+            if set(row[0] for row in cursor.fetchall()) != set(names):
+                return False
+            for s in self.services:
+                cursor.execute('SELECT 1 FROM pg_roles WHERE rolname = %s', (s,))
+                if cursor.fetchone() is None:
+                    cursor.execute('CREATE USER "{}"'.format(s))
+                cursor.execute('DROP DATABASE IF EXISTS "{}"'.format(s))
+                cursor.execute(
+                    'CREATE DATABASE "{}" TEMPLATE "{}" OWNER "{}"'.format(
+                        s, self.template_name(s), s
+                    )
+                )
+            return True
+        finally:
+            conn.close()
+
+    def save(self, dependencies=None):
+        """
+        Copies the provisioned database of each service into its TEMPLATE
+        database. Nothing may be connected to the databases meanwhile.
+        :param dependencies: DEPENDENCIES config to connect with; the app's
+            if None
+        """
+        conn = PostgresProvisioner.connect(dependencies=dependencies)
+        conn.autocommit = True
+        try:
+            cursor = conn.cursor()
+            for s in self.services:
+                cursor.execute('DROP DATABASE IF EXISTS "{}"'.format(
+                    self.template_name(s)
+                ))
+                cursor.execute('CREATE DATABASE "{}" TEMPLATE "{}"'.format(
+                    self.template_name(s), s
+                ))
+        finally:
+            conn.close()
+
+    def commit(self, runner, dependencies=None):
+        """
+        Commits the container of a provisioned postgres into the image of
+        the snapshot. The data directory of the container (PGDATA) has to be
+        outside of the volumes of its image, which are not committed.
+        :param runner: DockerRunner of the postgres container
+        :param dependencies: DEPENDENCIES config to connect with; the app's
+            if None
+        :return: the image of the snapshot
+        """
+        conn = PostgresProvisioner.connect(dependencies=dependencies)
+        conn.autocommit = True
+        try:
+            # Flush the data to disk so that it starts without recovery
+            conn.cursor().execute('CHECKPOINT')
+        finally:
+            conn.close()
+        runner.client.commit(
+            runner.container['Id'], repository=self.repository, tag=self.key,
+            message='Snapshot of {}'.format(', '.join(self.services)),
+        )
+        runner.inventory.invalidate()
+        return self.tag
+
 
 class ConsulProvisioner(ScriptProvisioner):
     """
@@ -106,8 +557,12 @@ class ConsulProvisioner(ScriptProvisioner):
 
     name = 'consul'
 
-    def __init__(self, services):
-
+    def __init__(self, services, dependencies=None):
+        """
+        :param services: iterable of services to provision
+        :param dependencies: DEPENDENCIES config to connect with; the app's
+            if None
+        """
         self._KNOWN_SERVICES = self.known_services()
         self.processes = OrderedDict()
         self.shell = True
@@ -125,36 +580,20 @@ class ConsulProvisioner(ScriptProvisioner):
         for s in services:
             self.services[s] = template.render(
                 service=s,
-                port=ConsulProvisioner.get_cli_params(),
-                db_host=ConsulProvisioner.get_db_params()['HOST'],
-                db_port=ConsulProvisioner.get_db_params()['PORT']
+                port=ConsulProvisioner.get_cli_params(dependencies),
+                db_host=ConsulProvisioner.get_db_params(dependencies)['HOST'],
+                db_port=ConsulProvisioner.get_db_params(dependencies)['PORT']
             )
         self.scripts = self.services.values()
 
-    @classmethod
-    def known_services(cls):
-        """
-        Services consul knows about
-        :return: list of services
-        """
-        template_dir = '{base}/{provisioner}'.format(
-            base=cls.template_dir,
-            provisioner=cls.name
-        )
-        return [_dir for _dir in os.listdir(template_dir)
-                if os.path.isdir(os.path.join(template_dir, _dir))]
-
     @staticmethod
-    def get_cli_params():
+    def get_cli_params(dependencies=None):
         """
         finds the command line parameters necessary to pass to `psql`
+        :param dependencies: DEPENDENCIES config; the app's if None
         :returns string containing psql-specifically formatted params
         """
-        try:
-            config = current_app.config
-        except RuntimeError:  # Outside of application context
-            config = create_app().config
-        config = config['DEPENDENCIES']['CONSUL']
+        config = dependencies_config(dependencies)['CONSUL']
 
         cli = "{port}".format(
             port=config.get('PORT', 8500),
@@ -163,14 +602,10 @@ class ConsulProvisioner(ScriptProvisioner):
         return cli
 
     @staticmethod
-    def get_db_params():
+    def get_db_params(dependencies=None):
         """
         finds the parameters necessary to connect to the postgres instance.
+        :param dependencies: DEPENDENCIES config; the app's if None
         :return: string uri of the postgres instance
         """
-        try:
-            config = current_app.config
-        except RuntimeError:  # Outside of application context
-            config = create_app().config
-
-        return config['DEPENDENCIES']['POSTGRES']
+        return dependencies_config(dependencies)['POSTGRES']
@@ -0,0 +1,143 @@
+"""
+Scheduling of concurrent image builds on a docker daemon
+"""
+import heapq
+import itertools
+import logging
+import threading
+
+
+class BuildScheduler(object):
+    """
+    Runs queued builds concurrently on one docker daemon. The number of
+    concurrent builds, the slots, is derived from the CPUs and memory the
+    daemon reports and capped by `slots`. Builds of different repositories
+    run side by side; builds of the same repository run one after the other,
+    since they compete for the same layers and tags. Builds wait for a slot
+    in order of priority, then of submission.
+    """
+
+    def __init__(self, client, slots=None, cpus_per_build=1,
+                 memory_per_build=1024 ** 3, build_fn=None):
+        """
+        :param client: docker.Client of the daemon the builds run on; None to
+            rely on `slots` alone
+        :param slots: maximum number of concurrent builds; None for as many
+            as the resources of the daemon allow
+        :param cpus_per_build: CPUs reserved for each build
+        :param memory_per_build: memory reserved for each build, in bytes
+        :param build_fn: callable running a build, given its id
+        """
+        self.client = client
+        self.build_fn = build_fn
+        self.slots = self.capacity(
+            client.info() if client is not None else {}, slots,
+            cpus_per_build, memory_per_build
+        )
+        self.finished = []
+        self.logger = logging.getLogger(__name__)
+        self._queue = []
+        self._seq = itertools.count()
+        self._running = {}
+        self._threads = []
+        self._cond = threading.Condition()
+
+    @staticmethod
+    def capacity(info, slots=None, cpus_per_build=1, memory_per_build=None):
+        """
+        :param info: output of docker.Client.info()
+        :param slots: maximum number of slots; None for no maximum
+        :param cpus_per_build: CPUs reserved for each build
+        :param memory_per_build: memory reserved for each build, in bytes
+        :return: number of builds the daemon can run concurrently, at least 1
+        """
+        limits = [] if slots is None else [slots]
+        if info.get('NCPU') and cpus_per_build:
+            limits.append(info['NCPU'] // cpus_per_build)
+        if info.get('MemTotal') and memory_per_build:
+            limits.append(info['MemTotal'] // memory_per_build)
+        return max(min(limits), 1) if limits else 1
+
+    def submit(self, build_id, repository, priority=0):
+        """
+        Queues a build
+        :param build_id: id of the models.Build
+        :param repository: repository of the build's commit
+        :param priority: builds with a higher priority start first
+        """
+        with self._cond:
+            heapq.heappush(
+                self._queue,
+                (-priority, next(self._seq), build_id, repository)
+            )
+            self._cond.notify_all()
+
+    def utilisation(self):
+        """
+        :return: dict of the slots, the busy slots, the number of queued
+            builds and the repositories being built
+        """
+        with self._cond:
+            return {
+                'slots': self.slots,
+                'busy': len(self._running),
+                'queued': len(self._queue),
+                'running': sorted(self._running),
+            }
+
+    def run(self):
+        """
+        Runs the queued builds, including those submitted meanwhile, and
+        returns once the queue is drained
+        :return: list of (build id, exception or None) in order of completion
+        """
+        with self._cond:
+            while self._queue or self._running:
+                while len(self._running) < self.slots:
+                    item = self._next()
+                    if item is None:
+                        break
+                    self._start(*item)
+                self._cond.wait()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        return self.finished
+
+    def _next(self):
+        """
+        Pops the first queued build whose repository is not being built.
+        Must be called with the lock held.
+        :return: (build id, repository) or None
+        """
+        for item in sorted(self._queue):
+            if item[3] not in self._running:
+                self._queue.remove(item)
+                heapq.heapify(self._queue)
+                return item[2], item[3]
+        return None
+
+    def _start(self, build_id, repository):
+        self._running[repository] = build_id
+        thread = threading.Thread(
+            target=self._run, args=(build_id, repository),
+            name='build-{}'.format(build_id),
+        )
+        thread.daemon = True
+        self._threads.append(thread)
+        thread.start()
+
+    def _run(self, build_id, repository):
+        error = None
+        try:
+            self.build_fn(build_id)
+        except Exception as e:
+            error = e
+            self.logger.exception(
+                "build {} of {} failed".format(build_id, repository)
+            )
+        finally:
+            with self._cond:
+                del self._running[repository]
+                self.finished.append((build_id, error))
+                self._cond.notify_all()
@@ -2,14 +2,30 @@
 Tasks that should live outside of the request/response cycle
 """
 import datetime
+import functools
+import socket
+from collections import OrderedDict
 from flask import current_app
 import json
 
-from mc.app import create_celery
-from mc.models import db, Build, Commit
-from mc.builders import DockerImageBuilder, DockerRunner
-from mc.utils import get_boto_session
-from mc.provisioners import PostgresProvisioner
+from mc.app import create_celery, refresh_jinja2
+from mc.models import db, Build, Commit, ImageStats
+from mc.builders import DockerImageBuilder, DockerRunner, docker_clients, \
+    image_inventory
+from mc.utils import get_boto_session, StageTimer, median
+from mc.provisioners import PostgresProvisioner, ConsulProvisioner, \
+    PostgresLoader, PostgresSnapshot
+from mc.environments import TestEnvironment, environment_key, \
+    environment_pool, remove_environment
+from mc.ingest import WebhookSpool, upsert_commits
+from mc.mirrors import GitMirror
+from mc.buildlogs import BuildLog
+from mc.scheduler import BuildScheduler
+from mc.farm import docker_host_pool, HOST_ERRORS
+from mc.wheelhouse import Wheelhouse
+from mc.views import GithubListener
+from mc.exceptions import UnknownRepoError, NoDockerHostError, \
+    DependencyError
 
 celery = create_celery()
 
@@ -65,51 +81,442 @@ def run_task(cluster, desiredCount, taskDefinition):
         taskDefinition=taskDefinition
     )
 
+
+def psql_dependencies(endpoints):
+    """
+    :param endpoints: dict of dependency name: (host, port)
+    :return: DEPENDENCIES config pointing to the postgres dependency of a
+        test environment
+    """
+    host, port = endpoints['postgres']
+    dependencies = dict(current_app.config['DEPENDENCIES'])
+    dependencies['POSTGRES'] = dict(
+        dependencies['POSTGRES'], HOST=host, PORT=port
+    )
+    return dependencies
+
+
+def provision_psql(endpoints, services):
+    """
+    Provisions the databases of the services in the postgres dependency of a
+    test environment, in process or with the psql scripts per
+    POSTGRES_PROVISIONER. With POSTGRES_SNAPSHOT set to 'template', they are
+    cloned from the TEMPLATE databases of their snapshot if the server has
+    them, and are kept as such otherwise.
+    :param endpoints: dict of dependency name: (host, port)
+    :param services: services of the environment
+    """
+    dependencies = psql_dependencies(endpoints)
+    known = PostgresProvisioner.known_services()
+    services = [s for s in services if s in known]
+    snapshot = None
+    if current_app.config.get('POSTGRES_SNAPSHOT') == 'template':
+        snapshot = PostgresSnapshot(services)
+        if snapshot.restore(dependencies):
+            current_app.logger.info(
+                "Restored {} from snapshot {}".format(
+                    ', '.join(services), snapshot.key
+                )
+            )
+            return
+    if current_app.config.get('POSTGRES_PROVISIONER', 'native') == 'script':
+        PostgresProvisioner(services, dependencies=dependencies)()
+    else:
+        PostgresLoader(services, dependencies=dependencies)()
+    if snapshot is not None:
+        snapshot.save(dependencies)
+
+
+def snapshot_psql(endpoints, runner, snapshot):
+    """
+    Commits the provisioned postgres dependency of a test environment into
+    the image of its snapshot, for the next environments to start from
+    :param endpoints: dict of dependency name: (host, port)
+    :param runner: DockerRunner of the postgres dependency
+    :param snapshot: PostgresSnapshot of the services of the environment
+    """
+    image = snapshot.commit(runner, psql_dependencies(endpoints))
+    current_app.logger.info("Committed snapshot {}".format(image))
+
+
+def postgres_dependency(services):
+    """
+    :param services: services of the environment
+    :return: the postgres dependency of a test environment. With
+        POSTGRES_SNAPSHOT set to 'image', it runs the image of the snapshot
+        of the services if the docker daemon has it, without provisioning;
+        otherwise it is provisioned, then committed into that image once the
+        daemon has the postgres image. 'template' requires a warm pool that
+        resets its environments, the only ones whose server is reused.
+    :raises ValueError: for an unknown or unusable POSTGRES_SNAPSHOT
+    """
+    dependency = {
+        "name": "postgres",
+        "image": "postgres",
+        "port": 5432,
+        "probe": "postgres",
+        "callback": functools.partial(provision_psql, services=services),
+        "reset": functools.partial(reset_psql, services=services),
+    }
+    mode = current_app.config.get('POSTGRES_SNAPSHOT')
+    if mode not in (None,) + PostgresSnapshot.MODES:
+        raise ValueError("Unknown POSTGRES_SNAPSHOT {}".format(mode))
+    if mode == 'template' and not (
+            current_app.config.get('WARM_POOL_SIZE') and
+            current_app.config.get('WARM_POOL_RESET') == 'reset'):
+        # Every other environment starts a new server, without the templates
+        raise ValueError(
+            "POSTGRES_SNAPSHOT 'template' needs a reused postgres server: "
+            "WARM_POOL_SIZE > 0 and WARM_POOL_RESET 'reset'"
+        )
+    if mode != 'image':
+        return dependency
+
+    inventory = image_inventory(
+        docker_clients.get(),
+        current_app.config.get('DOCKER_IMAGE_INVENTORY_TTL', 300)
+    )
+    base = inventory.get(dependency['image'])
+    if base is None:
+        # The snapshot is keyed by the postgres image, which is pulled first
+        return dependency
+    known = PostgresProvisioner.known_services()
+    snapshot = PostgresSnapshot(
+        [s for s in services if s in known],
+        repository=current_app.config.get(
+            'POSTGRES_SNAPSHOT_REPOSITORY', 'adsabs/postgres-snapshot'
+        ),
+        base=base,
+    )
+    if snapshot.tag in inventory:
+        dependency.update(image=snapshot.tag, pull_policy='never')
+        del dependency['callback']
+    else:
+        # The data directory of the image is a volume, which is not committed
+        dependency['runner'] = {'environment': {
+            'PGDATA': current_app.config.get(
+                'POSTGRES_SNAPSHOT_PGDATA', '/var/lib/postgresql/snapshot'
+            ),
+        }}
+        dependency['snapshot'] = functools.partial(
+            snapshot_psql, snapshot=snapshot
+        )
+    return dependency
+
+
+def provision_consul(endpoints, services):
+    """
+    Provisions the config of the services in the consul dependency of a test
+    environment, pointing them to its postgres dependency
+    :param endpoints: dict of dependency name: (host, port)
+    :param services: services of the environment
+    """
+    dependencies = dict(current_app.config['DEPENDENCIES'])
+    dependencies['CONSUL'] = dict(
+        dependencies['CONSUL'], PORT=endpoints['consul'][1]
+    )
+    if 'postgres' in endpoints:
+        host, port = endpoints['postgres']
+        dependencies['POSTGRES'] = dict(
+            dependencies['POSTGRES'], HOST=host, PORT=port
+        )
+    known = ConsulProvisioner.known_services()
+    ConsulProvisioner(
+        [s for s in services if s in known], dependencies=dependencies
+    )()
+
+
+def reset_psql(endpoints, services):
+    """
+    Drops the databases and users of the services in the postgres dependency
+    of a test environment, and provisions them again
+    :param endpoints: dict of dependency name: (host, port)
+    :param services: services of the environment
+    """
+    conn = PostgresProvisioner.connect(
+        dependencies=psql_dependencies(endpoints)
+    )
+    conn.autocommit = True
+    try:
+        cursor = conn.cursor()
+        for s in services:
+            if s not in PostgresProvisioner.known_services():
+                continue
+            cursor.execute('DROP DATABASE IF EXISTS "{}"'.format(s))
+            cursor.execute('DROP USER IF EXISTS "{}"'.format(s))
+    finally:
+        conn.close()
+    provision_psql(endpoints, services)
+
+
+def reset_redis(endpoints):
+    """
+    Empties the redis dependency of a test environment
+    :param endpoints: dict of dependency name: (host, port)
+    """
+    conn = socket.create_connection(endpoints['redis'], 5)
+    try:
+        conn.sendall('FLUSHALL\r\n')
+        reply = conn.recv(64)
+    finally:
+        conn.close()
+    if not reply.startswith('+OK'):
+        raise DependencyError("redis FLUSHALL failed: {}".format(reply))
+
+
 @celery.task()
 def make_test_environment(test_id, config=None):
     """
     Creates the test environment:
-      - Run dependency containers
-      - Provision dependency containers, if necessary
+      - Run dependency containers, concurrently
+      - Provision dependency containers once they are ready, if necessary
       - Run the microservices
       - Run the tests
-    :param config: Config detailing which versions and services to provision
+    :param config: Config detailing which versions and services to provision,
+        the pull policy of the dependencies, and whether to refresh the
+        inventory of the images available locally
     :type config: dict
-    :return: None
+    :return: summary of the environment: its ready time, and the endpoint,
+        container and stage durations of each dependency
     """
+    config = config or {}
+    services = config.get('services', ['adsws'])
+
+    if 'dependencies' not in config:
+        config['dependencies'] = [
+            {
+                "name": "redis",
+                "image": "redis",
+                "port": 6379,
+                "probe": "tcp",
+                "reset": reset_redis,
+            },
+            {
+                "name": "consul",
+                "image": "consul",
+                "port": 8500,
+                "probe": "consul",
+                # consul's config points the services to postgres
+                "requires": ["postgres"],
+                "callback": functools.partial(
+                    provision_consul, services=services
+                ),
+                "reset": functools.partial(
+                    provision_consul, services=services
+                ),
+            },
+            postgres_dependency(services),
+        ]
+    dependencies = config['dependencies']
+
+    if config.get('pull_policy'):
+        for d in dependencies:
+            d.setdefault('pull_policy', config['pull_policy'])
+
+    app = current_app._get_current_object()
+
+    def start(environment_id):
+        with app.app_context():
+            return TestEnvironment(
+                environment_id,
+                dependencies,
+                host=config.get(
+                    'host', app.config.get('DEPENDENCIES_HOST', 'localhost')
+                ),
+                timeout=app.config.get('DEPENDENCIES_READY_TIMEOUT', 120),
+                refresh=config.get('refresh', False),
+            ).start()
+
+    pool = environment_pool(current_app.config)
+    if pool is None:
+        return start(test_id).summary()
+
+    key = environment_key(dependencies, services)
+    environment, hit = pool.acquire(key, start, test_id)
+    current_app.logger.info(
+        "Test environment {} from the warm pool: {} [{}]".format(
+            test_id, 'hit' if hit else 'miss', ' '.join(
+                '{}={}'.format(k, v) for k, v in
+                sorted(pool.metrics()[key].items())
+            )
+        )
+    )
+    summary = environment.summary()
+    summary['pooled'] = hit
+    return summary
+
 
-    dependencies = config.setdefault('dependencies', [
-        {
-            "name": "redis",
-            "image": "redis",
-            "callback": None,
-        },
-        {
-            "name": "consul",
-            "image": "consul",
-            "callback": provision_consol,
-        },
-        {
-            "name": "postgres",
-            "image": "postgres",
-            "callback": provision_psql,
-        },
-    ])
-
-    for d in dependencies:
-        builder = DockerRunner(
-            image=d['image'],
-            name="{}-{}".format(d['name'], test_id),
+@celery.task()
+def release_test_environment(test_id):
+    """
+    Gives the test environment of a test back to the warm pool of the
+    process it was made by, which destroys, resets or reuses it according to
+    WARM_POOL_RESET. Environments made by another process, e.g. another
+    child of a prefork worker, or without a warm pool are destroyed.
+    :param test_id: id of the test
+    :return: True if the environment went back to the warm pool
+    """
+    pool = environment_pool(current_app.config)
+    if pool is not None and test_id in pool.in_use:
+        pool.release(test_id)
+        return True
+    removed = remove_environment(docker_clients.get(), test_id)
+    current_app.logger.info(
+        "Removed {} containers of test environment {}".format(
+            removed, test_id
         )
-        builder.start(callback=d['callback'])
+    )
+    return False
+
+
+@celery.task()
+def warm_pool_metrics():
+    """
+    :return: hits, misses and sizes of the warm pool of the worker, per
+        environment key
+    """
+    pool = environment_pool(current_app.config)
+    return pool.metrics() if pool is not None else {}
+
+
+def queue_build(commit, refresh=False, force=False):
+    """
+    Records a queued build for a commit, superseding the builds of other
+    commits of the same repository and tag that are still queued: only the
+    newest image would be deployed, so those are marked as skipped and
+    build_docker will not run them. A build of the commit that is still
+    queued, e.g. for a redelivered webhook, is reused. Call
+    build_docker.delay(commit.id) once the session is committed.
+
+    :param commit: commit to build
+    :type commit: mc.models.Commit
+    :param refresh: build without the layer cache, regardless of the
+        repository's cache policy
+    :type refresh: bool
+    :param force: build even if an identical build context was already built
+        and pushed
+    :type force: bool
+    :return: the queued build
+    :rtype: mc.models.Build
+    """
+    superseded = Build.query.join(Commit).filter(
+        Build.status == 'queued',
+        Commit.repository == commit.repository,
+        Commit.tag == commit.tag if commit.tag else Commit.tag.is_(None),
+    )
+    queued = None
+    for build in superseded:
+        if build.commit is commit:
+            queued = build
+            continue
+        build.status = 'skipped'
+        # Ends the streams following the build
+        log = BuildLog.for_build(current_app.config, build.id)
+        if log is not None:
+            log.write({'type': 'status', 'status': 'skipped'})
+            log.close()
+        current_app.logger.info("Build {} of {}:{} superseded by {}".format(
+            build.id,
+            build.commit.repository,
+            build.commit.commit_hash,
+            commit.commit_hash,
+        ))
+
+    if queued is not None:
+        if refresh:
+            queued.no_cache = True
+        if force:
+            queued.force = True
+        return queued
+    build = Build(
+        commit=commit,
+        timestamp=datetime.datetime.now(),
+        status='queued',
+        no_cache=True if refresh else None,
+        force=True if force else None,
+    )
+    db.session.add(build)
+    return build
+
+
+def resolve_cache_policy(commit, refresh=False):
+    """
+    Decides how the layer cache is used to build a commit, based on the
+    repository's entry in DOCKER_CACHE_POLICIES
+
+    :param commit: commit to build
+    :type commit: mc.models.Commit
+    :param refresh: force a build without the layer cache
+    :type refresh: bool
+    :return: tuple of policy name, no_cache
+    """
+    policies = current_app.config.get('DOCKER_CACHE_POLICIES', {})
+    policy = dict(policies.get('default', {'policy': 'fresh'}))
+    policy.update(policies.get(commit.repository, {}))
+    name = policy['policy']
+
+    if refresh or name == 'fresh':
+        return name, True
 
+    builds = Build.query.join(Commit).filter(
+        Commit.repository == commit.repository,
+        Build.built.is_(True),
+    ).order_by(Build.timestamp.desc())
+
+    if name == 'refresh':
+        last_fresh = builds.filter(Build.no_cache.is_(True)).first()
+        stale = last_fresh is None or (
+            datetime.datetime.now() - last_fresh.timestamp
+        ).total_seconds() > policy.get('max_age', 24 * 60 * 60)
+        return name, stale
+
+    raise ValueError("Unknown cache policy {} for {}".format(
+        name, commit.repository
+    ))
+
+
+def fingerprinted_image(fingerprint, image, exclude=None):
+    """
+    :param fingerprint: fingerprint of a build context
+    :param image: full name of the image to build
+    :param exclude: id of a build to ignore, i.e. the build being run
+    :return: the build that already pushed `image` from the same build
+        context, or None
+    """
+    query = Build.query.filter(
+        Build.fingerprint == fingerprint,
+        Build.image == image,
+        Build.pushed.is_(True),
+    )
+    if exclude is not None:
+        query = query.filter(Build.id != exclude)
+    return query.order_by(Build.id.desc()).first()
+
+
+def pushed_image(commit):
+    """
+    Finds the image that was most recently built and pushed for a commit
+    :param commit: mc.models.Commit
+    :return: full name of the image, or None if the commit was never pushed
+    """
+    build = commit.builds.filter(Build.pushed.is_(True)) \
+        .order_by(Build.id.desc()).first()
+    if build is None:
+        return None
+    # Builds recorded before Build.image existed were always hash-tagged
+    return build.image or "adsabs/{}:{}".format(
+        commit.repository, commit.commit_hash
+    )
 
 
 @celery.task()
 def build_docker(commit_id):
     """
     Task responsible for building a docker image from a commit, and pushing
-    that image to a remote repository for storage
+    that image to a remote repository for storage. If the commit's latest
+    build was superseded while queued (see queue_build), nothing is built. If
+    an image was already pushed for the commit under another name, e.g. before
+    the commit was tagged, that image is retagged instead of rebuilt.
 
     :param commit_id: commit integer id from which to build
     :type commit_id: int or basestring
@@ -120,27 +527,417 @@ def build_docker(commit_id):
 
     commit = Commit.query.get(commit_id)
 
-    build = Build(
-        commit=commit,
-        timestamp=datetime.datetime.now(),
-    )
-    current_app.logger.info("Build created: {}:{}".format(
-        commit.repository,
-        commit.commit_hash,
-    ))
+    build = commit.builds.order_by(Build.id.desc()).first()
+    if build is not None and build.status == 'skipped':
+        current_app.logger.info("Build skipped: {}:{}".format(
+            commit.repository,
+            commit.commit_hash,
+        ))
+        return
+
+    if build is None or build.status != 'queued':
+        build = Build(
+            commit=commit,
+            timestamp=datetime.datetime.now(),
+        )
+    run_build(build)
+
 
+def fail_build(build, log, error):
+    """
+    Records a build that crashed as finished without an image, and ends its
+    log, so that it is not left running and its followers stop
+
+    :param build: the build that crashed
+    :type build: mc.models.Build
+    :param log: log of the build; that in BUILD_LOG_DIR if None
+    :type log: mc.buildlogs.BuildLog or None
+    :param error: the exception
+    :return: None
+    """
+    current_app.logger.exception(error)
+    # The session may hold the failed changes, e.g. of a commit
+    db.session.rollback()
+    build.built = build.pushed = False
+    build.status = 'finished'
+    if log is None and build.id is not None:
+        log = BuildLog.for_build(current_app.config, build.id)
+    if log is not None:
+        log.write({'type': 'error', 'error': unicode(error)})
+        log.write({
+            'type': 'status', 'status': 'finished', 'built': False,
+            'pushed': False, 'duration': None,
+        })
+        log.close()
+    db.session.add(build)
+    db.session.commit()
+
+
+def run_build(build):
+    """
+    Builds and pushes the image of a build's commit, or retags an image
+    already pushed for the commit, and records the outcome on the build. A
+    recorded build is first claimed, and not run if it is no longer queued.
+
+    :param build: the build to run
+    :type build: mc.models.Build
+    :return: None
+    """
+    commit = build.commit
+    if build.id is not None:
+        # Claims the queued build, so that build_docker and schedule_builds
+        # do not both run it
+        claimed = Build.query.filter_by(id=build.id, status='queued').update(
+            {'status': 'running'}, synchronize_session=False
+        )
+        db.session.commit()
+        if not claimed:
+            current_app.logger.info("Build {} of {}:{} already {}".format(
+                build.id,
+                commit.repository,
+                commit.commit_hash,
+                build.status,
+            ))
+            return
+
+    log = None
     try:
-        builder = DockerImageBuilder(commit)
-        builder.run()
+        if refresh_jinja2(interval=current_app.config.get(
+                'TEMPLATES_REFRESH_INTERVAL', 60)):
+            current_app.logger.info("Templates changed on disk; recompiling")
+        build.cache_policy, build.no_cache = resolve_cache_policy(
+            commit, refresh=bool(build.no_cache)
+        )
+        build.status = 'running'
+        db.session.add(build)
+        db.session.commit()
+        current_app.logger.info(
+            "Build created: {}:{} ({}, no_cache={})".format(
+                commit.repository,
+                commit.commit_hash,
+                build.cache_policy,
+                build.no_cache,
+            )
+        )
+
+        mirror = None
+        if current_app.config.get('GIT_MIRROR_DIR'):
+            mirror = GitMirror(
+                commit.repository,
+                current_app.config['GIT_MIRROR_DIR'],
+                current_app.config['GIT_MIRROR_URL'].format(
+                    repo=commit.repository
+                ),
+            )
+        wheelhouse = None
+        if current_app.config.get('WHEELHOUSE_DIR'):
+            wheelhouse = Wheelhouse(
+                current_app.config['WHEELHOUSE_DIR'],
+                max_size=current_app.config.get('WHEELHOUSE_MAX_SIZE'),
+            )
+        log = BuildLog.for_build(current_app.config, build.id)
+        if log is not None:
+            log.write({'type': 'status', 'status': 'running'})
     except Exception, e:
-        current_app.logger.exception(e)
+        # e.g. an unknown cache policy
+        fail_build(build, log, e)
+        raise
+
+    pool = docker_host_pool(current_app.config)
+    # Without a farm every error is the build's; with one, errors of the
+    # daemon itself fail the build over to another daemon
+    host_errors = HOST_ERRORS if pool is not None else ()
+
+    def build_on(docker_url):
+        builder = DockerImageBuilder(
+            commit, no_cache=build.no_cache, mirror=mirror,
+            wheelhouse=wheelhouse, docker_url=docker_url, log=log,
+        )
+        try:
+            # Renders the templates, which fails e.g. without a dockerfile
+            build.fingerprint = builder.fingerprint()
+            done = fingerprinted_image(
+                build.fingerprint, builder.tag, build.id
+            ) if not build.force else None
+        except host_errors:
+            raise
+        except Exception, e:
+            current_app.logger.exception(e)
+            if log is not None:
+                log.write({'type': 'error', 'error': unicode(e)})
+            return builder
+        if done is not None:
+            current_app.logger.info(
+                "Build {} of {}:{} skipped: build {} pushed {} from an "
+                "identical context".format(
+                    build.id, commit.repository, commit.commit_hash, done.id,
+                    builder.tag,
+                )
+            )
+            builder.built = builder.pushed = True
+            return builder
+
+        source = pushed_image(commit)
+        if source is not None and source != builder.tag:
+            # e.g. a tag pushed for a commit that was built before it was
+            # tagged
+            try:
+                builder.retag(source)
+                current_app.logger.info(
+                    "Retagged {} as {}".format(source, builder.tag)
+                )
+            except host_errors:
+                raise
+            except Exception, e:
+                current_app.logger.exception(e)
+                if log is not None:
+                    log.write({'type': 'error', 'error': unicode(e)})
+
+        if not builder.pushed:
+            try:
+                builder.run()
+            except host_errors:
+                raise
+            except Exception, e:
+                current_app.logger.exception(e)
+                if log is not None:
+                    log.write({'type': 'error', 'error': unicode(e)})
+        return builder
+
+    try:
+        if pool is None:
+            builder = build_on(None)
+        else:
+            builder = pool.run(commit.repository, build_on)
+    except NoDockerHostError, e:
+        # Every daemon went away; leave the build for a later run
+        current_app.logger.error(e)
+        if log is not None:
+            log.write({'type': 'error', 'error': unicode(e)})
+            log.write({'type': 'status', 'status': 'queued'})
+            log.close()
+        build.status = 'queued'
+        db.session.add(build)
+        db.session.commit()
+        return
+    except Exception, e:
+        fail_build(build, log, e)
+        raise
+    finally:
+        if wheelhouse is not None:
+            # Lets the wheels of the build be evicted
+            wheelhouse.release()
 
     build.built = builder.built
     build.pushed = builder.pushed
+    build.image = builder.tag if builder.pushed else None
+    build.duration = builder.timer.total
+    build.status = 'finished'
+    if builder.stats is not None:
+        build.stats = ImageStats(**builder.stats)
+    if log is not None:
+        log.write({
+            'type': 'status', 'status': 'finished', 'built': build.built,
+            'pushed': build.pushed, 'duration': build.duration,
+        })
+        log.close()
     current_app.logger.info(
-        "Build {} status built/pushed {}/{}".format(
-            commit.commit_hash, build.built, build.pushed
+        "Build {} status built/pushed {}/{} [{}]{}{}{}".format(
+            commit.commit_hash, build.built, build.pushed, builder.timer,
+            " [host: {}]".format(builder.docker_url)
+            if builder.docker_url else "",
+            " [mirror: {}]".format(mirror.timer) if mirror else "",
+            " [wheelhouse: {}]".format(wheelhouse) if wheelhouse else "",
         )
     )
     db.session.add(build)
     db.session.commit()
+
+
+# Metrics of image_regressions: column of ImageStats, or of Build
+REGRESSION_METRICS = OrderedDict([
+    ('size', ImageStats.size),
+    ('compressed_size', ImageStats.compressed_size),
+    ('layers', ImageStats.layers),
+    ('duration', Build.duration),
+    ('build_duration', ImageStats.build_duration),
+    ('push_duration', ImageStats.push_duration),
+])
+
+
+def image_regressions(repository=None, window=10, threshold=1.5,
+                      min_history=3, metrics=None):
+    """
+    Finds the builds whose image size or build time jumped: each metric of a
+    build is compared to its median over the previous `window` builds of the
+    same repository that have it.
+
+    :param repository: repository to look at; None for all
+    :param window: number of previous builds the median is taken over
+    :param threshold: ratio to the median above which a build is flagged
+    :param min_history: number of previous builds needed to flag a build,
+        at most the window
+    :param metrics: names of REGRESSION_METRICS to look at; None for all
+    :return: list of dicts with the build, commit, repository, metric,
+        value, median and ratio of each regression, by repository and then
+        oldest first
+    """
+    metrics = metrics or REGRESSION_METRICS.keys()
+    columns = [REGRESSION_METRICS[m] for m in metrics]
+    query = db.session.query(
+        Build.id, Commit.repository, Commit.commit_hash, *columns
+    ).join(Commit).join(ImageStats).filter(Build.pushed.is_(True))
+    if repository is not None:
+        query = query.filter(Commit.repository == repository)
+    query = query.order_by(Commit.repository, Build.timestamp, Build.id)
+
+    regressions = []
+    history = {}
+    for row in query:
+        build_id, repo, commit_hash = row[:3]
+        for metric, value in zip(metrics, row[3:]):
+            if value is None:
+                continue
+            previous = history.setdefault((repo, metric), [])
+            trailing = previous[-window:]
+            if len(trailing) >= min(min_history, window):
+                m = median(trailing)
+                if m and float(value) / m > threshold:
+                    regressions.append({
+                        'build': build_id,
+                        'repository': repo,
+                        'commit': commit_hash,
+                        'metric': metric,
+                        'value': value,
+                        'median': m,
+                        'ratio': float(value) / m,
+                    })
+            previous.append(value)
+    return regressions
+
+
+@celery.task()
+def schedule_builds(slots=None, client=None):
+    """
+    Runs all queued builds on the docker daemon, or the daemons of
+    DOCKER_HOSTS, with a BuildScheduler, builds of tagged commits first, then
+    in order of queueing. Builds of different repositories run concurrently,
+    up to the slots the daemon(s) can sustain.
+
+    :param slots: maximum number of concurrent builds; defaults to
+        DOCKER_BUILD_SLOTS
+    :param client: docker.Client used to size the slots
+    :return: list of (build id, exception or None) in order of completion
+    """
+    app = current_app._get_current_object()
+
+    def build_fn(build_id):
+        with app.app_context():
+            build = Build.query.get(build_id)
+            # Coalesced or picked up elsewhere since it was scheduled
+            if build is None or build.status != 'queued':
+                return
+            run_build(build)
+
+    pool = docker_host_pool(current_app.config)
+    if pool is not None:
+        # The farm places each build on one of its daemons
+        client = None
+        slots = slots or pool.capacity()
+    elif client is None:
+        client = docker_clients.get()
+    scheduler = BuildScheduler(
+        client,
+        slots=slots or current_app.config.get('DOCKER_BUILD_SLOTS'),
+        cpus_per_build=current_app.config.get('DOCKER_BUILD_CPUS', 1),
+        memory_per_build=current_app.config.get('DOCKER_BUILD_MEMORY'),
+        build_fn=build_fn,
+    )
+    builds = Build.query.filter_by(status='queued').order_by(Build.id).all()
+    for build in builds:
+        scheduler.submit(
+            build.id,
+            build.commit.repository,
+            priority=1 if build.commit.tag else 0,
+        )
+    current_app.logger.info("Scheduling builds: {}".format(
+        scheduler.utilisation()
+    ))
+    finished = scheduler.run()
+    current_app.logger.info("Scheduled builds finished: {}/{} failed".format(
+        sum(1 for _, error in finished if error is not None), len(finished)
+    ))
+    return finished
+
+
+@celery.task()
+def ingest_webhooks(limit=None):
+    """
+    Drains the payloads spooled by GithubListener when WEBHOOK_ASYNC is set.
+    Payloads arriving within WEBHOOK_INGEST_WINDOW seconds of each other are
+    written with a single bulk upsert, then a build is created for each
+    distinct commit.
+
+    :param limit: maximum number of payloads to ingest; defaults to
+        WEBHOOK_INGEST_BATCH_SIZE
+    :type limit: int or None
+    :return: number of events and rows ingested, rows per second and the
+        per-stage durations in seconds
+    :rtype: dict
+    """
+    config = current_app.config
+    spool = WebhookSpool(config['WEBHOOK_SPOOL_DIR'])
+    spool.recover(config.get('WEBHOOK_CLAIM_TIMEOUT', 300))
+
+    timer = StageTimer()
+    with timer('collect'):
+        events = spool.claim_window(
+            limit or config.get('WEBHOOK_INGEST_BATCH_SIZE', 100),
+            config.get('WEBHOOK_INGEST_WINDOW', 0),
+        )
+    stats = {'events': len(events), 'rows': 0, 'rows_per_second': 0,
+             'durations': timer.durations}
+    if not events:
+        return stats
+
+    rows = []
+    with timer('parse'):
+        for event, data in events:
+            try:
+                rows.append(GithubListener.commit_values(json.loads(data)))
+            except UnknownRepoError, e:
+                current_app.logger.warning(
+                    "Dropping webhook {}: unknown repo {}".format(event, e)
+                )
+            except (ValueError, KeyError), e:
+                current_app.logger.warning(
+                    "Dropping malformed webhook {}: {}".format(event, e)
+                )
+
+    with timer('upsert'):
+        ids = upsert_commits(rows)
+        db.session.commit()
+    stats['rows'] = len(ids)
+    if timer.durations['upsert']:
+        stats['rows_per_second'] = len(ids) / timer.durations['upsert']
+
+    with timer('enqueue'):
+        # Several deliveries for the same commit result in one build
+        commits = [
+            Commit.query.get(ids[commit_hash]) for commit_hash in
+            OrderedDict.fromkeys(r['commit_hash'] for r in rows)
+        ]
+        for commit in commits:
+            queue_build(commit)
+        db.session.commit()
+        for commit in commits:
+            build_docker.delay(commit.id)
+
+    for event, _ in events:
+        spool.ack(event)
+
+    current_app.logger.info(
+        "Ingested {events} webhooks, {rows} commits at {rows_per_second:.0f} "
+        "rows/s [{timer}]".format(timer=timer, **stats)
+    )
+    return stats
@@ -0,0 +1,53 @@
+"""
+Micro-benchmark of DockerImageBuilder.render_templates with a cold and a warm
+template cache
+
+    python -m mc.tests.benchmarks.bench_render_templates [repeat]
+"""
+import shutil
+import sys
+import tempfile
+import timeit
+from mc import app
+from mc.builders import DockerImageBuilder, BaseImageBuilder
+from mc.models import Commit
+
+
+def render():
+    commit = Commit(commit_hash='master', repository='adsws')
+    DockerImageBuilder(commit).render_templates()
+
+
+def cold():
+    """
+    Every build compiles every template, as with one environment per builder
+    """
+    app.invalidate_jinja2()
+    app._jinja2_environments.clear()
+    BaseImageBuilder.available.clear()
+    render()
+
+
+def main(repeat=50):
+    bytecode_dir = tempfile.mkdtemp()
+    flask_app = app.create_app()
+    flask_app.config['JINJA2_BYTECODE_DIR'] = bytecode_dir
+    try:
+        with flask_app.app_context():
+            results = [
+                ('cold', timeit.timeit(cold, number=repeat)),
+                # New processes only load the compiled templates from disk
+                ('bytecode', timeit.timeit(
+                    lambda: (app._jinja2_environments.clear(), render()),
+                    number=repeat
+                )),
+                ('warm', timeit.timeit(render, number=repeat)),
+            ]
+    finally:
+        shutil.rmtree(bytecode_dir)
+    for name, total in results:
+        print "{:<10}{:8.2f} ms/build".format(name, 1000 * total / repeat)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -1,15 +1,28 @@
 """
 Test builders
 """
+import datetime
 import unittest
 import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import base64
 import mock
+import httpretty
 import jinja2
 import json
 import tarfile
-from mc.builders import DockerImageBuilder, DockerRunner, ECSBuilder
+from mc import app
+from mc import builders
+from mc.builders import DockerImageBuilder, DockerRunner, ECSBuilder, \
+    BaseImageBuilder, DockerClientPool
+from mc.contexts import DockerContext
 from mc.models import Commit, Build
-from mc.exceptions import BuildError
+from mc.exceptions import BuildError, DependencyError
+from docker.errors import NotFound
 
 class TestECSbuilder(unittest.TestCase):
     """
@@ -91,15 +104,107 @@ class TestDockerImageBuilder(unittest.TestCase):
         self.assertEqual(self.builder.files[0]['name'], 'Dockerfile')
         self.assertIn(self.commit.commit_hash, self.builder.files[0]['content'])
 
+    def test_base_image(self):
+        """
+        The Dockerfile should be built FROM the shared base image, which is
+        tagged with the hash of its rendered Dockerfile
+        """
+        self.builder.render_templates()
+        base = self.builder.base
+        self.assertTrue(self.builder.files[0]['content'].startswith(
+            'FROM adsabs/python-base:{}'.format(base.hash)
+        ))
+        self.assertEqual(base.tag, BaseImageBuilder().tag)
+        self.assertIn('apt-get install', base.dockerfile)
+        self.assertNotIn('apt-get install', self.builder.files[0]['content'])
+
+    @mock.patch('mc.builders.Client')
+    def test_base_image_ensure(self, mocked):
+        """
+        The base image should only be built and pushed if it is neither
+        available locally nor in the registry
+        """
+        instance = mocked.return_value
+        instance.build.return_value = ['Successfully built']
+        instance.push.return_value = ['DIGEST: sha256']
+
+        base = BaseImageBuilder(name='unittest-base')
+        self.assertFalse(base.ensure())
+        self.assertFalse(instance.build.called)
+        BaseImageBuilder.available.clear()
+
+        instance.inspect_image.side_effect = [
+            NotFound('not found', mock.Mock()), {'Id': 'pulled'}
+        ]
+        self.assertFalse(base.ensure())
+        instance.pull.assert_called_with(base.tag)
+        self.assertFalse(instance.build.called)
+        BaseImageBuilder.available.clear()
+
+        instance.inspect_image.side_effect = NotFound('not found', mock.Mock())
+        self.assertTrue(base.ensure())
+        _, kwargs = instance.build.call_args
+        self.assertEqual(kwargs['tag'], base.tag)
+        instance.push.assert_called_with(base.tag, stream=True)
+        with tarfile.open(fileobj=io.BytesIO(base.tarfile.tobytes())) as tf:
+            self.assertEqual(tf.getnames(), ['Dockerfile'])
+
+        # Known to be available from now on
+        instance.reset_mock()
+        self.assertFalse(base.ensure())
+        self.assertFalse(instance.inspect_image.called)
+        BaseImageBuilder.available.clear()
+
+    @mock.patch('mc.builders.Client')
+    def test_base_image_refresh(self, mocked):
+        """
+        Fresh builds should pull the base image, and rebuild it once it is
+        older than max_age
+        """
+        instance = mocked.return_value
+        instance.build.return_value = ['Successfully built']
+        instance.push.return_value = ['DIGEST: sha256']
+        builder = DockerImageBuilder(
+            Commit(commit_hash='master', repository='adsws'), no_cache=True
+        )
+        self.assertTrue(builder.base.refresh)
+        self.assertTrue(builder.base.no_cache)
+        self.assertFalse(DockerImageBuilder(
+            Commit(commit_hash='master', repository='adsws'), no_cache=False
+        ).base.refresh)
+
+        base = BaseImageBuilder(name='unittest-base', refresh=True,
+                                max_age=3600)
+        created = datetime.datetime.utcnow() - datetime.timedelta(minutes=5)
+        instance.inspect_image.return_value = {
+            'Id': 'pulled', 'Created': created.isoformat() + 'Z'
+        }
+        self.assertFalse(base.ensure())
+        instance.pull.assert_called_with(base.tag)
+        self.assertFalse(instance.build.called)
+
+        # Pulled again, even though known to be available
+        instance.reset_mock()
+        created -= datetime.timedelta(hours=2)
+        instance.inspect_image.return_value['Created'] = \
+            created.isoformat() + 'Z'
+        self.assertTrue(base.ensure())
+        instance.pull.assert_called_with(base.tag)
+        _, kwargs = instance.build.call_args
+        self.assertTrue(kwargs['nocache'])
+        self.assertTrue(kwargs['pull'])
+        BaseImageBuilder.available.clear()
+
     def test_create_docker_context(self):
         """
-        Test that the docker context is created in-memory and that it has
-        a non zero size. This uses "live" templates.
+        Test that the docker context is streamed and that its members have
+        the right modes. This uses "live" templates.
         """
         self.builder.render_templates()
         self.builder.create_docker_context()
-        self.assertIsInstance(self.builder.tarfile, io.BytesIO)
-        with tarfile.open(fileobj=self.builder.tarfile) as tf:
+        self.assertIsInstance(self.builder.tarfile, DockerContext)
+        context = io.BytesIO(self.builder.tarfile.tobytes())
+        with tarfile.open(fileobj=context) as tf:
             for fn in ["Dockerfile", "gunicorn.conf.py", "app.nginx.conf"]:
                 f = tf.getmember(fn)
                 self.assertEqual(f.mode, 420)
@@ -118,6 +223,25 @@ class TestDockerImageBuilder(unittest.TestCase):
         instance.build.return_value = ['Successfully built']
         self.builder.build()
         self.assertTrue(self.builder.built)
+        _, kwargs = instance.build.call_args
+        self.assertTrue(kwargs['nocache'])
+        self.assertTrue(kwargs['pull'])
+
+    @mock.patch('mc.builders.Client', autospec=True)
+    def test_docker_build_signature(self, mocked):
+        """
+        The arguments of docker build should be those of the installed
+        docker client; a mock with its spec raises TypeError otherwise
+        """
+        instance = mocked.return_value
+        instance.build.return_value = ['Successfully built']
+        for no_cache in (True, False):
+            builder = DockerImageBuilder(self.commit, no_cache=no_cache)
+            builder.build()
+            self.assertTrue(builder.built)
+            _, kwargs = instance.build.call_args
+            self.assertEqual(kwargs['nocache'], no_cache)
+            self.assertEqual(kwargs['pull'], no_cache)
 
     @mock.patch('mc.builders.Client')
     def test_docker_push(self, mocked):
@@ -137,6 +261,322 @@ class TestDockerImageBuilder(unittest.TestCase):
         with self.assertRaises(BuildError):
             self.builder.push()
 
+    def test_fingerprint(self):
+        """
+        The fingerprint should only depend on the commit and the rendered
+        files, and not render the files twice
+        """
+        fingerprint = self.builder.fingerprint()
+        files = len(self.builder.files)
+        self.assertEqual(self.builder.fingerprint(), fingerprint)
+        self.assertEqual(len(self.builder.files), files)
+        self.assertEqual(
+            DockerImageBuilder(self.commit).fingerprint(), fingerprint
+        )
+        other = DockerImageBuilder(
+            Commit(commit_hash='other', repository='adsws')
+        )
+        self.assertNotEqual(other.fingerprint(), fingerprint)
+        changed = DockerImageBuilder(self.commit)
+        changed.render_templates()
+        changed.files[-1]['content'] += '# changed'
+        self.assertNotEqual(changed.fingerprint(), fingerprint)
+
+    @mock.patch('mc.builders.Client')
+    def test_docker_retag(self, mocked):
+        """
+        retag() should tag the existing image, pulling it if it is not
+        available locally, and push it under the new name
+        """
+        instance = mocked.return_value
+        instance.push.return_value = ['DIGEST: sha256']
+        self.commit.tag = 'v1.0.0'
+        builder = DockerImageBuilder(self.commit)
+
+        builder.retag('adsabs/adsws:master')
+        self.assertFalse(instance.pull.called)
+        self.assertFalse(instance.build.called)
+        instance.tag.assert_called_with(
+            'adsabs/adsws:master', 'adsabs/adsws', tag='v1.0.0', force=True
+        )
+        instance.push.assert_called_with('adsabs/adsws:v1.0.0', stream=True)
+        self.assertTrue(builder.built)
+        self.assertTrue(builder.pushed)
+
+        instance.inspect_image.side_effect = NotFound('not found', mock.Mock())
+        builder.retag('adsabs/adsws:master')
+        instance.pull.assert_called_with('adsabs/adsws:master')
+
+        instance.tag.return_value = False
+        with self.assertRaises(BuildError):
+            builder.retag('adsabs/adsws:master')
+
+        instance.tag.return_value = True
+        instance.push.return_value = ['{"error": "denied"}']
+        builder = DockerImageBuilder(self.commit)
+        with self.assertRaises(BuildError):
+            builder.retag('adsabs/adsws:master')
+        self.assertFalse(builder.built)
+        self.assertFalse(builder.pushed)
+
+
+class FakeRegistry(object):
+    """
+    Stands in for docker.Client pushing to a local registry; records the
+    credentials and $HOME seen by each push
+    """
+    def __init__(self):
+        self.pushes = []
+        self.lock = threading.Lock()
+
+    def push(self, repository, stream=False, auth_config=None):
+        time.sleep(0.02)  # Let the pushes overlap
+        with self.lock:
+            self.pushes.append(
+                (repository, auth_config, os.environ.get('HOME'))
+            )
+        return ['{"status": "Digest: sha256:abc"}']
+
+
+class TestRegistryAuth(unittest.TestCase):
+    """
+    Test pushing and pulling with explicit registry credentials
+    """
+
+    def setUp(self):
+        self.docker_home = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.docker_home, '.docker'))
+        with open(os.path.join(self.docker_home, '.docker',
+                               'config.json'), 'w') as f:
+            json.dump({'auths': {'localhost:5000': {
+                'auth': base64.b64encode('mc:secret'),
+                'email': 'mc@example.com',
+            }}}, f)
+        self.app = app.create_app()
+        self.app.config['DOCKER_HOME'] = self.docker_home
+        builders._registry_auths.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.docker_home)
+        builders._registry_auths.clear()
+
+    def test_registry_auth(self):
+        """
+        credentials should be found for the registry of the image only
+        """
+        config = builders.registry_auth(
+            'localhost:5000/adsabs/adsws:v1', self.docker_home
+        )
+        self.assertEqual(config['username'], 'mc')
+        self.assertEqual(config['password'], 'secret')
+        for image in ('localhost:5000/adsabs/postgres',
+                      'localhost:5000/adsabs/adsws@sha256:abc'):
+            self.assertEqual(
+                builders.registry_auth(image, self.docker_home), config
+            )
+        self.assertIsNone(
+            builders.registry_auth('adsabs/adsws:v1', self.docker_home)
+        )
+        self.assertIsNone(builders.registry_auth('adsabs/adsws:v1', None))
+
+    @httpretty.activate
+    def test_registry_manifest(self):
+        """
+        the manifest should be fetched with a token from the registry's
+        token service, using the registry credentials
+        """
+        manifest_url = 'https://localhost:5000/v2/adsabs/adsws/manifests/v1'
+
+        def manifest(request, uri, headers):
+            if request.headers.get('Authorization') != 'Bearer t0k3n':
+                headers['WWW-Authenticate'] = \
+                    'Bearer realm="https://auth.example.com/token",' \
+                    'service="registry",scope="repository:adsabs/adsws:pull"'
+                return 401, headers, ''
+            return 200, headers, json.dumps({
+                'config': {'size': 10},
+                'layers': [{'size': 100}, {'size': 200}],
+            })
+
+        def token(request, uri, headers):
+            self.assertEqual(
+                request.headers['Authorization'],
+                'Basic {}'.format(base64.b64encode('mc:secret'))
+            )
+            self.assertEqual(
+                request.querystring['scope'],
+                ['repository:adsabs/adsws:pull']
+            )
+            return 200, headers, json.dumps({'token': 't0k3n'})
+
+        httpretty.register_uri(httpretty.GET, manifest_url, body=manifest)
+        httpretty.register_uri(
+            httpretty.GET, 'https://auth.example.com/token', body=token
+        )
+        image = 'localhost:5000/adsabs/adsws:v1'
+        m = builders.registry_manifest(
+            image, builders.registry_auth(image, self.docker_home)
+        )
+        self.assertEqual(sum(l['size'] for l in m['layers']), 300)
+
+    @mock.patch('mc.builders.auth.load_config',
+                wraps=builders.auth.load_config)
+    @mock.patch('mc.builders.Client')
+    def test_concurrent_push(self, Client, load_config):
+        """
+        pushes from several threads should each send the credentials, load
+        them only once and leave $HOME alone
+        """
+        registry = FakeRegistry()
+        Client.return_value = registry
+        home = os.environ.get('HOME')
+        errors = []
+
+        def push(n):
+            commit = Commit(
+                commit_hash='{:040d}'.format(n), repository='svc{}'.format(n)
+            )
+            builder = DockerImageBuilder(
+                commit, namespace='localhost:5000/adsabs'
+            )
+            try:
+                with self.app.app_context():
+                    builder.push()
+                self.assertTrue(builder.pushed)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [
+            threading.Thread(target=push, args=(n,)) for n in range(8)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(registry.pushes), 8)
+        self.assertEqual(
+            sorted(r for r, _, _ in registry.pushes),
+            sorted('localhost:5000/adsabs/svc{0}:{0:040d}'.format(n)
+                   for n in range(8))
+        )
+        for _, auth_config, push_home in registry.pushes:
+            self.assertEqual(auth_config['username'], 'mc')
+            self.assertEqual(push_home, home)
+        self.assertEqual(os.environ.get('HOME'), home)
+        load_config.assert_called_once_with(
+            os.path.join(self.docker_home, '.docker', 'config.json')
+        )
+
+    @mock.patch('mc.builders.Client')
+    def test_pull(self, Client):
+        """
+        pulls of images, base images and images to retag should send the
+        credentials too
+        """
+        instance = Client.return_value
+        instance.images.return_value = []
+        instance.create_container.return_value = {'Id': 'mocked'}
+        instance.inspect_image.side_effect = NotFound('not found', mock.Mock())
+        instance.tag.return_value = True
+        instance.push.return_value = ['{"status": "Digest: sha256:abc"}']
+        builder = DockerImageBuilder(
+            Commit(commit_hash='master', repository='adsws', tag='v1'),
+            namespace='localhost:5000/adsabs',
+        )
+        with self.app.app_context():
+            builder.retag('localhost:5000/adsabs/adsws:master')
+            builder.base.run = mock.Mock()
+            builder.base.ensure()
+            DockerRunner(image='localhost:5000/adsabs/postgres', name='pg')
+        BaseImageBuilder.available.clear()
+
+        self.assertEqual(
+            [args[0] for args, _ in instance.pull.call_args_list],
+            ['localhost:5000/adsabs/adsws:master', builder.base.tag,
+             'localhost:5000/adsabs/postgres']
+        )
+        for _, kwargs in instance.pull.call_args_list:
+            self.assertEqual(kwargs['auth_config']['username'], 'mc')
+
+
+class FakeClient(object):
+    """
+    Stands in for docker.Client; counts the API version negotiations
+    """
+    negotiations = 0
+
+    def __init__(self, base_url=None, version=None):
+        self.base_url = base_url
+        if version == 'auto':
+            FakeClient.negotiations += 1
+            version = '1.24'
+        self.api_version = version
+        self.closed = False
+
+    def pull(self, image):
+        pass
+
+    def images(self):
+        return []
+
+    def create_container(self, **kwargs):
+        return {'Id': 'fake'}
+
+    def close(self):
+        self.closed = True
+
+
+class TestDockerClientPool(unittest.TestCase):
+    """
+    Test the pool of docker clients
+    """
+
+    def setUp(self):
+        FakeClient.negotiations = 0
+        self.pool = DockerClientPool(factory=FakeClient)
+
+    def test_shared_clients(self):
+        """
+        one client should be created, and the version negotiated once, per
+        daemon
+        """
+        local = self.pool.get()
+        self.assertIs(self.pool.get(), local)
+        self.assertIsNone(local.base_url)
+        remote = self.pool.get('tcp://build1:2375')
+        self.assertIsNot(remote, local)
+        self.assertIs(self.pool.get('tcp://build1:2375'), remote)
+        self.assertEqual(FakeClient.negotiations, 2)
+
+    def test_cached_version(self):
+        """
+        clients re-created after a clear or a fork should reuse the
+        negotiated version
+        """
+        client = self.pool.get()
+        self.pool.clear()
+        self.assertTrue(client.closed)
+        self.pool.pid = -1  # As seen from a forked worker
+        other = self.pool.get()
+        self.assertIsNot(other, client)
+        self.assertEqual(other.api_version, '1.24')
+        self.assertEqual(FakeClient.negotiations, 1)
+
+    def test_builders_share_client(self):
+        """
+        builders and runners should share the injected client
+        """
+        with mock.patch('mc.builders.docker_clients', self.pool):
+            runner = DockerRunner(image='redis', name='redis')
+            builder = DockerImageBuilder(
+                Commit(commit_hash='master', repository='adsws')
+            )
+            self.assertIs(builder.client(), runner.client)
+            self.assertIs(builder.base.client(), runner.client)
+        self.assertEqual(FakeClient.negotiations, 1)
+
 
 class TestDockerRunner(unittest.TestCase):
     """
@@ -187,3 +627,83 @@ class TestDockerRunner(unittest.TestCase):
         self.builder.teardown()
         self.instance.stop.assert_called_with(container='mocked')
         self.instance.remove_container.assert_called_with(container='mocked')
+
+
+class TestImageInventory(unittest.TestCase):
+    """
+    Test the inventory of the images of a daemon and the pull policies
+    """
+
+    def setUp(self):
+        self.client = mock.Mock(base_url='http+docker://inventory')
+        self.client.images.return_value = [
+            {'Id': 'sha256:aaa', 'RepoTags': ['redis:latest'],
+             'RepoDigests': ['redis@sha256:111']},
+            {'Id': 'sha256:bbb', 'RepoTags': ['postgres:9.5'],
+             'RepoDigests': None},
+            {'Id': 'sha256:ccc', 'RepoTags': ['<none>:<none>']},
+        ]
+        self.client.create_container.return_value = {'Id': 'created'}
+        self.pool = mock.patch(
+            'mc.builders.docker_clients', mock.Mock(**{
+                'get.return_value': self.client
+            })
+        )
+        self.pool.start()
+        builders._image_inventories.clear()
+
+    def tearDown(self):
+        self.pool.stop()
+        builders._image_inventories.clear()
+
+    def test_inventory(self):
+        """
+        images should be found by tag or digest, and the daemon listed again
+        only once the listing is stale or invalidated
+        """
+        inventory = builders.image_inventory(self.client, ttl=60)
+        self.assertIs(inventory, builders.image_inventory(self.client))
+        self.assertEqual(inventory.get('redis'), 'sha256:aaa')
+        self.assertEqual(inventory.get('redis@sha256:111'), 'sha256:aaa')
+        self.assertIn('postgres:9.5', inventory)
+        self.assertNotIn('postgres', inventory)
+        self.assertNotIn('<none>:<none>', inventory.images)
+        self.assertEqual(self.client.images.call_count, 1)
+
+        inventory.invalidate()
+        self.assertIn('redis', inventory)
+        self.assertEqual(self.client.images.call_count, 2)
+        inventory.listed -= 61
+        self.assertIn('redis', inventory)
+        self.assertEqual(self.client.images.call_count, 3)
+
+    def test_pull_policies(self):
+        """
+        images should be pulled always, only if they are not available
+        locally, or never
+        """
+        DockerRunner(image='redis', name='redis')
+        self.assertFalse(self.client.pull.called)
+        DockerRunner(image='consul', name='consul')
+        self.client.pull.assert_called_once_with('consul')
+
+        self.client.pull.reset_mock()
+        DockerRunner(image='redis', name='redis', pull_policy='always')
+        self.client.pull.assert_called_once_with('redis')
+
+        self.client.pull.reset_mock()
+        with self.assertRaises(DependencyError):
+            DockerRunner(image='consul', name='consul', pull_policy='never')
+        self.assertFalse(self.client.pull.called)
+        with self.assertRaises(ValueError):
+            DockerRunner(image='redis', name='redis', pull_policy='sometimes')
+
+    def test_refresh(self):
+        """
+        refresh should list the images of the daemon again
+        """
+        DockerRunner(image='redis', name='redis')
+        DockerRunner(image='redis', name='redis')
+        self.assertEqual(self.client.images.call_count, 1)
+        DockerRunner(image='redis', name='redis', refresh=True)
+        self.assertEqual(self.client.images.call_count, 2)
@@ -0,0 +1,225 @@
+"""
+Test the build logs
+"""
+import json
+import shutil
+import tempfile
+import unittest
+import zlib
+import mock
+from mc.buildlogs import StatusDecoder, BuildLog
+from mc.builders import DockerImageBuilder
+from mc.exceptions import BuildError
+from mc.models import Commit
+
+BUILD_STREAM = [
+    {"stream": "Step 1/3 : FROM adsabs/python-base:abc\n"},
+    {"stream": " ---> 0123456789ab\n"},
+    {"stream": "Step 2/3 : RUN pip install -r requirements.txt\n"},
+    {"stream": " ---> Running in fedcba987654\n"},
+    {"stream": "Collecting flask\n"},
+    {"stream": " ---> 3456789abcde\n"},
+    {"stream": "Step 3/3 : COPY src /app\n"},
+    {"stream": " ---> 456789abcdef\n"},
+    {"stream": "Successfully built 456789abcdef\n"},
+]
+
+PUSH_STREAM = [
+    {"status": "The push refers to a repository [docker.io/adsabs/adsws]"},
+    {"status": "Pushing", "id": "5f70bf18a086",
+     "progressDetail": {"current": 512, "total": 1024}},
+    {"status": "Pushed", "id": "5f70bf18a086", "progressDetail": {}},
+    {"status": "master: digest: sha256:0a1b size: 1234"},
+]
+
+
+def stream(objects):
+    """
+    :return: the objects as one string, as sent by the docker daemon
+    """
+    return ''.join(json.dumps(o) + '\r\n' for o in objects)
+
+
+class TestStatusDecoder(unittest.TestCase):
+    """
+    Test the decoding of the docker status stream
+    """
+
+    def decode(self, data, size):
+        decoder = StatusDecoder()
+        events = []
+        for i in range(0, len(data), size):
+            events.extend(decoder.feed(data[i:i + size]))
+        return events + decoder.close()
+
+    def test_build_events(self):
+        """
+        the build stream should be decoded into step, layer and built events,
+        however it is chunked
+        """
+        data = stream(BUILD_STREAM)
+        for size in (1, 7, len(data)):
+            events = self.decode(data, size)
+            self.assertEqual(
+                [e['type'] for e in events],
+                ['step', 'layer', 'step', 'output', 'output', 'layer',
+                 'step', 'layer', 'built']
+            )
+            self.assertEqual(events[0]['steps'], 3)
+            self.assertEqual(events[1]['layer'], '0123456789ab')
+            self.assertEqual(events[4]['step'], 2)
+            self.assertEqual(events[-1]['image'], '456789abcdef')
+
+    def test_push_events(self):
+        """
+        the push stream should be decoded into progress and pushed events
+        """
+        events = self.decode(stream(PUSH_STREAM), 5)
+        self.assertEqual(
+            [e['type'] for e in events],
+            ['output', 'progress', 'output', 'pushed']
+        )
+        self.assertEqual(events[1]['current'], 512)
+        self.assertEqual(events[1]['total'], 1024)
+        self.assertEqual(events[1]['layer'], '5f70bf18a086')
+        self.assertEqual(events[-1]['digest'], 'sha256:0a1b')
+
+    def test_error(self):
+        """
+        errors should be decoded from the error or errorDetail fields
+        """
+        events = self.decode(stream([
+            {"stream": "Step 1/2 : RUN false\n"},
+            {"errorDetail": {"message": "returned a non-zero code: 1"},
+             "error": "returned a non-zero code: 1"},
+        ]), 3)
+        self.assertEqual(events[-1]['type'], 'error')
+        self.assertEqual(events[-1]['error'], 'returned a non-zero code: 1')
+        self.assertEqual(events[-1]['step'], 1)
+
+    def test_text_lines(self):
+        """
+        lines that are not JSON should be decoded as plain text
+        """
+        events = self.decode('Step 1 : FROM x\nSuccessfully built\n', 4)
+        self.assertEqual([e['type'] for e in events], ['step', 'built'])
+        events = self.decode('DIGEST: sha256', 4)
+        self.assertEqual([e['type'] for e in events], ['pushed'])
+
+
+class TestBuildLog(unittest.TestCase):
+    """
+    Test the chunked, compressed build log
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.log = BuildLog(self.directory, 1, chunk_size=1024)
+        for n in range(1000):
+            self.log.write({'type': 'output', 'message': 'line {}'.format(n)})
+        self.log.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_read(self):
+        """
+        the events should be read back in order, in any range
+        """
+        log = BuildLog(self.directory, 1)
+        self.assertTrue(log.exists())
+        self.assertEqual(len(log), 1000)
+        self.assertGreater(len(log.index()), 10)
+        events = log.read()
+        self.assertEqual(
+            [e['message'] for e in events],
+            ['line {}'.format(n) for n in range(1000)]
+        )
+        self.assertEqual(
+            [e['message'] for e in log.read(498, 503)],
+            ['line {}'.format(n) for n in range(498, 503)]
+        )
+        self.assertEqual(log.read(990, 2000), events[990:])
+        self.assertEqual(log.read(1000), [])
+        self.assertFalse(BuildLog(self.directory, 2).exists())
+        self.assertEqual(BuildLog(self.directory, 2).read(), [])
+
+    def test_partial_decompression(self):
+        """
+        reading a range or the tail should decompress only its chunks
+        """
+        log = BuildLog(self.directory, 1)
+        with mock.patch('mc.buildlogs.zlib.decompress',
+                        wraps=zlib.decompress) as decompress:
+            self.assertEqual(
+                [e['message'] for e in log.tail(3)],
+                ['line 997', 'line 998', 'line 999']
+            )
+            self.assertEqual(decompress.call_count, 1)
+            decompress.reset_mock()
+            log.read(500, 501)
+            self.assertEqual(decompress.call_count, 1)
+
+    def test_append(self):
+        """
+        a log should be appended to across writers, and be smaller than the
+        events it holds
+        """
+        log = BuildLog(self.directory, 1)
+        log.write({'type': 'status', 'status': 'finished'})
+        self.assertEqual(len(log), 1000)
+        log.flush()
+        self.assertEqual(len(log), 1001)
+        self.assertEqual(log.tail(1), [{'type': 'status', 'status': 'finished'}])
+        with open(log.path, 'rb') as f:
+            self.assertLess(len(f.read()), log.size)
+
+
+class TestBuilderEvents(unittest.TestCase):
+    """
+    Test that the builder decides success from the decoded events
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.log = BuildLog(self.directory, 1)
+        self.builder = DockerImageBuilder(
+            Commit(commit_hash='master', repository='adsws'), log=self.log
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @mock.patch('mc.builders.Client')
+    def test_build_and_push(self, Client):
+        """
+        a successful build and push should be stored in the build log
+        """
+        data = stream(BUILD_STREAM)
+        Client.return_value.build.return_value = iter([data[:50], data[50:]])
+        Client.return_value.push.return_value = iter([stream(PUSH_STREAM)])
+        self.builder.tarfile = None
+        self.builder.build()
+        self.builder.push()
+        self.assertTrue(self.builder.built)
+        self.assertTrue(self.builder.pushed)
+        events = self.log.read()
+        self.assertEqual(len(events), len(BUILD_STREAM) + len(PUSH_STREAM))
+        self.assertEqual(events[0]['stage'], 'build')
+        self.assertEqual(events[-1]['stage'], 'push')
+
+    @mock.patch('mc.builders.Client')
+    def test_build_error(self, Client):
+        """
+        an error event should fail the build with the daemon's message, even
+        if it is not the last line
+        """
+        Client.return_value.build.return_value = [stream([
+            {"stream": "Step 1/2 : RUN false\n"},
+            {"error": "The command returned a non-zero code: 1"},
+            {"stream": "Successfully built 0123456789ab\n"},
+        ])]
+        with self.assertRaisesRegexp(BuildError, 'non-zero code'):
+            self.builder.build()
+        self.assertFalse(self.builder.built)
+        self.assertEqual(self.log.read()[1]['type'], 'error')
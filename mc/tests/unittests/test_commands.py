@@ -6,11 +6,12 @@ from flask.ext.testing import TestCase
 from mc.app import create_app
 from mc.tests.stubdata import github_commit_payload
 from mc.manage import BuildDockerImage, MakeDockerrunTemplate, \
-    RegisterTaskRevision, UpdateService, RunTask
-from mc.models import db, Commit, Build
+    RegisterTaskRevision, UpdateService, RunTask, ImageRegressions
+from mc.models import db, Commit, Build, ImageStats
 import mock
 import httpretty
 from sqlalchemy.orm.exc import NoResultFound
+import datetime
 import json
 
 
@@ -196,6 +197,17 @@ class TestBuildDockerImage(TestCase):
                 repository=repo, commit_hash=commit
             ).one()
             self.assertEqual(c.id, c2.id)
+            self.assertIsNone(c2.builds.all()[-1].no_cache)
+
+            BuildDockerImage().run(repo, commit, refresh=True, app=self.app)
+            build = db.session.query(Build).order_by(Build.id.desc()).first()
+            self.assertEqual(build.commit_id, c.id)
+            self.assertTrue(build.no_cache)
+            self.assertIsNone(build.force)
+
+            BuildDockerImage().run(repo, commit, force=True, app=self.app)
+            build = db.session.query(Build).order_by(Build.id.desc()).first()
+            self.assertTrue(build.force)
 
     @httpretty.activate
     def test_run_tag(self):
@@ -272,3 +284,59 @@ class TestBuildDockerImage(TestCase):
 
             with self.assertRaises(KeyError):
                 BuildDockerImage().run(repo, tag=no_tag, app=self.app)
+
+
+class TestImageRegressions(TestCase):
+    """
+    Test the manage.py regressions command
+    """
+
+    def create_app(self):
+        app = create_app()
+        app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:///"
+        return app
+
+    def setUp(self):
+        db.create_all()
+        start = datetime.datetime(2016, 1, 1)
+        sizes = {
+            'adsws': [100, 110, 90, 105, 300, 100],
+            'biblib': [50, 50, 50, 50, 50, 50],
+        }
+        for repo, values in sizes.items():
+            for n, size in enumerate(values):
+                db.session.add(Build(
+                    commit=Commit(
+                        repository=repo, commit_hash='{}-{}'.format(repo, n)
+                    ),
+                    timestamp=start + datetime.timedelta(days=n),
+                    pushed=True, status='finished', duration=60.0,
+                    stats=ImageStats(size=size, layers=10),
+                ))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def test_run(self):
+        """
+        builds well above the trailing median of their repository should be
+        flagged
+        """
+        regressions = ImageRegressions().run(app=self.app)
+        self.assertEqual(
+            [(r['commit'], r['metric']) for r in regressions],
+            [('adsws-4', 'size')]
+        )
+        self.assertEqual(regressions[0]['median'], 102.5)
+        self.assertAlmostEqual(regressions[0]['ratio'], 300 / 102.5)
+
+        # A shorter window and lower threshold are more sensitive
+        regressions = ImageRegressions().run(
+            repo='adsws', window=1, threshold=1.1, metrics=['size'],
+            app=self.app,
+        )
+        self.assertEqual(
+            [r['commit'] for r in regressions], ['adsws-3', 'adsws-4']
+        )
@@ -0,0 +1,123 @@
+"""
+Test the streamed docker contexts
+"""
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+import mock
+import requests
+from mc.contexts import DockerContext
+
+
+class TestDockerContext(unittest.TestCase):
+    """
+    Test the DockerContext
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.wheel = os.path.join(self.directory, 'flask-1.0-py2-none-any.whl')
+        with open(self.wheel, 'wb') as f:
+            f.write(os.urandom(300 * 1024))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self, context):
+        return tarfile.open(fileobj=io.BytesIO(context.tobytes()))
+
+    def test_members(self):
+        """
+        rendered and on-disk files should be members of the context, sized
+        by their encoded bytes
+        """
+        context = DockerContext([
+            {'name': 'Dockerfile', 'content': u'# caf\xe9\nFROM python\n'},
+            {'name': 'nginx.sh', 'content': u'nginx', 'mode': 0555},
+            {'name': 'wheels/flask.whl', 'path': self.wheel},
+        ])
+        with self.read(context) as tar:
+            self.assertEqual(
+                tar.getnames(), ['Dockerfile', 'nginx.sh', 'wheels/flask.whl']
+            )
+            self.assertEqual(
+                tar.extractfile('Dockerfile').read().decode('utf-8'),
+                u'# caf\xe9\nFROM python\n'
+            )
+            self.assertEqual(tar.getmember('nginx.sh').mode, 0555)
+            with open(self.wheel, 'rb') as f:
+                self.assertEqual(
+                    tar.extractfile('wheels/flask.whl').read(), f.read()
+                )
+        # It can be sent again, e.g. to another daemon
+        self.assertEqual(context.tobytes(), context.tobytes())
+
+    def test_chunked_upload(self):
+        """
+        requests should send the context chunked, without generating it
+        before the upload
+        """
+        context = DockerContext([{'name': 'Dockerfile', 'content': u'FROM x'}])
+        with mock.patch.object(
+                DockerContext, 'blocks', wraps=context.blocks) as blocks:
+            request = requests.Request(
+                'POST', 'http+docker://localunixsocket/build', data=context
+            ).prepare()
+            self.assertFalse(blocks.called)
+        self.assertFalse(hasattr(context, 'getvalue'))
+        self.assertEqual(request.headers['Transfer-Encoding'], 'chunked')
+        self.assertNotIn('Content-Length', request.headers)
+        self.assertIs(request.body, context)
+
+    def test_streaming(self):
+        """
+        the context should be generated in non-empty chunks of about
+        chunk_size, without reading any file whole
+        """
+        context = DockerContext(
+            [{'name': 'Dockerfile', 'content': u'FROM python\n'},
+             {'name': 'flask.whl', 'path': self.wheel}],
+            chunk_size=16 * 1024,
+        )
+        reads = []
+
+        class TrackedFile(file):
+            def read(self, size=-1):
+                reads.append(size)
+                return file.read(self, size)
+
+        with mock.patch('mc.contexts.open', TrackedFile, create=True):
+            chunks = list(context)
+        self.assertTrue(all(chunks))
+        self.assertTrue(all(len(c) <= 2 * 16 * 1024 for c in chunks))
+        self.assertEqual(max(reads), 16 * 1024)
+
+    def test_mirror(self):
+        """
+        the tree of the commit should be streamed out of the mirror
+        """
+        tree = io.BytesIO()
+        with tarfile.open(fileobj=tree, mode='w') as tar:
+            tarinfo = tarfile.TarInfo('src/wsgi.py')
+            tarinfo.size = 5
+            tar.addfile(tarinfo, io.BytesIO('app=1'))
+        tree.seek(0)
+
+        def members(commit_hash, prefix):
+            with tarfile.open(fileobj=tree, mode='r|') as archive:
+                for member in archive:
+                    yield member, archive.extractfile(member)
+
+        mirror = mock.Mock()
+        mirror.members.side_effect = members
+        context = DockerContext(
+            [{'name': 'Dockerfile', 'content': u'FROM python\n'}],
+            mirror=mirror, commit_hash='master',
+        )
+        with self.read(context) as tar:
+            self.assertEqual(tar.getnames(), ['Dockerfile', 'src/wsgi.py'])
+            self.assertEqual(tar.extractfile('src/wsgi.py').read(), 'app=1')
+        mirror.members.assert_called_with('master', 'src/')
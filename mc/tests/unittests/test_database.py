@@ -1,6 +1,8 @@
 from flask.ext.testing import TestCase
 from mc.app import create_app
 from mc.models import db, Commit, Build
+from mc.ingest import upsert_commits, postgres_upsert_statement
+from sqlalchemy.dialects import postgresql
 import datetime
 from dateutil.tz import tzlocal
 from sqlalchemy.exc import IntegrityError
@@ -109,3 +111,49 @@ class TestModels(TestCase):
         db.session.commit()
         self.assertIsNone(Build.query.first())
 
+    def test_upsert_commits(self):
+        """
+        upsert_commits should insert new commits once, and only add a tag to
+        existing commits that have none
+        """
+        existing = Commit(commit_hash='tagged', tag='v1.0.0', repository='r')
+        untagged = Commit(commit_hash='untagged', repository='r')
+        db.session.add_all([existing, untagged])
+        db.session.commit()
+
+        rows = [
+            dict(commit_hash='new', tag=None, repository='r',
+                 timestamp=datetime.datetime(2015, 6, 3, 12, 26, 57)),
+            dict(commit_hash='new', tag='v2.0.0', repository='r'),
+            dict(commit_hash='tagged', tag='v1.1.0', repository='r'),
+            dict(commit_hash='untagged', tag='v0.9.0', repository='r'),
+        ]
+        ids = upsert_commits(rows)
+        db.session.commit()
+        db.session.expire_all()
+
+        self.assertEqual(Commit.query.count(), 3)
+        self.assertEqual(ids['tagged'], existing.id)
+        self.assertEqual(ids['untagged'], untagged.id)
+        new = Commit.query.get(ids['new'])
+        self.assertEqual(new.tag, 'v2.0.0')
+        self.assertEqual(
+            new.timestamp, datetime.datetime(2015, 6, 3, 12, 26, 57)
+        )
+        self.assertEqual(Commit.query.get(ids['tagged']).tag, 'v1.0.0')
+        self.assertEqual(Commit.query.get(ids['untagged']).tag, 'v0.9.0')
+
+        # Redelivery is a no-op
+        self.assertEqual(upsert_commits(rows), ids)
+        self.assertEqual(upsert_commits([]), {})
+
+    def test_postgres_upsert_statement(self):
+        """
+        The postgres path should be a single INSERT ... ON CONFLICT statement
+        that keeps an existing tag
+        """
+        sql = str(postgres_upsert_statement([
+            dict(commit_hash='a', tag=None), dict(commit_hash='b', tag='t')
+        ]).compile(dialect=postgresql.dialect()))
+        self.assertIn('ON CONFLICT (commit_hash) DO UPDATE', sql)
+        self.assertIn('coalesce(commit.tag, excluded.tag)', sql)
@@ -0,0 +1,606 @@
+"""
+Test the test environments
+"""
+import os
+import socket
+import time
+import unittest
+import httpretty
+import mock
+from flask.ext.testing import TestCase
+from mc import app, environments
+from mc.environments import TestEnvironment, EnvironmentPool, \
+    environment_key, wait_until_ready, tcp_probe, consul_probe, \
+    postgres_probe, remove_environment, DEPENDENCY_LABEL
+from mc.exceptions import DependencyError
+from mc.tasks import make_test_environment, release_test_environment, \
+    postgres_dependency
+
+
+class FakeRunner(object):
+    """
+    Stands in for DockerRunner: takes `delay` seconds to pull and create its
+    container, and publishes its port on 1 + the container's port
+    """
+    delays = {}
+    torn_down = []
+    created = []
+
+    def __init__(self, image, name, **kwargs):
+        time.sleep(self.delays.get(image, 0))
+        self.image = image
+        self.name = name
+        self.kwargs = kwargs
+        self.container = {'Id': name}
+        self.client = mock.Mock()
+        self.client.port.side_effect = \
+            lambda container, port: [{'HostPort': str(port + 1)}]
+        self.started = False
+        self.created.append(self)
+
+    def start(self, callback=None):
+        self.started = True
+
+    def teardown(self):
+        self.torn_down.append(self.name)
+
+
+class TestTestEnvironment(unittest.TestCase):
+    """
+    Test starting the dependencies of a test environment
+    """
+
+    def setUp(self):
+        FakeRunner.delays = {'redis': 0.1, 'postgres': 0.2, 'consul': 0.1}
+        FakeRunner.torn_down = []
+        self.provisioned = []
+        self.ready = {}
+        self.probes = mock.patch.dict('mc.environments.PROBES', {
+            'tcp': lambda host, port: True,
+            'slow': lambda host, port: time.time() > self.ready[port],
+        })
+        self.probes.start()
+
+    def tearDown(self):
+        self.probes.stop()
+
+    def dependencies(self):
+        def provision(name):
+            def callback(endpoints):
+                self.provisioned.append((name, sorted(endpoints)))
+            return callback
+
+        return [
+            {'name': 'redis', 'image': 'redis', 'port': 6379},
+            {'name': 'consul', 'image': 'consul', 'port': 8500,
+             'requires': ['postgres'], 'callback': provision('consul')},
+            {'name': 'postgres', 'image': 'postgres', 'port': 5432,
+             'callback': provision('postgres')},
+        ]
+
+    def test_concurrent_start(self):
+        """
+        the dependencies should start concurrently, and be provisioned once
+        their requirements are
+        """
+        environment = TestEnvironment(
+            'test', self.dependencies(), runner_factory=FakeRunner
+        ).start()
+        # 0.2s for the slowest dependency, not 0.4s for all of them
+        self.assertLess(environment.ready_time, 0.35)
+        self.assertEqual(
+            self.provisioned,
+            [('postgres', ['consul', 'postgres', 'redis']),
+             ('consul', ['consul', 'postgres', 'redis'])]
+        )
+        summary = environment.summary()
+        self.assertEqual(
+            summary['dependencies']['postgres']['endpoint'],
+            ('localhost', 5433)
+        )
+        self.assertEqual(
+            summary['dependencies']['consul']['container'], 'consul-test'
+        )
+        self.assertIn(
+            'provision', summary['dependencies']['postgres']['durations']
+        )
+        runner = environment.runners['redis']
+        self.assertEqual(runner.kwargs['port_bindings'], {6379: None})
+        self.assertEqual(runner.kwargs['labels'], {DEPENDENCY_LABEL: 'redis'})
+        self.assertTrue(runner.started)
+
+    def test_snapshot(self):
+        """
+        the snapshot of a dependency should be taken once it is provisioned,
+        with its runner
+        """
+        snapshots = []
+        dependencies = self.dependencies()
+        dependencies[2]['snapshot'] = lambda endpoints, runner: \
+            snapshots.append((len(self.provisioned), runner.name))
+        environment = TestEnvironment(
+            'test', dependencies, runner_factory=FakeRunner
+        ).start()
+        self.assertEqual(snapshots, [(1, 'postgres-test')])
+        self.assertIn(
+            'snapshot', environment.summary()['dependencies']['postgres']
+            ['durations']
+        )
+
+    def test_readiness(self):
+        """
+        dependencies should only be provisioned once their probe succeeds
+        """
+        dependencies = self.dependencies()
+        dependencies[2]['probe'] = 'slow'
+        self.ready[5433] = time.time() + 0.5
+        TestEnvironment(
+            'test', dependencies, runner_factory=FakeRunner
+        ).start()
+        self.assertEqual(
+            [name for name, _ in self.provisioned], ['postgres', 'consul']
+        )
+        self.assertGreater(time.time(), self.ready[5433])
+
+    def test_failure(self):
+        """
+        a dependency that does not become ready should fail the environment,
+        its dependents should not be provisioned, and the environment should
+        be torn down
+        """
+        dependencies = self.dependencies()
+        dependencies[2]['probe'] = 'slow'
+        self.ready[5433] = time.time() + 60
+        environment = TestEnvironment(
+            'test', dependencies, timeout=0.3, runner_factory=FakeRunner
+        )
+        with self.assertRaisesRegexp(DependencyError, 'postgres: Not ready'):
+            environment.start()
+        self.assertEqual(self.provisioned, [])
+        self.assertEqual(
+            sorted(FakeRunner.torn_down),
+            ['consul-test', 'postgres-test', 'redis-test']
+        )
+
+    def test_graph(self):
+        """
+        unknown and circular requirements should be refused
+        """
+        dependencies = self.dependencies()
+        dependencies[0]['requires'] = ['mongo']
+        with self.assertRaisesRegexp(DependencyError, 'unknown mongo'):
+            TestEnvironment('test', dependencies)
+        dependencies[0]['requires'] = []
+        dependencies[2]['requires'] = ['consul']
+        with self.assertRaisesRegexp(DependencyError, 'Circular'):
+            TestEnvironment('test', dependencies)
+
+
+class TestProbes(unittest.TestCase):
+    """
+    Test the readiness probes
+    """
+
+    def test_backoff(self):
+        """
+        the delay between attempts should double, up to max_delay
+        """
+        results = iter([False] * 6 + [True])
+        sleep = mock.Mock()
+        attempts = wait_until_ready(
+            lambda: next(results), delay=0.1, max_delay=1.0, sleep=sleep
+        )
+        self.assertEqual(attempts, 7)
+        self.assertEqual(
+            [c[0][0] for c in sleep.call_args_list],
+            [0.1, 0.2, 0.4, 0.8, 1.0, 1.0]
+        )
+        with self.assertRaises(DependencyError):
+            wait_until_ready(lambda: False, timeout=0.05, delay=0.01)
+
+    def test_tcp_probe(self):
+        """
+        the tcp probe should succeed once the port accepts connections
+        """
+        server = socket.socket()
+        server.bind(('localhost', 0))
+        port = server.getsockname()[1]
+        self.assertFalse(tcp_probe('localhost', port))
+        server.listen(1)
+        self.assertTrue(tcp_probe('localhost', port))
+        server.close()
+
+    @httpretty.activate
+    def test_consul_probe(self):
+        """
+        the consul probe should succeed once consul elected a leader
+        """
+        url = 'http://localhost:8500/v1/status/leader'
+        httpretty.register_uri(httpretty.GET, url, body='""')
+        self.assertFalse(consul_probe('localhost', 8500))
+        httpretty.register_uri(httpretty.GET, url, body='"10.0.0.1:8300"')
+        self.assertTrue(consul_probe('localhost', 8500))
+
+    @mock.patch('mc.environments.psycopg2')
+    def test_postgres_probe(self, psycopg2):
+        """
+        the postgres probe should connect with the credentials of the
+        DEPENDENCIES config
+        """
+        cursor = psycopg2.connect.return_value.cursor.return_value
+        cursor.fetchone.return_value = (1,)
+        dependencies = {'POSTGRES': {'USERNAME': 'mc', 'PASSWORD': 'secret'}}
+        self.assertTrue(
+            postgres_probe('localhost', '5433', dependencies=dependencies)
+        )
+        _, kwargs = psycopg2.connect.call_args
+        self.assertEqual(kwargs['port'], 5433)
+        self.assertEqual(kwargs['user'], 'mc')
+        self.assertEqual(kwargs['password'], 'secret')
+
+
+class TestMakeTestEnvironment(TestCase):
+    """
+    Test the make_test_environment task
+    """
+
+    def create_app(self):
+        return app.create_app()
+
+    @mock.patch('mc.tasks.ConsulProvisioner')
+    @mock.patch('mc.tasks.PostgresLoader')
+    @mock.patch('mc.tasks.PostgresProvisioner')
+    @mock.patch('mc.environments.DockerRunner', FakeRunner)
+    def test_make_test_environment(self, Postgres, Loader, Consul):
+        """
+        consul should be provisioned with the endpoint of postgres
+        """
+        FakeRunner.delays = {}
+        Postgres.known_services.return_value = ['adsws', 'biblib']
+        Consul.known_services.return_value = ['adsws']
+        with mock.patch.dict('mc.environments.PROBES', {
+            'tcp': lambda host, port: True,
+            'postgres': lambda host, port: True,
+            'consul': lambda host, port: True,
+        }):
+            summary = make_test_environment('test', {
+                'services': ['adsws', 'biblib'],
+                'pull_policy': 'never',
+                'refresh': True,
+            })
+        self.assertEqual(
+            sorted(summary['dependencies']), ['consul', 'postgres', 'redis']
+        )
+        self.assertFalse(Postgres.called)
+        args, kwargs = Loader.call_args
+        self.assertEqual(args, (['adsws', 'biblib'],))
+        self.assertEqual(kwargs['dependencies']['POSTGRES']['PORT'], 5433)
+        args, kwargs = Consul.call_args
+        self.assertEqual(args, (['adsws'],))
+        self.assertEqual(kwargs['dependencies']['CONSUL']['PORT'], 8501)
+        self.assertEqual(kwargs['dependencies']['POSTGRES']['PORT'], 5433)
+        for runner in FakeRunner.created[-3:]:
+            self.assertEqual(runner.kwargs['pull_policy'], 'never')
+            self.assertTrue(runner.kwargs['refresh'])
+
+
+class TestPostgresSnapshotDependency(TestCase):
+    """
+    Test the postgres dependency of test environments with image snapshots
+    """
+
+    def create_app(self):
+        app_ = app.create_app()
+        app_.config['POSTGRES_SNAPSHOT'] = 'image'
+        return app_
+
+    @mock.patch('mc.tasks.docker_clients')
+    @mock.patch('mc.tasks.image_inventory')
+    def test_postgres_dependency(self, image_inventory, docker_clients):
+        """
+        postgres should be provisioned and committed without a snapshot
+        image, and run from it without provisioning otherwise
+        """
+        images = {'postgres': 'sha256:base'}
+        image_inventory.return_value.get.side_effect = images.get
+        image_inventory.return_value.__contains__.side_effect = \
+            lambda image: image in images
+        dependency = postgres_dependency(['adsws', 'unknown'])
+        self.assertEqual(dependency['image'], 'postgres')
+        self.assertIn('callback', dependency)
+        self.assertEqual(
+            dependency['runner']['environment']['PGDATA'],
+            '/var/lib/postgresql/snapshot'
+        )
+        snapshot = dependency['snapshot'].keywords['snapshot']
+        self.assertEqual(snapshot.services, ['adsws'])
+        self.assertEqual(snapshot.base, 'sha256:base')
+
+        images[snapshot.tag] = 'sha256:snapshot'
+        dependency = postgres_dependency(['adsws'])
+        self.assertEqual(dependency['image'], snapshot.tag)
+        self.assertEqual(dependency['pull_policy'], 'never')
+        self.assertNotIn('callback', dependency)
+        self.assertNotIn('snapshot', dependency)
+
+        # A new postgres image makes a new snapshot
+        images['postgres'] = 'sha256:update'
+        dependency = postgres_dependency(['adsws'])
+        self.assertEqual(dependency['image'], 'postgres')
+        self.assertNotEqual(
+            dependency['snapshot'].keywords['snapshot'].tag, snapshot.tag
+        )
+
+        # The snapshot waits for the postgres image to be pulled
+        del images['postgres']
+        dependency = postgres_dependency(['adsws'])
+        self.assertIn('callback', dependency)
+        self.assertNotIn('snapshot', dependency)
+
+        self.app.config['POSTGRES_SNAPSHOT'] = None
+        self.assertNotIn('snapshot', postgres_dependency(['adsws']))
+
+    def test_template_server(self):
+        """
+        template snapshots should require a warm pool reusing its servers
+        """
+        self.app.config['POSTGRES_SNAPSHOT'] = 'template'
+        with self.assertRaises(ValueError):
+            postgres_dependency(['adsws'])
+        self.app.config['WARM_POOL_SIZE'] = 1
+        self.app.config['WARM_POOL_RESET'] = 'destroy'
+        with self.assertRaises(ValueError):
+            postgres_dependency(['adsws'])
+        self.app.config['WARM_POOL_RESET'] = 'reset'
+        self.assertNotIn('snapshot', postgres_dependency(['adsws']))
+
+        self.app.config['POSTGRES_SNAPSHOT'] = 'volume'
+        with self.assertRaises(ValueError):
+            postgres_dependency(['adsws'])
+
+
+class TestWarmPoolTask(TestCase):
+    """
+    Test make_test_environment with a warm pool
+    """
+
+    def create_app(self):
+        app_ = app.create_app()
+        app_.config['WARM_POOL_SIZE'] = 1
+        app_.config['WARM_POOL_RESET'] = 'reuse'
+        return app_
+
+    def tearDown(self):
+        for pool in environments._pools.values():
+            pool.close()
+        environments._pools.clear()
+
+    @mock.patch('mc.tasks.ConsulProvisioner')
+    @mock.patch('mc.tasks.PostgresLoader')
+    @mock.patch('mc.tasks.PostgresProvisioner')
+    @mock.patch('mc.environments.DockerRunner', FakeRunner)
+    def test_warm_pool(self, Postgres, Loader, Consul):
+        """
+        the second environment should come from the pool, and a released
+        environment should go back to it
+        """
+        FakeRunner.delays = {}
+        Postgres.known_services.return_value = ['adsws']
+        Consul.known_services.return_value = ['adsws']
+        config = {'services': ['adsws']}
+        with mock.patch.dict('mc.environments.PROBES', {
+            'tcp': lambda host, port: True,
+            'postgres': lambda host, port: True,
+            'consul': lambda host, port: True,
+        }):
+            first = make_test_environment('test-1', dict(config))
+            pool = environments.environment_pool(self.app.config)
+            key = pool.in_use['test-1'][0]
+            pool.fill(key, wait=True)
+            second = make_test_environment('test-2', dict(config))
+            pool.fill(key, wait=True)
+        self.assertFalse(first['pooled'])
+        self.assertTrue(second['pooled'])
+        self.assertTrue(
+            second['dependencies']['redis']['container'].startswith('redis-warm-')
+        )
+        container = second['dependencies']['redis']['container']
+        self.assertEqual(
+            [r.name for r in FakeRunner.created
+             if r.container['Id'] == container],
+            ['redis-test-2']
+        )
+        self.assertTrue(release_test_environment('test-1'))
+        self.assertEqual(pool.metrics()[key]['idle'], 1)
+        self.assertEqual(pool.metrics()[key]['in_use'], 1)
+        pool.close()
+
+    @mock.patch('mc.tasks.remove_environment')
+    @mock.patch('mc.tasks.docker_clients')
+    def test_release_elsewhere(self, docker_clients, remove_environment):
+        """
+        the environment of a test handed out by another process should be
+        removed by name
+        """
+        remove_environment.return_value = 3
+        self.assertFalse(release_test_environment('test-3'))
+        remove_environment.assert_called_once_with(
+            docker_clients.get.return_value, 'test-3'
+        )
+
+
+class FakeEnvironment(object):
+    """
+    Stands in for a started TestEnvironment
+    """
+    def __init__(self, environment_id):
+        self.id = environment_id
+        self.warm_id = environment_id
+        self.resets = 0
+        self.torn_down = False
+
+    def rename(self, environment_id):
+        self.id = environment_id
+
+    def reset(self):
+        self.resets += 1
+
+    def teardown(self):
+        self.torn_down = True
+
+    def summary(self):
+        return {'id': self.id}
+
+
+class TestEnvironmentPool(unittest.TestCase):
+    """
+    Test the warm pool of test environments
+    """
+
+    def pool(self, **kwargs):
+        pool = EnvironmentPool(**kwargs)
+        pool.prewarm('key', FakeEnvironment)
+        return pool
+
+    def test_hits(self):
+        """
+        a warm environment should be handed out, and the pool refilled
+        """
+        pool = self.pool(size=1)
+        self.assertEqual(pool.metrics()['key']['idle'], 1)
+        environment, hit = pool.acquire('key', FakeEnvironment, 'test-1')
+        self.assertTrue(hit)
+        self.assertTrue(environment.warm_id.startswith('warm-key-'))
+        # Renamed after the test it is handed out to
+        self.assertEqual(environment.id, 'test-1')
+        pool.fill('key', wait=True)
+        environment, hit = pool.acquire('key', FakeEnvironment, 'test-2')
+        self.assertTrue(hit)
+        # Nothing warm yet for another key
+        environment, hit = pool.acquire('other', FakeEnvironment, 'test-3')
+        self.assertFalse(hit)
+        self.assertEqual(environment.id, 'test-3')
+        metrics = pool.metrics()
+        self.assertEqual(metrics['key']['hits'], 2)
+        self.assertEqual(metrics['key']['in_use'], 2)
+        self.assertEqual(metrics['other']['misses'], 1)
+        self.assertEqual(metrics['other']['hit_rate'], 0.0)
+        pool.close()
+
+    def test_reset_policies(self):
+        """
+        released environments should be destroyed, reset or reused
+        """
+        for policy, resets, kept in [('destroy', 0, False), ('reset', 1, True),
+                                     ('reuse', 0, True)]:
+            pool = self.pool(size=1, reset_policy=policy)
+            environment, _ = pool.acquire('key', FakeEnvironment, 'test')
+            pool.fill('key', wait=True)
+            # The pool is full again: the released one would be one too many
+            pool.size = 2
+            pool.release('test')
+            self.assertEqual(environment.resets, resets, msg=policy)
+            self.assertEqual(environment.torn_down, not kept, msg=policy)
+            self.assertEqual(
+                environment in [e for e, _ in pool.idle['key']], kept
+            )
+            pool.close()
+        with self.assertRaises(ValueError):
+            EnvironmentPool(reset_policy='ignore')
+
+    def test_idle_eviction(self):
+        """
+        environments idle for too long should be destroyed
+        """
+        pool = self.pool(size=2, max_idle=60)
+        environment, since = pool.idle['key'][0]
+        pool.idle['key'][0] = (environment, since - 61)
+        self.assertEqual(pool.evict_idle(), 1)
+        self.assertTrue(environment.torn_down)
+        self.assertEqual(pool.metrics()['key']['evicted'], 1)
+        self.assertEqual(pool.metrics()['key']['idle'], 1)
+        pool.close()
+
+    def test_evict_interval(self):
+        """
+        idle environments should be evicted in the background
+        """
+        pool = self.pool(size=1, max_idle=0, evict_interval=0.01)
+        environment, _ = pool.idle['key'][0]
+        deadline = time.time() + 5
+        while not environment.torn_down and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(environment.torn_down)
+        pool.close()
+        self.assertTrue(pool._stopped.is_set())
+
+    def test_warm_ids(self):
+        """
+        warm environments should have ids unique across processes, which
+        all start from the same state
+        """
+        pools = [self.pool(size=2), self.pool(size=2)]
+        ids = [e.warm_id for pool in pools for e, _ in pool.idle['key']]
+        self.assertEqual(len(set(ids)), 4)
+        for warm_id in ids:
+            self.assertIn(
+                '-{}-{}-'.format(socket.gethostname(), os.getpid()), warm_id
+            )
+        for pool in pools:
+            pool.close()
+
+    def test_remove_environment(self):
+        """
+        the containers of an environment should be found by name and label
+        """
+        client = mock.Mock()
+        client.containers.return_value = [
+            {'Id': 'a', 'Names': ['/redis-test-1'],
+             'Labels': {DEPENDENCY_LABEL: 'redis'}},
+            {'Id': 'b', 'Names': ['/postgres-test-1'],
+             'Labels': {DEPENDENCY_LABEL: 'postgres'}},
+            {'Id': 'c', 'Names': ['/redis-test-11'],
+             'Labels': {DEPENDENCY_LABEL: 'redis'}},
+            {'Id': 'd', 'Names': ['/redis-warm-key-test-1'],
+             'Labels': {DEPENDENCY_LABEL: 'redis'}},
+        ]
+        self.assertEqual(remove_environment(client, 'test-1'), 2)
+        self.assertEqual(
+            [args for args, _ in client.remove_container.call_args_list],
+            [('a',), ('b',)]
+        )
+        _, kwargs = client.containers.call_args
+        self.assertEqual(kwargs['filters'], {'label': DEPENDENCY_LABEL})
+
+    def test_environment_key(self):
+        """
+        environments should be interchangeable if their dependencies and
+        services are, whatever their callbacks
+        """
+        dependencies = [
+            {'name': 'postgres', 'image': 'postgres', 'callback': len},
+            {'name': 'redis', 'image': 'redis'},
+        ]
+        key = environment_key(dependencies, ['adsws', 'biblib'])
+        self.assertEqual(
+            key, environment_key(dependencies[::-1], ['biblib', 'adsws'])
+        )
+        self.assertNotEqual(key, environment_key(dependencies, ['adsws']))
+        dependencies[1]['image'] = 'redis:3'
+        self.assertNotEqual(
+            key, environment_key(dependencies, ['adsws', 'biblib'])
+        )
+
+    def test_reset_order(self):
+        """
+        dependencies should be reset after their requirements
+        """
+        resets = []
+        dependencies = [
+            {'name': 'consul', 'image': 'consul', 'requires': ['postgres'],
+             'reset': lambda endpoints: resets.append('consul')},
+            {'name': 'postgres', 'image': 'postgres',
+             'reset': lambda endpoints: resets.append('postgres')},
+        ]
+        TestEnvironment('test', dependencies).reset()
+        self.assertEqual(resets, ['postgres', 'consul'])
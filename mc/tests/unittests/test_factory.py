@@ -1,11 +1,16 @@
 """
 Test factory (app.py)
 """
+import os
+import shutil
+import tempfile
+import time
 import unittest
 from mc import app
 from flask import Flask
 from celery import Celery
 import jinja2
+import mock
 
 
 class TestFactory(unittest.TestCase):
@@ -27,4 +32,140 @@ class TestFactory(unittest.TestCase):
     def test_create_jinja2(self):
         e = app.create_jinja2()
         self.assertIsInstance(e, jinja2.Environment)
-        self.assertIsInstance(e.loader, jinja2.FileSystemLoader)
\ No newline at end of file
+        self.assertIsInstance(e.loader, jinja2.FileSystemLoader)
+
+    def test_shared_jinja2(self):
+        """
+        one environment should be shared per template directory
+        """
+        self.assertIs(app.create_jinja2(), app.create_jinja2())
+        self.assertFalse(app.create_jinja2().auto_reload)
+        other = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, other)
+        self.assertIsNot(app.create_jinja2(other), app.create_jinja2())
+
+
+class TestTemplateCache(unittest.TestCase):
+    """
+    Test the compiled template cache
+    """
+
+    def setUp(self):
+        self.template_dir = tempfile.mkdtemp()
+        self.bytecode_dir = tempfile.mkdtemp()
+        self.write('hello {{ name }}')
+        self.app = app.create_app(name='unittest')
+        self.app.config['JINJA2_BYTECODE_DIR'] = self.bytecode_dir
+
+    def tearDown(self):
+        app._jinja2_environments.pop(self.template_dir, None)
+        shutil.rmtree(self.template_dir)
+        shutil.rmtree(self.bytecode_dir)
+
+    def write(self, content):
+        path = os.path.join(self.template_dir, 'hello.template')
+        with open(path, 'w') as f:
+            f.write(content)
+        # Make the change visible to a modification time based check
+        mtime = time.time() + len(content)
+        os.utime(path, (mtime, mtime))
+
+    def test_bytecode_cache(self):
+        """
+        compiled templates should be cached on disk, and re-used by a new
+        environment
+        """
+        with self.app.app_context():
+            env = app.create_jinja2(self.template_dir)
+        self.assertEqual(
+            env.get_template('hello.template').render(name='mc'), 'hello mc'
+        )
+        self.assertEqual(len(os.listdir(self.bytecode_dir)), 1)
+
+        app._jinja2_environments.pop(self.template_dir)
+        with self.app.app_context():
+            env = app.create_jinja2(self.template_dir)
+        with mock.patch.object(env, 'compile') as compile:
+            env.get_template('hello.template')
+            self.assertFalse(compile.called)
+
+    def test_refresh(self):
+        """
+        templates should only be compiled again once they changed on disk and
+        the cache was refreshed
+        """
+        env = app.create_jinja2(self.template_dir)
+        self.assertEqual(
+            env.get_template('hello.template').render(name='mc'), 'hello mc'
+        )
+        self.assertFalse(app.refresh_jinja2(self.template_dir))
+
+        self.write('bye {{ name }}')
+        self.assertEqual(
+            env.get_template('hello.template').render(name='mc'), 'hello mc'
+        )
+        self.assertFalse(app.refresh_jinja2(self.template_dir, interval=60))
+        self.assertTrue(app.refresh_jinja2(self.template_dir))
+        self.assertEqual(
+            env.get_template('hello.template').render(name='mc'), 'bye mc'
+        )
+
+
+class TestTemplateIndex(unittest.TestCase):
+    """
+    Test the index of the templates
+    """
+
+    def setUp(self):
+        self.template_dir = tempfile.mkdtemp()
+        for path in [
+            'docker/dockerfiles/adsws.dockerfile.template',
+            'docker/cron/adsws/cronjob.sh',
+            'docker/cron/adsws/.gitkeep',
+            'docker/etc/adsws/common.py.monkeypatch',
+            'consul/base.consul.template',
+            'consul/adsws/adsws.config.json',
+            'postgres/biblib/biblib.schema.sql',
+        ]:
+            self.write(path)
+
+    def tearDown(self):
+        app._jinja2_environments.pop(self.template_dir, None)
+        shutil.rmtree(self.template_dir)
+
+    def write(self, path):
+        path = os.path.join(self.template_dir, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(path)
+
+    def test_index(self):
+        """
+        the templates should be indexed by repository and service
+        """
+        index = app.template_index(self.template_dir)
+        self.assertEqual(index.repositories(), ['adsws'])
+        self.assertEqual(
+            index.files['adsws'],
+            ['docker/cron/adsws/cronjob.sh',
+             'docker/etc/adsws/common.py.monkeypatch']
+        )
+        self.assertEqual(index.consul.keys(), ['adsws'])
+        self.assertEqual(
+            index.postgres, {'biblib': ['postgres/biblib/biblib.schema.sql']}
+        )
+        self.assertIs(index, app.template_index(self.template_dir))
+
+    def test_refresh(self):
+        """
+        the index should be rebuilt when the templates change
+        """
+        index = app.template_index(self.template_dir)
+        self.write('docker/dockerfiles/biblib.dockerfile.template')
+        self.assertIs(index, app.template_index(self.template_dir))
+        self.assertTrue(app.refresh_jinja2(self.template_dir))
+        self.assertEqual(
+            app.template_index(self.template_dir).repositories(),
+            ['adsws', 'biblib']
+        )
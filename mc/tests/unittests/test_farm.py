@@ -0,0 +1,246 @@
+"""
+Test the build farm
+"""
+import shutil
+import tempfile
+import threading
+import unittest
+import mock
+import requests
+from requests.packages.urllib3.exceptions import ProtocolError
+from flask.ext.testing import TestCase
+from mc import app
+from mc.buildlogs import BuildLog
+from mc.exceptions import NoDockerHostError
+from mc.farm import DockerHostPool, docker_host_pool
+from mc.models import db, Commit, Build
+from mc.tasks import run_build
+
+
+class FakeDaemon(object):
+    """
+    Stands in for the docker.Client of one daemon of the farm
+    """
+    def __init__(self, ncpu=2, memory=4 * 1024 ** 3):
+        self.ncpu = ncpu
+        self.memory = memory
+        self.up = True
+        self.builds = []
+
+    def info(self):
+        if not self.up:
+            raise requests.exceptions.ConnectionError("connection refused")
+        return {'NCPU': self.ncpu, 'MemTotal': self.memory}
+
+
+class FakeFarm(object):
+    """
+    client_factory of a farm of fake daemons
+    """
+    def __init__(self, **daemons):
+        self.daemons = daemons
+
+    def __call__(self, url):
+        return self.daemons[url]
+
+
+class TestDockerHostPool(unittest.TestCase):
+    """
+    Test the DockerHostPool
+    """
+
+    def setUp(self):
+        self.farm = FakeFarm(
+            a=FakeDaemon(ncpu=2), b=FakeDaemon(ncpu=4), c=FakeDaemon(ncpu=1)
+        )
+        self.pool = DockerHostPool(
+            ['a', 'b', 'c'], check_interval=60, client_factory=self.farm
+        )
+
+    def test_capacity(self):
+        """
+        each daemon should be sized by its resources
+        """
+        self.assertEqual(self.pool.capacity('a'), 2)
+        self.assertEqual(self.pool.capacity(), 7)
+        self.farm.daemons['b'].up = False
+        self.pool.check('b')
+        self.assertEqual(self.pool.capacity(), 3)
+
+    def test_least_loaded(self):
+        """
+        builds of new repositories should go to the least loaded daemon
+        """
+        placed = [self.pool.acquire(repo) for repo in 'wxyz']
+        self.assertEqual(placed, ['a', 'b', 'c', 'b'])
+        self.assertEqual(
+            self.pool.utilisation(), {'a': (1, 2), 'b': (2, 4), 'c': (1, 1)}
+        )
+
+    def test_sticky(self):
+        """
+        builds of a repository should go back to the daemon that built it,
+        unless it is full
+        """
+        self.assertEqual(self.pool.acquire('adsws'), 'a')
+        self.pool.release('a')
+        self.assertEqual(self.pool.acquire('biblib'), 'a')
+        self.assertEqual(self.pool.acquire('adsws'), 'a')
+        self.assertEqual(self.pool.acquire('adsws'), 'b')
+        self.assertEqual(self.pool.sticky['adsws'], 'b')
+
+    def test_health_check(self):
+        """
+        unhealthy daemons should not be used, and all daemons being down
+        should raise NoDockerHostError
+        """
+        self.farm.daemons['a'].up = False
+        self.assertEqual(self.pool.acquire('adsws'), 'b')
+        for daemon in self.farm.daemons.values():
+            daemon.up = False
+        self.pool.checked = dict((url, None) for url in self.pool.urls)
+        with self.assertRaises(NoDockerHostError):
+            self.pool.acquire('adsws')
+
+    def test_wait_for_slot(self):
+        """
+        acquire should wait for a slot when every daemon is full
+        """
+        pool = DockerHostPool(['c'], client_factory=self.farm)
+        self.assertEqual(pool.acquire('adsws'), 'c')
+        threading.Timer(0.05, pool.release, args=('c',)).start()
+        self.assertEqual(pool.acquire('biblib'), 'c')
+
+    def test_failover(self):
+        """
+        a build whose daemon goes away should be run again on another
+        daemon, and the daemon should not be used until it is healthy
+        """
+        def build(url):
+            daemon = self.farm.daemons[url]
+            if url == 'a':
+                daemon.up = False
+                raise requests.exceptions.ConnectionError("daemon went away")
+            daemon.builds.append('adsws')
+            return url
+
+        self.assertEqual(self.pool.run('adsws', build), 'b')
+        self.assertEqual(self.farm.daemons['b'].builds, ['adsws'])
+        self.assertNotIn('a', self.pool.healthy())
+        self.assertEqual(
+            self.pool.utilisation(), {'a': (0, 0), 'b': (0, 4), 'c': (0, 1)}
+        )
+
+    def test_broken_stream(self):
+        """
+        a daemon going away while streaming the output of a build should
+        fail the build over too
+        """
+        errors = [
+            requests.exceptions.ChunkedEncodingError("connection broken"),
+            ProtocolError("connection broken"),
+        ]
+
+        def build(url):
+            if errors:
+                self.farm.daemons[url].up = False
+                raise errors.pop(0)
+            return url
+
+        self.assertEqual(self.pool.run('adsws', build), 'c')
+        self.assertEqual(self.pool.healthy(), ['c'])
+
+    def test_build_error(self):
+        """
+        other errors are the build's: they should not fail over
+        """
+        build = mock.Mock(side_effect=ValueError("bad Dockerfile"))
+        with self.assertRaises(ValueError):
+            self.pool.run('adsws', build)
+        build.assert_called_once_with('a')
+        self.assertEqual(self.pool.load['a'], 0)
+        self.assertIn('a', self.pool.healthy())
+
+
+class TestFarmBuild(TestCase):
+    """
+    Test builds on the farm
+    """
+
+    def create_app(self):
+        app_ = app.create_app()
+        app_.config['SQLALCHEMY_DATABASE_URI'] = "sqlite://"
+        app_.config['DOCKER_HOSTS'] = ['tcp://build1:2375', 'tcp://build2:2375']
+        return app_
+
+    def setUp(self):
+        db.create_all()
+        self.commit = Commit(commit_hash='master', repository='adsws')
+        db.session.add(self.commit)
+        db.session.commit()
+        self.pool = docker_host_pool(self.app.config)
+        self.pool.client_factory = FakeFarm(**{
+            'tcp://build1:2375': FakeDaemon(),
+            'tcp://build2:2375': FakeDaemon(),
+        })
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    @mock.patch('mc.tasks.DockerImageBuilder')
+    def test_failover(self, Builder):
+        """
+        run_build should build on the second daemon if the first goes away
+        """
+        def builder(*args, **kwargs):
+            instance = mock.Mock(
+                docker_url=kwargs['docker_url'], pushed=False, built=False,
+                tag='adsabs/adsws:master',
+            )
+            instance.timer.total = 1.0
+            instance.fingerprint.return_value = '0' * 64
+            instance.stats = None
+            if kwargs['docker_url'] == 'tcp://build1:2375':
+                instance.run.side_effect = \
+                    requests.exceptions.ConnectionError("gone")
+            else:
+                def run():
+                    instance.built = instance.pushed = True
+                instance.run.side_effect = run
+            return instance
+        Builder.side_effect = builder
+
+        build = Build(commit=self.commit, status='queued')
+        run_build(build)
+        self.assertEqual(
+            [kw['docker_url'] for _, kw in Builder.call_args_list],
+            ['tcp://build1:2375', 'tcp://build2:2375']
+        )
+        self.assertTrue(build.pushed)
+        self.assertEqual(build.status, 'finished')
+        self.assertEqual(self.pool.sticky['adsws'], 'tcp://build2:2375')
+
+    @mock.patch('mc.tasks.DockerImageBuilder')
+    def test_requeue(self, Builder):
+        """
+        a build without any daemon should be queued again, and its log
+        should say so, so that its followers stop
+        """
+        self.app.config['BUILD_LOG_DIR'] = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.app.config['BUILD_LOG_DIR'])
+        for daemon in self.pool.client_factory.daemons.values():
+            daemon.up = False
+        self.pool.checked = dict((url, None) for url in self.pool.urls)
+        build = Build(commit=self.commit, status='queued')
+        db.session.add(build)
+        db.session.commit()
+
+        run_build(build)
+        self.assertEqual(build.status, 'queued')
+        self.assertFalse(Builder.called)
+        events = BuildLog.for_build(self.app.config, build.id).read()
+        self.assertEqual(
+            [(e['type'], e.get('status')) for e in events],
+            [('status', 'running'), ('error', None), ('status', 'queued')]
+        )
@@ -0,0 +1,149 @@
+"""
+Test mirrors.py
+"""
+import io
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import unittest
+from mc.mirrors import GitMirror
+from mc.builders import DockerImageBuilder
+from mc.contexts import DockerContext
+from mc.models import Commit
+from mc.exceptions import BuildError
+
+
+def git(repo, *args):
+    """
+    run a git command in a working copy
+    """
+    return subprocess.check_output(
+        ['git', '-C', repo, '-c', 'user.name=unittest',
+         '-c', 'user.email=unittest@localhost'] + list(args)
+    ).strip()
+
+
+class TestGitMirror(unittest.TestCase):
+    """
+    Test the GitMirror against a local repository, without network access
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.upstream = os.path.join(self.tmp, 'upstream')
+        git(self.tmp, 'init', '--quiet', self.upstream)
+        self.commit('requirements.txt', 'flask\n')
+        self.first = self.commit('wsgi.py', 'application = None\n')
+        self.mirror = GitMirror(
+            'unittest-repo', os.path.join(self.tmp, 'mirrors'), self.upstream
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def commit(self, name, content):
+        """
+        commit a file to the upstream repository
+        :return: the commit hash
+        """
+        with open(os.path.join(self.upstream, name), 'w') as f:
+            f.write(content)
+        git(self.upstream, 'add', name)
+        git(self.upstream, 'commit', '--quiet', '-m', name)
+        return git(self.upstream, 'rev-parse', 'HEAD')
+
+    def export(self, commit_hash):
+        """
+        export a commit, return the tarfile's names and wsgi.py content
+        """
+        context = DockerContext(
+            [], mirror=self.mirror, commit_hash=commit_hash
+        )
+        with tarfile.open(fileobj=io.BytesIO(context.tobytes())) as tar:
+            return tar.getnames(), tar.extractfile('src/wsgi.py').read()
+
+    def test_clone_fetch_export(self):
+        """
+        The mirror is cloned once, fetched only for unknown commits, and the
+        exported tree matches the requested commit
+        """
+        self.assertFalse(self.mirror.has_commit(self.first))
+        names, wsgi = self.export(self.first)
+        self.assertIn('src/requirements.txt', names)
+        self.assertEqual(wsgi, 'application = None\n')
+        self.assertEqual(
+            self.mirror.timer.durations.keys(), ['clone', 'export']
+        )
+
+        # Known commits do not need the upstream
+        second = self.commit('wsgi.py', 'application = True\n')
+        self.export(self.first)
+        self.assertNotIn('fetch', self.mirror.timer.durations)
+
+        names, wsgi = self.export(second)
+        self.assertEqual(wsgi, 'application = True\n')
+        self.assertIn('fetch', self.mirror.timer.durations)
+
+        with self.assertRaises(BuildError):
+            self.mirror.ensure('0' * 40)
+
+    def test_builder_context(self):
+        """
+        A builder with a mirror sends the source in its context and copies it
+        instead of cloning it within the container
+        """
+        builder = DockerImageBuilder(
+            Commit(commit_hash=self.first, repository='adsws'),
+            mirror=self.mirror,
+        )
+        builder.render_templates()
+        dockerfile = builder.files[0]['content']
+        self.assertIn('COPY src /app', dockerfile)
+        self.assertNotIn('git clone', dockerfile)
+        builder.create_docker_context()
+        with tarfile.open(fileobj=io.BytesIO(builder.tarfile.tobytes())) as tar:
+            names = tar.getnames()
+            self.assertEqual(
+                tar.extractfile('requirements.txt').read(), 'flask\n'
+            )
+        self.assertIn('Dockerfile', names)
+        self.assertIn('src/wsgi.py', names)
+        # Timed for the log line of the build
+        self.assertIn('export', self.mirror.timer.durations)
+
+        # The dependencies are installed before the source is copied, in a
+        # layer keyed on the content of requirements.txt only
+        self.assertLess(
+            dockerfile.index('pip install -r /tmp/requirements.txt'),
+            dockerfile.index('COPY src /app')
+        )
+        # and removed in the same layer, not to stay in the image
+        self.assertIn(
+            'pip install -r /tmp/requirements.txt && rm /tmp/requirements.txt',
+            dockerfile
+        )
+        second = self.commit('wsgi.py', 'application = True\n')
+        third = self.commit('requirements.txt', 'flask\nrequests\n')
+
+        def install_line(commit_hash):
+            builder = DockerImageBuilder(
+                Commit(commit_hash=commit_hash, repository='adsws'),
+                mirror=self.mirror,
+            )
+            builder.render_templates()
+            return [l for l in builder.files[0]['content'].splitlines()
+                    if 'pip install' in l][0]
+
+        self.assertEqual(install_line(self.first), install_line(second))
+        self.assertNotEqual(install_line(second), install_line(third))
+
+    def test_read(self):
+        """
+        read() returns the content of a file at a commit, or None
+        """
+        self.assertEqual(
+            self.mirror.read(self.first, 'requirements.txt'), 'flask\n'
+        )
+        self.assertIsNone(self.mirror.read(self.first, 'setup.py'))
@@ -1,10 +1,18 @@
 """
 Test provisioners.py
 """
+import glob
+import gzip
+import os
+import re
+import shutil
+import tempfile
 import unittest
+import mock
+import psycopg2
 from flask import current_app
 from mc.provisioners import ScriptProvisioner, PostgresProvisioner, \
-    ConsulProvisioner
+    ConsulProvisioner, PostgresLoader, PostgresSnapshot
 from mc.exceptions import UnknownServiceError
 from mc.app import create_app
 
@@ -78,6 +86,262 @@ class TestPostgresProvisioner(unittest.TestCase):
                 PostgresProvisioner.get_cli_params()
 
 
+class TestPostgresLoader(unittest.TestCase):
+    """
+    Test the in process postgres loader
+    """
+
+    def setUp(self):
+        self.template_dir = os.path.join(tempfile.mkdtemp(), 'templates')
+        shutil.copytree(ScriptProvisioner.template_dir, self.template_dir)
+        self.copied = []
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.template_dir))
+
+    def copy_expert(self, cursor):
+        """
+        :return: side effect of copy_expert that reads the data like
+            psycopg2, and sets the rowcount of the cursor
+        """
+        def copy_expert(statement, stream, size=8192):
+            data = ''.join(iter(lambda: stream.read(size), ''))
+            self.copied.append((statement, data))
+            cursor.rowcount = data.count('\n')
+        return copy_expert
+
+    def test_unknown_service(self):
+        """
+        Passing an unknown service should raise UnknownServiceError
+        """
+        with self.assertRaisesRegexp(UnknownServiceError, "unknown-service"):
+            PostgresLoader("unknown-service")
+
+    @mock.patch('mc.provisioners.psycopg2')
+    def test_schema(self, psycopg2):
+        """
+        the statements of a dump should be run in one transaction, and its
+        COPY blocks streamed to COPY
+        """
+        conn = psycopg2.connect.return_value
+        cursor = conn.cursor.return_value
+        cursor.fetchone.return_value = None
+        cursor.copy_expert.side_effect = self.copy_expert(cursor)
+        stats = PostgresLoader(['adsws'])()
+
+        dbnames = [kw['dbname'] for _, kw in psycopg2.connect.call_args_list]
+        self.assertEqual(dbnames, ['postgres', 'adsws'])
+        conn.__exit__.assert_called_once_with(None, None, None)
+        statements = [args[0] for args, _ in cursor.execute.call_args_list]
+        self.assertIn('CREATE DATABASE "adsws"', statements)
+        self.assertIn('CREATE USER "adsws"', statements)
+        for statement in statements:
+            self.assertNotIn('FROM stdin', statement)
+            self.assertNotIn('\\.', statement)
+        self.assertIn('CREATE TABLE users', ''.join(statements))
+        copied = dict(self.copied)
+        self.assertEqual(
+            copied['COPY roles (id, name, description) FROM stdin'], ''
+        )
+        users = [
+            data for statement, data in self.copied
+            if statement.startswith('COPY users')
+        ][0]
+        self.assertEqual(users.count('\n'), 4)
+        self.assertEqual(stats['adsws']['users']['rows'], 4)
+        self.assertEqual(stats['adsws']['users']['bytes'], len(users))
+
+    @mock.patch('mc.provisioners.psycopg2')
+    def test_tolerated_errors(self, mocked):
+        """
+        a privilege statement that fails, e.g. a GRANT to a role that does
+        not exist, should be skipped without failing the load
+        """
+        mocked.Error = psycopg2.Error
+        conn = mocked.connect.return_value
+        cursor = conn.cursor.return_value
+
+        def execute(statement, params=None):
+            if 'TO adsabs' in statement:
+                raise psycopg2.ProgrammingError(
+                    'role "adsabs" does not exist'
+                )
+        cursor.execute.side_effect = execute
+        cursor.copy_expert.side_effect = self.copy_expert(cursor)
+        PostgresLoader(['graphics'])()
+
+        conn.__exit__.assert_called_once_with(None, None, None)
+        statements = [args[0] for args, _ in cursor.execute.call_args_list]
+        grant = statements.index('GRANT ALL ON SCHEMA public TO adsabs;\n')
+        self.assertEqual(statements[grant - 1], 'SAVEPOINT provision')
+        self.assertEqual(
+            statements[grant + 1], 'ROLLBACK TO SAVEPOINT provision'
+        )
+        self.assertIn('RELEASE SAVEPOINT provision', statements)
+
+    def test_schema_dumps(self):
+        """
+        every statement of the schema dumps should be one that cannot fail
+        on a new database, or one that is skipped if it fails
+        """
+        safe = re.compile(
+            r'^(CREATE\s+(TABLE|SEQUENCE|(UNIQUE\s+)?INDEX|'
+            r'EXTENSION\s+IF\s+NOT\s+EXISTS)|'
+            r'ALTER\s+TABLE\s+ONLY\s+\S+\s+(ADD\s+CONSTRAINT|ALTER\s+COLUMN)|'
+            r'ALTER\s+SEQUENCE\s+\S+\s+OWNED\s+BY|'
+            r'SELECT\s+pg_catalog\.setval|COMMENT\s+ON\s+(TABLE|COLUMN))\b',
+            re.I
+        )
+        loader = PostgresLoader([])
+        paths = glob.glob(os.path.join(
+            ScriptProvisioner.template_dir, 'postgres', '*', '*.schema.sql'
+        ))
+        self.assertEqual(len(paths), len(PostgresProvisioner.known_services()))
+        for path in paths:
+            with open(path) as f:
+                for statement, table, stream in loader.statements(f):
+                    if stream is not None:
+                        stream.read()
+                        self.assertTrue(stream._ended, msg=table)
+                        continue
+                    self.assertFalse(statement.startswith('\\'), msg=path)
+                    self.assertTrue(
+                        safe.match(statement) or
+                        loader.TOLERATED.match(statement),
+                        msg='{}: {}'.format(path, statement)
+                    )
+
+    @mock.patch('mc.provisioners.psycopg2')
+    def test_gzipped_data(self, psycopg2):
+        """
+        gzipped data files should be decompressed as they are copied
+        """
+        directory = os.path.join(self.template_dir, 'postgres', 'recommender')
+        path = os.path.join(directory, 'clusters.data.sql')
+        with open(path, 'rb') as f:
+            data = f.read()
+        with gzip.open(path + '.gz', 'wb') as f:
+            f.write(data)
+        os.remove(path)
+
+        cursor = psycopg2.connect.return_value.cursor.return_value
+        cursor.copy_expert.side_effect = self.copy_expert(cursor)
+        loader = PostgresLoader(
+            ['recommender'], template_dir=self.template_dir
+        )
+        stats = loader()['recommender']
+        self.assertIn(('COPY "clusters" FROM STDIN', data), self.copied)
+        self.assertEqual(
+            sorted(stats), ['clustering', 'clusters', 'coreads']
+        )
+        self.assertEqual(stats['clusters']['rows'], data.count('\n'))
+        self.assertEqual(stats['clusters']['bytes'], len(data))
+
+
+class TestPostgresSnapshot(unittest.TestCase):
+    """
+    Test the snapshots of provisioned postgres databases
+    """
+
+    def setUp(self):
+        self.template_dir = os.path.join(tempfile.mkdtemp(), 'templates')
+        shutil.copytree(ScriptProvisioner.template_dir, self.template_dir)
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.template_dir))
+
+    def test_fingerprint(self):
+        """
+        the key of a snapshot should depend on its services, on the
+        content of their files and on its postgres image only
+        """
+        snapshot = PostgresSnapshot(
+            ['metrics', 'adsws'], template_dir=self.template_dir
+        )
+        self.assertEqual(
+            snapshot.key,
+            PostgresSnapshot(
+                ['adsws', 'metrics'], template_dir=self.template_dir
+            ).key
+        )
+        self.assertEqual(
+            snapshot.key, PostgresSnapshot(['adsws', 'metrics']).key
+        )
+        self.assertNotEqual(
+            snapshot.key,
+            PostgresSnapshot(['adsws'], template_dir=self.template_dir).key
+        )
+        self.assertEqual(
+            snapshot.tag, 'adsabs/postgres-snapshot:{}'.format(snapshot.key)
+        )
+        self.assertNotEqual(
+            snapshot.key,
+            PostgresSnapshot(
+                ['adsws', 'metrics'], template_dir=self.template_dir,
+                base='sha256:base'
+            ).key
+        )
+        path = os.path.join(
+            self.template_dir, 'postgres', 'metrics', 'metrics.data.sql'
+        )
+        with open(path, 'a') as f:
+            f.write('\n')
+        self.assertNotEqual(snapshot.key, snapshot.fingerprint())
+
+    @mock.patch('mc.provisioners.psycopg2')
+    def test_template_databases(self, psycopg2):
+        """
+        the databases should be cloned from their TEMPLATE databases, only
+        if all of them exist
+        """
+        snapshot = PostgresSnapshot(['adsws', 'biblib'])
+        cursor = psycopg2.connect.return_value.cursor.return_value
+        cursor.fetchall.return_value = [(snapshot.template_name('adsws'),)]
+        self.assertFalse(snapshot.restore())
+        self.assertEqual(cursor.execute.call_count, 1)
+
+        cursor.reset_mock()
+        cursor.fetchall.return_value = [
+            (snapshot.template_name('adsws'),),
+            (snapshot.template_name('biblib'),),
+        ]
+        cursor.fetchone.return_value = None
+        self.assertTrue(snapshot.restore())
+        statements = [args[0] for args, _ in cursor.execute.call_args_list]
+        self.assertIn('CREATE USER "biblib"', statements)
+        self.assertIn(
+            'CREATE DATABASE "adsws" TEMPLATE "adsws_snapshot_{}" '
+            'OWNER "adsws"'.format(snapshot.key),
+            statements
+        )
+
+        cursor.reset_mock()
+        snapshot.save()
+        self.assertEqual(
+            cursor.execute.call_args_list[-1][0][0],
+            'CREATE DATABASE "biblib_snapshot_{}" TEMPLATE "biblib"'.format(
+                snapshot.key
+            )
+        )
+
+    @mock.patch('mc.provisioners.psycopg2')
+    def test_commit(self, psycopg2):
+        """
+        the container should be checkpointed, then committed into the image
+        of the snapshot
+        """
+        snapshot = PostgresSnapshot(['adsws'])
+        runner = mock.Mock(container={'Id': 'postgres-test'})
+        self.assertEqual(snapshot.commit(runner), snapshot.tag)
+        psycopg2.connect.return_value.cursor.return_value.execute\
+            .assert_called_once_with('CHECKPOINT')
+        args, kwargs = runner.client.commit.call_args
+        self.assertEqual(args, ('postgres-test',))
+        self.assertEqual(kwargs['repository'], 'adsabs/postgres-snapshot')
+        self.assertEqual(kwargs['tag'], snapshot.key)
+        runner.inventory.invalidate.assert_called_once_with()
+
+
 class TestConsulProvisioner(unittest.TestCase):
     """
     Test that consul is provisioned correctly
@@ -155,3 +419,12 @@ class TestConsulProvisioner(unittest.TestCase):
             with self.assertRaises(KeyError):
                 del current_app.config['DEPENDENCIES']['POSTGRES']
                 ConsulProvisioner.get_db_params()
+
+    def test_postgres_services_from_templates(self):
+        """
+        PostgresProvisioner should know the services it has templates for
+        """
+        self.assertEqual(
+            PostgresProvisioner.known_services(),
+            ['adsws', 'biblib', 'graphics', 'metrics', 'recommender']
+        )
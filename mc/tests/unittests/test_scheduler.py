@@ -0,0 +1,190 @@
+"""
+Test the build scheduler
+"""
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import mock
+from flask.ext.testing import TestCase
+from mc import app
+from mc.models import db, Commit, Build
+from mc.scheduler import BuildScheduler
+from mc.tasks import schedule_builds
+
+
+class FakeDocker(object):
+    """
+    Stands in for docker.Client; only reports the daemon's resources
+    """
+    def __init__(self, ncpu=4, memory=8 * 1024 ** 3):
+        self.ncpu = ncpu
+        self.memory = memory
+
+    def info(self):
+        return {'NCPU': self.ncpu, 'MemTotal': self.memory}
+
+
+class FakeBuilds(object):
+    """
+    build_fn recording the order and concurrency of the builds
+    """
+    def __init__(self, repositories, duration=0.05):
+        self.repositories = repositories
+        self.duration = duration
+        self.started = []
+        self.running = []
+        self.max_running = 0
+        self.overlaps = []
+        self.lock = threading.Lock()
+
+    def __call__(self, build_id):
+        repo = self.repositories[build_id]
+        with self.lock:
+            if repo in self.running:
+                self.overlaps.append(repo)
+            self.running.append(repo)
+            self.started.append(build_id)
+            self.max_running = max(self.max_running, len(self.running))
+        time.sleep(self.duration)
+        with self.lock:
+            self.running.remove(repo)
+
+
+class TestBuildScheduler(unittest.TestCase):
+    """
+    Test the BuildScheduler
+    """
+
+    def test_capacity(self):
+        """
+        the slots should be limited by the daemon's CPUs and memory, and by
+        the configured maximum
+        """
+        self.assertEqual(
+            BuildScheduler(FakeDocker(4, 8 * 1024 ** 3)).slots, 4
+        )
+        self.assertEqual(
+            BuildScheduler(FakeDocker(8, 2 * 1024 ** 3)).slots, 2
+        )
+        self.assertEqual(
+            BuildScheduler(FakeDocker(8, 8 * 1024 ** 3), slots=3).slots, 3
+        )
+        self.assertEqual(
+            BuildScheduler(FakeDocker(8, 8 * 1024 ** 3),
+                           cpus_per_build=4).slots, 2
+        )
+        self.assertEqual(BuildScheduler(FakeDocker(1, 1024)).slots, 1)
+
+    def test_concurrency(self):
+        """
+        builds of different repositories should run concurrently up to the
+        slots, builds of one repository one after the other
+        """
+        repositories = {
+            1: 'adsws', 2: 'adsws', 3: 'biblib', 4: 'myads', 5: 'orcid',
+            6: 'adsws',
+        }
+        builds = FakeBuilds(repositories)
+        scheduler = BuildScheduler(FakeDocker(), slots=3, build_fn=builds)
+        for build_id in sorted(repositories):
+            scheduler.submit(build_id, repositories[build_id])
+        self.assertEqual(
+            scheduler.utilisation(),
+            {'slots': 3, 'busy': 0, 'queued': 6, 'running': []}
+        )
+
+        finished = scheduler.run()
+
+        self.assertEqual(sorted(b for b, _ in finished), range(1, 7))
+        self.assertEqual(builds.max_running, 3)
+        self.assertEqual(builds.overlaps, [])
+        # adsws builds keep their order
+        self.assertEqual(
+            [b for b in builds.started if repositories[b] == 'adsws'],
+            [1, 2, 6]
+        )
+        self.assertEqual(
+            scheduler.utilisation(),
+            {'slots': 3, 'busy': 0, 'queued': 0, 'running': []}
+        )
+
+    def test_priority(self):
+        """
+        builds with a higher priority should start first
+        """
+        repositories = {1: 'adsws', 2: 'biblib', 3: 'myads'}
+        builds = FakeBuilds(repositories, duration=0)
+        scheduler = BuildScheduler(FakeDocker(), slots=1, build_fn=builds)
+        scheduler.submit(1, 'adsws')
+        scheduler.submit(2, 'biblib')
+        scheduler.submit(3, 'myads', priority=1)
+        scheduler.run()
+        self.assertEqual(builds.started, [3, 1, 2])
+
+    def test_failed_build(self):
+        """
+        a failing build should be reported and free its slot
+        """
+        def build_fn(build_id):
+            if build_id == 1:
+                raise RuntimeError("docker went away")
+
+        scheduler = BuildScheduler(FakeDocker(), slots=1, build_fn=build_fn)
+        scheduler.submit(1, 'adsws')
+        scheduler.submit(2, 'adsws')
+        finished = scheduler.run()
+        self.assertEqual([b for b, _ in finished], [1, 2])
+        self.assertIsInstance(finished[0][1], RuntimeError)
+        self.assertIsNone(finished[1][1])
+
+
+class TestScheduleBuilds(TestCase):
+    """
+    Test the schedule_builds task
+    """
+
+    def create_app(self):
+        self.tmpdir = tempfile.mkdtemp()
+        app_ = app.create_app()
+        # Builds run in threads with their own connection
+        app_.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:///{}".format(
+            os.path.join(self.tmpdir, 'mc.db')
+        )
+        return app_
+
+    def setUp(self):
+        db.create_all()
+        for repo, tag in [('adsws', None), ('biblib', None), ('adsws', 'v1')]:
+            commit = Commit(
+                commit_hash='{}-{}'.format(repo, tag), repository=repo,
+                tag=tag,
+            )
+            db.session.add(Build(commit=commit, status='queued'))
+        db.session.add(Build(
+            commit=Commit(commit_hash='done', repository='myads'),
+            status='finished',
+        ))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        shutil.rmtree(self.tmpdir)
+
+    @mock.patch('mc.tasks.run_build')
+    def test_schedule_builds(self, run_build):
+        """
+        the queued builds should be run, tagged commits first
+        """
+        started = []
+        run_build.side_effect = lambda build: started.append(
+            build.commit.commit_hash
+        )
+        finished = schedule_builds(slots=1, client=FakeDocker())
+        self.assertEqual(len(finished), 3)
+        self.assertEqual(
+            started, ['adsws-v1', 'adsws-None', 'biblib-None']
+        )
@@ -5,8 +5,12 @@ from flask.ext.testing import TestCase
 from mock import patch
 from mc import app
 from mc.models import db, Commit, Build
-from mc.tasks import register_task_revision, build_docker, update_service, run_task
+from mc.buildlogs import BuildLog
+from mc.tasks import register_task_revision, build_docker, update_service, \
+    run_task, queue_build, resolve_cache_policy, run_build
 import datetime
+import shutil
+import tempfile
 
 
 class TestRegisterTaskDefinition(TestCase):
@@ -109,6 +113,10 @@ class TestDockerBuildTask(TestCase):
         that a fresh database is used for each test.
         """
         db.create_all()
+        # The base image of the mocked daemon is up to date
+        patcher = patch('mc.builders.BaseImageBuilder.age', return_value=0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     def tearDown(self):
         """
@@ -146,4 +154,369 @@ class TestDockerBuildTask(TestCase):
             delta=datetime.timedelta(seconds=1)
         )
         self.assertTrue(build.built)
-        self.assertTrue(build.pushed)
\ No newline at end of file
+        self.assertTrue(build.pushed)
+        self.assertEqual(build.status, 'finished')
+
+    @patch('mc.builders.Client')
+    def test_image_stats(self, mocked):
+        """
+        The digest, size, layers and stage durations of the pushed image
+        should be stored with the build
+        """
+        commit = Commit(repository='adsws', commit_hash='test-hash')
+        db.session.add(commit)
+        db.session.commit()
+        instance = mocked.return_value
+        instance.build.return_value = ['Successfully built']
+        instance.push.return_value = ['master: digest: sha256:0a1b size: 1234']
+        instance.inspect_image.return_value = {
+            'Size': 123456789, 'RootFS': {'Layers': ['sha256:1', 'sha256:2']},
+        }
+
+        build_docker(commit.id)
+
+        stats = db.session.query(Build).first().stats
+        self.assertEqual(stats.digest, 'sha256:0a1b')
+        self.assertEqual(stats.size, 123456789)
+        self.assertEqual(stats.layers, 2)
+        self.assertIsNone(stats.compressed_size)
+        self.assertIsNotNone(stats.build_duration)
+        self.assertIsNotNone(stats.push_duration)
+
+    @patch('mc.builders.Client')
+    def test_build_log(self, mocked):
+        """
+        With BUILD_LOG_DIR set, the events of the build should be stored in
+        the build's log, between the running and finished statuses
+        """
+        self.app.config['BUILD_LOG_DIR'] = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.app.config['BUILD_LOG_DIR'])
+        commit = Commit(repository='adsws', commit_hash='test-hash')
+        db.session.add(commit)
+        db.session.commit()
+        instance = mocked.return_value
+        instance.build.return_value = ['Successfully built']
+        instance.push.return_value = ['pushing tag']
+
+        build_docker(commit.id)
+
+        build = db.session.query(Build).first()
+        events = BuildLog.for_build(self.app.config, build.id).read()
+        self.assertEqual(
+            [(e['type'], e.get('stage')) for e in events],
+            [('status', None), ('built', 'build'), ('pushed', 'push'),
+             ('status', None)]
+        )
+        self.assertEqual(events[-1]['status'], 'finished')
+        self.assertTrue(events[-1]['pushed'])
+
+    @patch('mc.builders.Client')
+    def test_render_error(self, mocked):
+        """
+        A build whose templates cannot be rendered should be recorded as
+        finished and not built, with the error in its log
+        """
+        self.app.config['BUILD_LOG_DIR'] = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.app.config['BUILD_LOG_DIR'])
+        commit = Commit(repository='no-dockerfile', commit_hash='test-hash')
+        db.session.add(commit)
+        db.session.commit()
+
+        build_docker(commit.id)
+
+        build = db.session.query(Build).first()
+        self.assertEqual(build.status, 'finished')
+        self.assertFalse(build.built)
+        self.assertFalse(build.pushed)
+        self.assertIsNone(build.image)
+        self.assertFalse(mocked.return_value.build.called)
+        events = BuildLog.for_build(self.app.config, build.id).read()
+        self.assertEqual(
+            [e['type'] for e in events], ['status', 'error', 'status']
+        )
+        self.assertIn('no-dockerfile', events[1]['error'])
+        self.assertEqual(events[-1]['status'], 'finished')
+
+    @patch('mc.tasks.DockerImageBuilder')
+    def test_unknown_cache_policy(self, Builder):
+        """
+        A build that cannot be set up, e.g. for a cache policy that is no
+        longer supported, should be recorded as finished and its log ended
+        """
+        self.app.config['BUILD_LOG_DIR'] = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.app.config['BUILD_LOG_DIR'])
+        self.app.config['DOCKER_CACHE_POLICIES'] = {
+            'default': {'policy': 'cache-from'}
+        }
+        commit = Commit(repository='adsws', commit_hash='test-hash')
+        db.session.add(commit)
+        build = queue_build(commit)
+        db.session.commit()
+        build_id = build.id
+
+        with self.assertRaises(ValueError):
+            run_build(build)
+
+        build = Build.query.get(build_id)
+        self.assertEqual(build.status, 'finished')
+        self.assertFalse(build.built)
+        self.assertFalse(Builder.called)
+        events = BuildLog.for_build(self.app.config, build_id).read()
+        self.assertEqual(
+            [e['type'] for e in events], ['error', 'status']
+        )
+        self.assertEqual(events[-1]['status'], 'finished')
+
+    @patch('mc.tasks.DockerImageBuilder')
+    def test_build_crash(self, Builder):
+        """
+        A build that crashes should be recorded as finished, and its log
+        should end, so that its followers stop
+        """
+        self.app.config['BUILD_LOG_DIR'] = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.app.config['BUILD_LOG_DIR'])
+        Builder.side_effect = RuntimeError("boom")
+        commit = Commit(repository='adsws', commit_hash='test-hash')
+        db.session.add(commit)
+        db.session.commit()
+
+        with self.assertRaises(RuntimeError):
+            build_docker(commit.id)
+
+        build = db.session.query(Build).first()
+        self.assertEqual(build.status, 'finished')
+        self.assertFalse(build.built)
+        events = BuildLog.for_build(self.app.config, build.id).read()
+        self.assertEqual(
+            [e['type'] for e in events], ['status', 'error', 'status']
+        )
+        self.assertEqual(events[-1]['status'], 'finished')
+
+    def test_requeued_commit(self):
+        """
+        Queueing a commit whose build is still queued, e.g. for a redelivered
+        webhook, should reuse that build rather than supersede it
+        """
+        commit = Commit(repository='adsws', commit_hash='test-hash')
+        db.session.add(commit)
+        build = queue_build(commit)
+        db.session.commit()
+        self.assertIs(queue_build(commit, refresh=True), build)
+        db.session.commit()
+        self.assertEqual(Build.query.count(), 1)
+        self.assertEqual(build.status, 'queued')
+        self.assertTrue(build.no_cache)
+
+    @patch('mc.tasks.DockerImageBuilder')
+    def test_claimed_build(self, Builder):
+        """
+        A queued build that was picked up elsewhere should not run again
+        """
+        commit = Commit(repository='adsws', commit_hash='test-hash')
+        db.session.add(commit)
+        build = queue_build(commit)
+        db.session.commit()
+        # e.g. by schedule_builds, in another process
+        Build.query.filter_by(id=build.id).update({'status': 'running'})
+        db.session.commit()
+
+        run_build(build)
+        self.assertFalse(Builder.called)
+        self.assertEqual(build.status, 'running')
+
+    @patch('mc.builders.Client')
+    def test_coalesced_builds(self, mocked):
+        """
+        Queued builds of the same repository and tag are superseded by newer
+        ones and recorded as skipped; build_docker then does not build them
+        """
+        commits = [
+            Commit(repository='adsws', commit_hash='hash-{}'.format(i))
+            for i in range(3)
+        ]
+        tagged = Commit(repository='adsws', commit_hash='hash-t', tag='v1')
+        other = Commit(repository='biblib-service', commit_hash='hash-o')
+        db.session.add_all(commits + [tagged, other])
+        builds = [queue_build(c) for c in [commits[0], tagged, other]]
+        builds += [queue_build(c) for c in commits[1:]]
+        db.session.commit()
+
+        commit_ids = [c.id for c in commits]
+        build_ids = [b.id for b in builds]
+
+        self.assertEqual(
+            [b.status for b in builds],
+            ['skipped', 'queued', 'queued', 'skipped', 'queued']
+        )
+
+        instance = mocked.return_value
+        instance.build.return_value = ['Successfully built']
+        instance.push.return_value = ['pushing tag']
+
+        build_docker(commit_ids[0])
+        self.assertFalse(instance.build.called)
+        build = Build.query.get(build_ids[0])
+        self.assertEqual(build.status, 'skipped')
+        self.assertIsNone(build.built)
+
+        build_docker(commit_ids[2])
+        self.assertEqual(instance.build.call_count, 1)
+        build = Build.query.get(build_ids[4])
+        self.assertEqual(build.status, 'finished')
+        self.assertTrue(build.built)
+        self.assertEqual(Build.query.count(), 5)
+
+    @patch('mc.builders.Client')
+    def test_retag_built_commit(self, mocked):
+        """
+        A tag pushed for a commit that was already built and pushed should
+        retag the existing image instead of rebuilding it
+        """
+        commit = Commit(repository='adsws', commit_hash='test-hash')
+        db.session.add(commit)
+        db.session.add(Build(
+            commit=commit, built=True, pushed=True, status='finished',
+            image='adsabs/adsws:test-hash'
+        ))
+        commit.tag = 'v1.0.0'
+        db.session.commit()
+        commit_id = commit.id
+
+        instance = mocked.return_value
+        instance.push.return_value = ['pushing tag']
+
+        build_docker(commit_id)
+        self.assertFalse(instance.build.called)
+        instance.tag.assert_called_with(
+            'adsabs/adsws:test-hash', 'adsabs/adsws', tag='v1.0.0', force=True
+        )
+        build = Build.query.order_by(Build.id.desc()).first()
+        self.assertTrue(build.built)
+        self.assertTrue(build.pushed)
+        self.assertEqual(build.image, 'adsabs/adsws:v1.0.0')
+
+        # A failed retag falls back to a full build
+        instance.tag.return_value = False
+        instance.build.return_value = ['Successfully built']
+        commit = Commit.query.get(commit_id)
+        commit.tag = 'v1.0.1'
+        db.session.commit()
+        build_docker(commit_id)
+        self.assertTrue(instance.build.called)
+        build = Build.query.order_by(Build.id.desc()).first()
+        self.assertEqual(build.image, 'adsabs/adsws:v1.0.1')
+
+    def test_resolve_cache_policy(self):
+        """
+        The cache policy of a repository, or the default one, should resolve
+        to its name and whether to build without the layer cache; unknown
+        policies, including the removed cache-from, are errors
+        """
+        commit = Commit(repository='adsws', commit_hash='test-hash')
+        db.session.add(commit)
+        db.session.commit()
+        policies = self.app.config['DOCKER_CACHE_POLICIES'] = {
+            'default': {'policy': 'refresh', 'max_age': 3600},
+            'biblib-service': {'policy': 'fresh'},
+        }
+
+        # No fresh build yet
+        self.assertEqual(
+            resolve_cache_policy(commit), ('refresh', True)
+        )
+        build = Build(
+            commit=commit, built=True, no_cache=True,
+            image='adsabs/adsws:test-hash',
+            timestamp=datetime.datetime.now() - datetime.timedelta(minutes=5)
+        )
+        db.session.add(build)
+        db.session.commit()
+        self.assertEqual(
+            resolve_cache_policy(commit), ('refresh', False)
+        )
+        self.assertEqual(
+            resolve_cache_policy(commit, refresh=True), ('refresh', True)
+        )
+        build.timestamp -= datetime.timedelta(hours=1)
+        self.assertEqual(
+            resolve_cache_policy(commit), ('refresh', True)
+        )
+
+        # Removed, as the build of docker-py 1.10 takes no cache_from
+        policies['adsws'] = {'policy': 'cache-from'}
+        with self.assertRaises(ValueError):
+            resolve_cache_policy(commit)
+        del policies['adsws']
+
+        commit.repository = 'biblib-service'
+        self.assertEqual(resolve_cache_policy(commit), ('fresh', True))
+
+        policies['default'] = {'policy': 'unknown'}
+        commit.repository = 'export_service'
+        with self.assertRaises(ValueError):
+            resolve_cache_policy(commit)
+
+    @patch('mc.builders.Client')
+    def test_refresh_build(self, mocked):
+        """
+        A build queued with refresh is built without the layer cache, and
+        the build is annotated with its policy and duration
+        """
+        commit = Commit(repository='adsws', commit_hash='test-hash')
+        db.session.add(commit)
+        db.session.add(Build(
+            commit=commit, built=True, no_cache=True,
+            timestamp=datetime.datetime.now()
+        ))
+        queue_build(commit, refresh=True)
+        db.session.commit()
+        commit_id = commit.id
+
+        instance = mocked.return_value
+        instance.build.return_value = ['Successfully built']
+        instance.push.return_value = ['pushing tag']
+        build_docker(commit_id)
+
+        _, kwargs = instance.build.call_args
+        self.assertTrue(kwargs['nocache'])
+        build = Build.query.order_by(Build.id.desc()).first()
+        self.assertEqual(build.cache_policy, 'refresh')
+        self.assertTrue(build.no_cache)
+        self.assertGreater(build.duration, 0)
+
+    @patch('mc.builders.Client')
+    def test_fingerprint(self, mocked):
+        """
+        A build whose context is identical to that of a pushed build should
+        not be built again, unless forced
+        """
+        commit = Commit(repository='adsws', commit_hash='test-hash')
+        db.session.add(commit)
+        db.session.commit()
+        commit_id = commit.id
+        instance = mocked.return_value
+        instance.build.return_value = ['Successfully built']
+        instance.push.return_value = ['pushing tag']
+
+        build_docker(commit_id)
+        first = Build.query.order_by(Build.id.desc()).first()
+        first_id, fingerprint = first.id, first.fingerprint
+        self.assertEqual(len(fingerprint), 64)
+        self.assertEqual(instance.build.call_count, 1)
+
+        # e.g. a redelivered webhook
+        queue_build(Commit.query.get(commit_id))
+        db.session.commit()
+        build_docker(commit_id)
+        self.assertEqual(instance.build.call_count, 1)
+        build = Build.query.order_by(Build.id.desc()).first()
+        self.assertNotEqual(build.id, first_id)
+        self.assertEqual(build.fingerprint, fingerprint)
+        self.assertTrue(build.pushed)
+        self.assertEqual(build.image, 'adsabs/adsws:test-hash')
+        self.assertEqual(build.status, 'finished')
+
+        queue_build(Commit.query.get(commit_id), force=True)
+        db.session.commit()
+        build_docker(commit_id)
+        self.assertEqual(instance.build.call_count, 2)
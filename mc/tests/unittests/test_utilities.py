@@ -13,8 +13,11 @@ from mc.views import GithubListener
 from mc.exceptions import NoSignatureInfo, InvalidSignature, UnknownRepoError
 from mc.tests.stubdata.github_webhook_payload import payload, payload_tag
 from mc.models import db, Commit
-from mc.utils import ChangeDir, get_boto_session
+from mc.utils import ChangeDir, get_boto_session, StageTimer, median
+from mc.ingest import WebhookSpool
 import mock
+import shutil
+import tempfile
 
 from flask.ext.testing import TestCase
 
@@ -50,6 +53,31 @@ class TestUtilities(unittest.TestCase):
             self.assertEqual(os.path.abspath(os.curdir), os.path.expanduser('~'))
         self.assertEqual(os.path.abspath(os.curdir), current)
 
+    def test_StageTimer(self):
+        """
+        StageTimer should record stages in order, accumulate re-entered stages
+        and record the duration of stages that raised
+        """
+        timer = StageTimer()
+        with timer('one'):
+            pass
+        with self.assertRaises(ValueError):
+            with timer('two'):
+                raise ValueError
+        with timer('one'):
+            pass
+        self.assertEqual(timer.durations.keys(), ['one', 'two'])
+        self.assertAlmostEqual(timer.total, sum(timer.durations.values()))
+        self.assertTrue(timer.header().startswith('one;dur='))
+        self.assertIn('two=', str(timer))
+
+    def test_median(self):
+        """
+        median should be the middle value, or the mean of the middle two
+        """
+        self.assertEqual(median([3, 1, 2]), 2)
+        self.assertEqual(median([4, 1, 3, 2]), 2.5)
+
     @mock.patch('mc.utils.Session')
     def test_get_boto_session(self, Session):
         """
@@ -71,6 +99,51 @@ class TestUtilities(unittest.TestCase):
         )
 
 
+class TestWebhookSpool(unittest.TestCase):
+    """
+    Test the directory-backed webhook spool
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spool = WebhookSpool(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_claim_ack(self):
+        """
+        Payloads are claimed in arrival order, at most once, and removed
+        once acknowledged
+        """
+        events = [self.spool.append('payload-{}'.format(i)) for i in range(3)]
+        self.assertEqual(self.spool.pending(), events)
+
+        claimed = self.spool.claim(limit=2)
+        self.assertEqual(
+            claimed, [(events[0], 'payload-0'), (events[1], 'payload-1')]
+        )
+        self.assertEqual(self.spool.pending(), events[2:])
+        self.assertEqual(
+            WebhookSpool(self.directory).claim(), [(events[2], 'payload-2')]
+        )
+
+        self.spool.ack(events[0])
+        self.spool.release(events[1])
+        self.assertEqual(self.spool.pending(), [events[1]])
+        self.assertNotIn(events[0], os.listdir(self.directory))
+
+    def test_recover(self):
+        """
+        Stale claims should be returned to the spool
+        """
+        event = self.spool.append('payload')
+        self.spool.claim()
+        self.assertEqual(self.spool.recover(timeout=60), [])
+        self.assertEqual(self.spool.recover(timeout=-1), [event])
+        self.assertEqual(self.spool.pending(), [event])
+
+
 class TestStaticMethodUtilities(TestCase):
     """
     Test standalone staticmethods
@@ -2,8 +2,19 @@
 Test webservices
 """
 import mock
+import hmac
+import hashlib
+import json
+import shutil
+import tempfile
+import threading
+import time
 from mc import app
-from mc.models import Commit, db
+from mc.models import Commit, Build, db
+from mc.buildlogs import BuildLog, LogTailer
+from mc.ingest import WebhookSpool
+from mc.tasks import ingest_webhooks, queue_build
+from mc.tests.stubdata.github_webhook_payload import payload
 from flask.ext.testing import TestCase
 from flask import url_for
 
@@ -77,3 +88,342 @@ class TestEndpoints(TestCase):
             url = url_for('GithubListener'.lower())
             r = self.client.post(url)
         self.assertEqual(r.json['received'], 'git-repo@git-hash, tag:v1.0.0')
+
+
+class TestAsyncEndpoints(TestCase):
+    """
+    Tests the GithubListener endpoint in asynchronous (WEBHOOK_ASYNC) mode
+    """
+
+    def create_app(self):
+        """
+        Create the wsgi application
+        """
+        app_ = app.create_app()
+        app_.config['SQLALCHEMY_DATABASE_URI'] = "sqlite://"
+        app_.config['MC_LOGGING'] = {}
+        app_.config['GITHUB_SECRET'] = 'unittest-secret'
+        app_.config['WEBHOOK_SPOOL_DIR'] = tempfile.mkdtemp()
+        app_.config['WEBHOOK_INGEST_WINDOW'] = 0
+        return app_
+
+    def setUp(self):
+        db.create_all()
+        self.payload = payload.replace(
+            '"name": "mission-control"', '"name": "adsws"'
+        )
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        shutil.rmtree(self.app.config['WEBHOOK_SPOOL_DIR'])
+
+    def post(self, data):
+        """
+        post a correctly signed payload to the GithubListener endpoint
+        """
+        signature = hmac.new(
+            self.app.config['GITHUB_SECRET'],
+            msg=data,
+            digestmod=hashlib.sha1,
+        ).hexdigest()
+        return self.client.post(
+            url_for('GithubListener'.lower()),
+            data=data,
+            content_type='application/json',
+            headers={
+                self.app.config['GITHUB_SIGNATURE_HEADER']:
+                    "sha1={}".format(signature)
+            }
+        )
+
+    def test_replayed_burst(self):
+        """
+        A burst of deliveries should be acknowledged with 202 after being
+        spooled, then ingested as a single commit and build. The synchronous
+        mode should report its own stages for comparison.
+        """
+        self.app.config['WEBHOOK_ASYNC'] = True
+        for _ in range(10):
+            r = self.post(self.payload)
+            self.assertStatus(r, 202)
+            self.assertIn('queued', r.json)
+            stages = [i.split(';')[0] for i in
+                      r.headers['Server-Timing'].split(', ')]
+            self.assertEqual(stages, ['verify', 'spool'])
+        spool = WebhookSpool(self.app.config['WEBHOOK_SPOOL_DIR'])
+        self.assertEqual(len(spool), 10)
+        self.assertEqual(Commit.query.count(), 0)
+
+        with mock.patch('mc.tasks.build_docker') as bd_mock:
+            stats = ingest_webhooks()
+        self.assertEqual(
+            stats['durations'].keys(), ['collect', 'parse', 'upsert', 'enqueue']
+        )
+        self.assertEqual(stats['events'], 10)
+        self.assertEqual(stats['rows'], 1)
+        self.assertGreater(stats['rows_per_second'], 0)
+        self.assertEqual(len(spool), 0)
+        self.assertEqual(Commit.query.count(), 1)
+        bd_mock.delay.assert_called_once_with(Commit.query.first().id)
+
+        # Nothing left to ingest
+        self.assertEqual(ingest_webhooks()['events'], 0)
+
+        self.app.config['WEBHOOK_ASYNC'] = False
+        with mock.patch('mc.tasks.build_docker'):
+            r = self.post(self.payload)
+        self.assertStatus(r, 200)
+        stages = [i.split(';')[0] for i in
+                  r.headers['Server-Timing'].split(', ')]
+        self.assertEqual(stages, ['verify', 'parse', 'db', 'enqueue'])
+
+    def test_unknown_repo_is_dropped(self):
+        """
+        Spooled payloads for unwatched repositories are dropped on ingestion
+        """
+        self.app.config['WEBHOOK_ASYNC'] = True
+        self.assertStatus(self.post(payload), 202)
+        with mock.patch('mc.tasks.build_docker') as bd_mock:
+            ingest_webhooks()
+        self.assertFalse(bd_mock.delay.called)
+        self.assertEqual(Commit.query.count(), 0)
+        self.assertEqual(
+            len(WebhookSpool(self.app.config['WEBHOOK_SPOOL_DIR'])), 0
+        )
+
+
+class TestBuildLogStream(TestCase):
+    """
+    Tests the BuildLogStream endpoint
+    """
+
+    def create_app(self):
+        """
+        Create the wsgi application
+        """
+        app_ = app.create_app()
+        app_.config['MC_LOGGING'] = {}
+        app_.config['BUILD_LOG_DIR'] = tempfile.mkdtemp()
+        # Followers run in threads with their own connection
+        app_.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:///{}/mc.db".format(
+            app_.config['BUILD_LOG_DIR']
+        )
+        app_.config['BUILD_LOG_POLL_INTERVAL'] = 0.01
+        return app_
+
+    def setUp(self):
+        db.create_all()
+        commit = Commit(commit_hash='master', repository='adsws')
+        self.finished = Build(commit=commit, status='finished')
+        self.running = Build(commit=commit, status='running')
+        db.session.add_all([self.finished, self.running])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        shutil.rmtree(self.app.config['BUILD_LOG_DIR'])
+
+    @staticmethod
+    def parse(body):
+        """
+        :return: list of (id, event type, data) of a Server-Sent Events body
+        """
+        events = []
+        for block in body.strip().split('\n\n'):
+            fields = dict(
+                line.split(': ', 1) for line in block.splitlines()
+                if not line.startswith(':')
+            )
+            if fields:
+                events.append((
+                    int(fields['id']), fields['event'],
+                    json.loads(fields['data'])
+                ))
+        return events
+
+    def test_replay(self):
+        """
+        the stored events of a finished build should be replayed, from the
+        Last-Event-ID if given
+        """
+        log = BuildLog.for_build(self.app.config, self.finished.id)
+        log.write({'type': 'status', 'status': 'running'})
+        log.write({'type': 'step', 'step': 1, 'message': 'Step 1/1 : FROM x'})
+        log.write({'type': 'status', 'status': 'finished'})
+        log.close()
+        url = url_for('buildlogstream', build_id=self.finished.id)
+
+        r = self.client.get(url)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.mimetype, 'text/event-stream')
+        events = self.parse(r.data)
+        self.assertEqual(
+            [(n, t) for n, t, _ in events],
+            [(0, 'status'), (1, 'step'), (2, 'status')]
+        )
+        self.assertEqual(events[1][2]['message'], 'Step 1/1 : FROM x')
+
+        r = self.client.get(url, headers={'Last-Event-ID': '1'})
+        self.assertEqual([n for n, _, _ in self.parse(r.data)], [2])
+
+    def test_unknown_build(self):
+        """
+        unknown builds, or disabled build logs, should 404
+        """
+        r = self.client.get(url_for('buildlogstream', build_id=1000))
+        self.assertStatus(r, 404)
+        with mock.patch.dict(self.app.config, {'BUILD_LOG_DIR': None}):
+            r = self.client.get(
+                url_for('buildlogstream', build_id=self.finished.id)
+            )
+        self.assertStatus(r, 404)
+
+    def test_build_without_status(self):
+        """
+        builds without a status, e.g. made before build statuses or by the
+        legacy build path, should be replayed rather than followed, and 404
+        without a log
+        """
+        build = Build(
+            commit=self.finished.commit, built=True, pushed=True, status=None
+        )
+        db.session.add(build)
+        db.session.commit()
+        url = url_for('buildlogstream', build_id=build.id)
+        self.assertStatus(self.client.get(url), 404)
+        # Queued builds have no log until they run
+        self.app.config['BUILD_LOG_KEEPALIVE'] = 0.05
+        follower, bodies = self.follow(self.running.id)
+        self.assertTrue(follower.is_alive())
+
+        log = BuildLog.for_build(self.app.config, build.id)
+        log.write({'type': 'output', 'message': 'built'})
+        log.close()
+        r = self.client.get(url)
+        self.assertStatus(r, 200)
+        self.assertEqual(
+            [e for _, _, e in self.parse(r.data)],
+            [{'type': 'output', 'message': 'built'}]
+        )
+        # Only the running build is followed
+        self.assertEqual(len(LogTailer.tailers), 1)
+
+        Build.query.get(self.running.id).status = None
+        db.session.commit()
+        follower.join(5)
+        self.assertFalse(follower.is_alive())
+
+    def test_follow(self):
+        """
+        followers of a running build should all receive its events as they
+        are stored, from a single tailer, until the build finishes
+        """
+        log = BuildLog.for_build(self.app.config, self.running.id)
+        log.write({'type': 'status', 'status': 'running'})
+        log.flush()
+        url = url_for('buildlogstream', build_id=self.running.id)
+        bodies = []
+
+        def follow():
+            with self.app.test_client() as client:
+                bodies.append(client.get(url).data)
+
+        followers = [threading.Thread(target=follow) for _ in range(5)]
+        for follower in followers:
+            follower.start()
+        time.sleep(0.1)
+        self.assertEqual(
+            [t.name for t in threading.enumerate()].count(
+                'tail-build-{}'.format(self.running.id)
+            ), 1
+        )
+        for n in range(3):
+            log.write({'type': 'output', 'message': 'line {}'.format(n)})
+            log.flush()
+            time.sleep(0.02)
+        log.write({'type': 'status', 'status': 'finished'})
+        log.flush()
+        for follower in followers:
+            follower.join(5)
+
+        self.assertEqual(len(bodies), 5)
+        for body in bodies:
+            self.assertEqual(
+                [e['type'] for _, _, e in self.parse(body)],
+                ['status', 'output', 'output', 'output', 'status']
+            )
+        self.assertEqual(LogTailer.tailers, {})
+
+    def follow(self, build_id):
+        """
+        :return: thread following the log of a build, and the list its body
+            is appended to
+        """
+        url = url_for('buildlogstream', build_id=build_id)
+        bodies = []
+
+        def follow():
+            with self.app.test_client() as client:
+                bodies.append(client.get(url).data)
+
+        follower = threading.Thread(target=follow)
+        follower.start()
+        time.sleep(0.1)
+        return follower, bodies
+
+    def test_follow_requeued(self):
+        """
+        a requeued build should end the stream, unless it runs again
+        """
+        log = BuildLog.for_build(self.app.config, self.running.id)
+        for status in ('running', 'queued', 'running'):
+            log.write({'type': 'status', 'status': status})
+        log.flush()
+        follower, bodies = self.follow(self.running.id)
+        self.assertTrue(follower.is_alive())
+        log.write({'type': 'status', 'status': 'queued'})
+        log.flush()
+        follower.join(5)
+        self.assertFalse(follower.is_alive())
+        self.assertEqual(
+            [e['status'] for _, _, e in self.parse(bodies[0])],
+            ['running', 'queued', 'running', 'queued']
+        )
+
+    def test_follow_skipped(self):
+        """
+        a queued build superseded by a newer one should end the stream
+        """
+        self.running.status = 'queued'
+        db.session.commit()
+        follower, bodies = self.follow(self.running.id)
+        self.assertTrue(follower.is_alive())
+        queue_build(Commit(commit_hash='newer', repository='adsws'))
+        db.session.commit()
+        follower.join(5)
+        self.assertFalse(follower.is_alive())
+        self.assertEqual(
+            [e for _, _, e in self.parse(bodies[0])],
+            [{'type': 'status', 'status': 'skipped'}]
+        )
+
+    def test_follow_status(self):
+        """
+        the stream should end at a keepalive once the build is recorded as
+        finished, even if its log never says so
+        """
+        self.app.config['BUILD_LOG_KEEPALIVE'] = 0.05
+        follower, bodies = self.follow(self.running.id)
+        self.assertTrue(follower.is_alive())
+        Build.query.get(self.running.id).status = 'finished'
+        db.session.commit()
+        follower.join(5)
+        self.assertFalse(follower.is_alive())
+        self.assertIn(': keepalive', bodies[0])
+        # The tailer stops at its next poll, without followers
+        deadline = time.time() + 5
+        while LogTailer.tailers and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(LogTailer.tailers, {})
@@ -0,0 +1,253 @@
+"""
+Test wheelhouse.py
+"""
+import io
+import os
+import shutil
+import stat
+import subprocess
+import tarfile
+import tempfile
+import unittest
+import mock
+from mc.wheelhouse import Wheelhouse
+from mc.builders import DockerImageBuilder
+from mc.models import Commit
+
+# Stands in for `pip wheel`: writes a 1kB wheel per requirement, counting how
+# often each one is built
+FAKE_PIP = '''#!/bin/sh
+while [ $# -gt 0 ]; do
+    case $1 in
+        --wheel-dir) out=$2; shift;;
+        -r) requirements=$2; shift;;
+    esac
+    shift
+done
+mkdir -p $out
+for r in $(cat $requirements); do
+    if [ $r = broken ]; then
+        failed=1
+    elif [ ! -f $out/$r-1.0-py2-none-any.whl ]; then
+        head -c 1024 /dev/zero > $out/$r-1.0-py2-none-any.whl
+        echo $r >> {log}
+    fi
+done
+exit $failed
+'''
+
+
+class FakeClient(object):
+    """
+    Stands in for docker.Client: runs the command of a container on the
+    host, in a directory standing for the root of its filesystem
+    """
+
+    def __init__(self, pip):
+        self.pip = pip
+        self.root = None
+        self.command = None
+        self.images = {}
+
+    def inspect_image(self, image):
+        return {'Id': self.images.get(image, 'sha256:{}'.format(image))}
+
+    def create_container(self, image, command):
+        self.root = tempfile.mkdtemp()
+        self.command = [self.pip] + [
+            self.root + arg if arg.startswith('/') else arg
+            for arg in command[1:]
+        ]
+        return {'Id': 'wheels'}
+
+    def put_archive(self, container, path, data):
+        with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+            tar.extractall(self.root + path)
+
+    def start(self, container):
+        pass
+
+    def wait(self, container):
+        return subprocess.call(self.command)
+
+    def logs(self, container):
+        return 'Failed to build broken'
+
+    def get_archive(self, container, path):
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w') as tar:
+            tar.add(self.root + path, arcname=os.path.basename(path))
+        archive.seek(0)
+        return archive, {}
+
+    def remove_container(self, container, force=False):
+        shutil.rmtree(self.root)
+
+
+class TestWheelhouse(unittest.TestCase):
+    """
+    Test the Wheelhouse with a fake pip
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.log = os.path.join(self.tmp, 'pip.log')
+        self.pip = os.path.join(self.tmp, 'pip')
+        with open(self.pip, 'w') as f:
+            f.write(FAKE_PIP.format(log=self.log))
+        os.chmod(self.pip, stat.S_IRWXU)
+        self.directory = os.path.join(self.tmp, 'wheelhouse')
+        self.client = FakeClient(self.pip)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def built(self):
+        """
+        :return: list of requirements built by the fake pip
+        """
+        if not os.path.isfile(self.log):
+            return []
+        with open(self.log) as f:
+            return f.read().split()
+
+    def test_hits_and_misses(self):
+        """
+        Wheels are built once per requirements content and counted as hits
+        afterwards
+        """
+        wheelhouse = Wheelhouse(self.directory, pip=self.pip)
+        self.assertIsNone(wheelhouse.hit_rate)
+
+        paths = wheelhouse.wheels('flask\nlxml\n', self.client, 'base')
+        self.assertEqual(
+            [os.path.basename(p) for p in paths],
+            ['flask-1.0-py2-none-any.whl', 'lxml-1.0-py2-none-any.whl']
+        )
+        self.assertEqual((wheelhouse.hits, wheelhouse.misses), (0, 2))
+
+        self.assertEqual(
+            wheelhouse.wheels('flask\nlxml\n', self.client, 'base'), paths
+        )
+        self.assertEqual(self.built(), ['flask', 'lxml'])
+        self.assertEqual(wheelhouse.hit_rate, 0.5)
+
+        # pip runs for new requirements, with the wheels already built, so
+        # only new wheels are misses
+        wheelhouse.wheels('flask\nnumpy\n', self.client, 'base')
+        self.assertEqual(self.built(), ['flask', 'lxml', 'numpy'])
+        self.assertEqual((wheelhouse.hits, wheelhouse.misses), (3, 3))
+        self.assertEqual(wheelhouse.size, 3 * 1024)
+        self.assertIn('3 wheels', str(wheelhouse))
+
+        # Wheels of another image are built for it
+        self.client.images['base'] = 'sha256:update'
+        other = wheelhouse.wheels('flask\nlxml\n', self.client, 'base')
+        self.assertNotEqual(other, paths)
+        self.assertEqual(self.built()[3:], ['flask', 'lxml'])
+
+    def test_pip_failure(self):
+        """
+        The wheels pip did build are used when it fails for others
+        """
+        wheelhouse = Wheelhouse(self.directory, pip=self.pip)
+        paths = wheelhouse.wheels('flask\nbroken\n', self.client, 'base')
+        self.assertEqual(
+            [os.path.basename(p) for p in paths],
+            ['flask-1.0-py2-none-any.whl']
+        )
+        wheelhouse.wheels('flask\nbroken\n', self.client, 'base')
+        self.assertEqual(self.built(), ['flask'])
+
+    def test_evict(self):
+        """
+        The least recently used wheels are evicted beyond max_size once
+        released, but never while a build holds the wheelhouse
+        """
+        wheelhouse = Wheelhouse(self.directory, max_size=2048, pip=self.pip)
+        a, b = wheelhouse.wheels('a\nb\n', self.client, 'base')
+        os.utime(a, (1, 1))
+        os.utime(b, (2, 2))
+        wheelhouse.release()
+
+        c, = wheelhouse.wheels('c\n', self.client, 'base')
+        # e.g. another build, in another thread or process
+        other = Wheelhouse(self.directory, max_size=2048, pip=self.pip)
+        other.acquire()
+        self.assertEqual(wheelhouse.release(), [])
+        self.assertTrue(os.path.exists(a))
+
+        other.release()
+        self.assertFalse(os.path.exists(a))
+        self.assertTrue(os.path.exists(b))
+        self.assertTrue(os.path.exists(c))
+        self.assertEqual(wheelhouse.size, 2048)
+
+        # The manifest of an evicted wheel is a miss
+        wheelhouse.wheels('a\nb\n', self.client, 'base')
+        wheelhouse.release()
+        self.assertEqual(self.built(), ['a', 'b', 'c', 'a'])
+        self.assertFalse(os.path.exists(c))
+
+    def test_projects(self):
+        """
+        The names of the required projects are normalised as in wheel names
+        """
+        self.assertEqual(
+            Wheelhouse.projects(
+                'Flask-Login==0.3\n# comment\n-e .\n'
+                'lxml>=3 ; python_version<"3"\nzope.interface[test]\n'
+            ),
+            set(['flask_login', 'lxml', 'zope_interface'])
+        )
+
+    def test_builder_context(self):
+        """
+        A builder with a wheelhouse builds the wheels in its base image,
+        sends them in its context and installs them, with the index for the
+        requirements without a wheel
+        """
+        wheelhouse = Wheelhouse(self.directory, pip=self.pip)
+        mirror = mock.Mock()
+        mirror.read.return_value = 'flask\n'
+        mirror.members.return_value = []
+        base = mock.Mock(tag='adsabs/python-base:abc')
+        builder = DockerImageBuilder(
+            Commit(commit_hash='master', repository='adsws'),
+            base=base,
+            mirror=mirror,
+            wheelhouse=wheelhouse,
+        )
+        with mock.patch.object(builder, 'client', return_value=self.client):
+            builder.render_templates()
+            self.assertIn(
+                'pip install --find-links /tmp/wheels -r /tmp/requirements.txt'
+                ' && rm -rf /tmp/requirements.txt /tmp/wheels',
+                builder.files[0]['content']
+            )
+            builder.add_wheels()
+        builder.create_docker_context()
+        with tarfile.open(fileobj=io.BytesIO(builder.tarfile.tobytes())) as tar:
+            self.assertEqual(
+                tar.getmember('wheels/flask-1.0-py2-none-any.whl').size, 1024
+            )
+
+    def test_fingerprint_builds_nothing(self):
+        """
+        The fingerprint of a builder with a wheelhouse neither ensures its
+        base image nor builds wheels, so that a retagged or skipped build
+        does not build anything
+        """
+        wheelhouse = mock.Mock()
+        mirror = mock.Mock()
+        mirror.read.return_value = 'flask\n'
+        base = mock.Mock(tag='adsabs/python-base:abc')
+        builder = DockerImageBuilder(
+            Commit(commit_hash='master', repository='adsws'),
+            base=base,
+            mirror=mirror,
+            wheelhouse=wheelhouse,
+        )
+        builder.fingerprint()
+        self.assertFalse(base.ensure.called)
+        self.assertFalse(wheelhouse.wheels.called)
@@ -1,4 +1,7 @@
 import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from boto3.session import Session
 from flask import current_app
 
@@ -16,6 +19,18 @@ def get_boto_session():
     )
 
 
+def median(values):
+    """
+    :param values: non-empty sequence of numbers
+    :return: median of the values
+    """
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
 class ChangeDir:
     """Context manager for changing the current working directory"""
     def __init__(self, newPath):
@@ -26,4 +41,50 @@ class ChangeDir:
         os.chdir(self.newPath)
 
     def __exit__(self, etype, value, traceback):
-        os.chdir(self.savedPath)
\ No newline at end of file
+        os.chdir(self.savedPath)
+
+
+class StageTimer(object):
+    """
+    Records the wall-clock duration of named stages, in seconds:
+
+        timer = StageTimer()
+        with timer('verify'):
+            ...
+        timer.durations  # OrderedDict([('verify', 0.0012)])
+
+    Re-entering a stage accumulates its duration.
+    """
+    def __init__(self):
+        self.durations = OrderedDict()
+
+    @contextmanager
+    def __call__(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.durations[stage] = \
+                self.durations.get(stage, 0) + time.time() - start
+
+    @property
+    def total(self):
+        """
+        sum of all recorded stage durations
+        """
+        return sum(self.durations.values())
+
+    def header(self):
+        """
+        formats the durations as a `Server-Timing` http header value, in ms
+        """
+        return ", ".join(
+            "{};dur={:.2f}".format(stage, duration * 1000)
+            for stage, duration in self.durations.items()
+        )
+
+    def __str__(self):
+        return " ".join(
+            "{}={:.1f}ms".format(stage, duration * 1000)
+            for stage, duration in self.durations.items()
+        )
@@ -3,11 +3,15 @@ Views
 """
 import hmac
 import hashlib
+import json
 from dateutil import parser
-from flask import current_app, request, abort
+from flask import current_app, request, abort, Response, stream_with_context
 from flask.ext.restful import Resource
 from mc.exceptions import NoSignatureInfo, InvalidSignature, UnknownRepoError
-from mc.models import db, Commit
+from mc.models import db, Commit, Build
+from mc.ingest import WebhookSpool
+from mc.buildlogs import BuildLog, LogTailer
+from mc.utils import StageTimer
 from sqlalchemy.orm.exc import NoResultFound
 
 
@@ -68,73 +72,189 @@ class GithubListener(Resource):
         if request is None:
             raise ValueError("No request object given")
 
-        payload = request.get_json()
-        repo = payload['repository']['name']
-        commit_hash = payload['head_commit']['id']
-        tag = payload['ref'].replace('refs/tags/', '') \
-            if 'tags' in payload['ref'] else None
+        return GithubListener.commit_from_payload(request.get_json())
 
+    @staticmethod
+    def commit_values(payload):
+        """
+        extracts the models.Commit column values from a decoded github webhook
+        payload
+        :param payload: decoded json payload
+        :type payload: dict
+        :return: dict of models.Commit column values
+        """
+        repo = payload['repository']['name']
         if repo not in current_app.config.get('WATCHED_REPOS'):
             raise UnknownRepoError("{}".format(repo))
 
+        return dict(
+            commit_hash=payload['head_commit']['id'],
+            tag=payload['ref'].replace('refs/tags/', '')
+            if 'tags' in payload['ref'] else None,
+            timestamp=parser.parse(payload['head_commit']['timestamp']),
+            author=payload['head_commit']['author']['username'],
+            repository=repo,
+            message=payload['head_commit']['message'],
+        )
+
+    @staticmethod
+    def commit_from_payload(payload):
+        """
+        creates a models.Commit instance from a decoded github webhook payload.
+        If that commit is already in the database, it instead returns that
+        commit, with the tag added if it was not previously known
+        :param payload: decoded json payload
+        :type payload: dict
+        :return: models.Commit based on the payload
+        """
+        values = GithubListener.commit_values(payload)
+
         try:
             c = Commit.query.filter_by(
-                commit_hash=commit_hash,
-                repository=repo
+                commit_hash=values['commit_hash'],
+                repository=values['repository']
             ).one()
 
-            if not c.tag and tag:
-                c.tag = tag
+            if not c.tag and values['tag']:
+                c.tag = values['tag']
                 db.session.add(c)
-                db.session.commit()
 
             return c
         except NoResultFound:
-            return Commit(
-                commit_hash=commit_hash,
-                tag=tag,
-                timestamp=parser.parse(payload['head_commit']['timestamp']),
-                author=payload['head_commit']['author']['username'],
-                repository=repo,
-                message=payload['head_commit']['message'],
-            )
+            return Commit(**values)
 
     def post(self):
         """
         Parse the incommit commit message, save to the backend database, and
         create a build.
         This endpoint should be contacted by a github webhook.
+
+        If WEBHOOK_ASYNC is set, only the signature is verified before the raw
+        payload is spooled and 202 is returned; mc.tasks.ingest_webhooks does
+        the rest. Per-stage durations are returned in the Server-Timing header.
         """
+        timer = StageTimer()
 
-        try:
-            GithubListener.verify_github_signature(request)
-        except (NoSignatureInfo, InvalidSignature) as e:
-            current_app.logger.warning("{}: {}".format(request.remote_addr, e))
-            abort(400)
-        try:
-            commit = GithubListener.parse_github_payload(request)
-        except UnknownRepoError, e:
-            return {"Unknown repo": "{}".format(e)}, 400
-        db.session.add(commit)
-        db.session.commit()
+        with timer('verify'):
+            try:
+                GithubListener.verify_github_signature(request)
+            except (NoSignatureInfo, InvalidSignature) as e:
+                current_app.logger.warning(
+                    "{}: {}".format(request.remote_addr, e)
+                )
+                abort(400)
+
+        if current_app.config.get('WEBHOOK_ASYNC'):
+            with timer('spool'):
+                spool = WebhookSpool(current_app.config['WEBHOOK_SPOOL_DIR'])
+                event = spool.append(request.data)
+            current_app.logger.info("spooled: {} [{}]".format(event, timer))
+            return {"queued": event}, 202, {'Server-Timing': timer.header()}
+
+        with timer('parse'):
+            try:
+                commit = GithubListener.parse_github_payload(request)
+            except UnknownRepoError, e:
+                return {"Unknown repo": "{}".format(e)}, 400
 
         # Causes circular import if left at the top; views->tasks->app->views
         # This is due to that fact that celery does not have a defereed setup,
         # ie no init_app method since it is not an extension.
         # See https://github.com/Robpol86/Flask-Celery-Helper for a possible
         # flask-extension to use in the future
-        from mc.tasks import build_docker
-        build_docker.delay(commit.id)
+        from mc.tasks import build_docker, queue_build
+
+        with timer('db'):
+            db.session.add(commit)
+            queue_build(commit)
+            db.session.commit()
+
+        with timer('enqueue'):
+            build_docker.delay(commit.id)
         current_app.logger.info(
-            "received: {}@{}, tag:{}"
-            .format(commit.repository, commit.commit_hash, commit.tag)
+            "received: {}@{}, tag:{} [{}]"
+            .format(commit.repository, commit.commit_hash, commit.tag, timer)
         )
         return {"received": "{}@{}, tag:{}".format(
             commit.repository, commit.commit_hash, commit.tag
-        )}
+        )}, 200, {'Server-Timing': timer.header()}
 
 
+class BuildLogStream(Resource):
+    """
+    Log of a build as Server-Sent Events
+    """
 
+    # Statuses of the builds whose log may still grow
+    active = ('queued', 'running')
 
+    @staticmethod
+    def format_event(n, event):
+        """
+        :param n: number of the event in the log
+        :param event: event dict
+        :return: the event as a Server-Sent Event
+        """
+        return "id: {}\nevent: {}\ndata: {}\n\n".format(
+            n, event['type'], json.dumps(event)
+        )
 
+    def get(self, build_id):
+        """
+        Streams the events of a build. The stored events of a build that is
+        neither queued nor running, e.g. finished, skipped or made without a
+        status, are replayed, and the stream ends; the events of a queued or
+        running build are followed until it finishes, is skipped or requeued,
+        or its status says so at a keepalive. Followers of the same build
+        share a single reader of its log. A Last-Event-ID header resumes the
+        stream after that event.
+        """
+        build = Build.query.get(build_id)
+        log = BuildLog.for_build(current_app.config, build_id)
+        if build is None or log is None:
+            abort(404)
+        if build.status not in self.active and not log.exists():
+            abort(404)
+
+        try:
+            start = int(request.headers.get('Last-Event-ID', -1)) + 1
+        except ValueError:
+            start = 0
+
+        if build.status not in self.active:
+            events = enumerate(log.read(start), start)
+        else:
+            events = LogTailer.follow(
+                log, start,
+                interval=current_app.config.get('BUILD_LOG_POLL_INTERVAL', 0.5),
+                keepalive=current_app.config.get('BUILD_LOG_KEEPALIVE', 15),
+            )
+        # Do not hold a transaction, and its locks, while streaming
+        db.session.rollback()
+
+        def ended():
+            status = db.session.query(Build.status).filter_by(
+                id=build_id
+            ).scalar()
+            db.session.rollback()
+            return status not in BuildLogStream.active
 
+        def stream():
+            try:
+                for item in events:
+                    if item is None:
+                        # e.g. the worker running the build died
+                        if ended():
+                            return
+                        yield ": keepalive\n\n"
+                    else:
+                        yield BuildLogStream.format_event(*item)
+            finally:
+                if hasattr(events, 'close'):
+                    events.close()
+
+        return Response(
+            stream_with_context(stream()),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+        )
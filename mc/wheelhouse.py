@@ -0,0 +1,253 @@
+"""
+Pip wheelhouse shared by the image builds of the build host
+"""
+import fcntl
+import hashlib
+import io
+import logging
+import os
+import re
+import shutil
+import tarfile
+import tempfile
+from mc.utils import StageTimer
+
+
+class Wheelhouse(object):
+    """
+    Directory of wheels of the build host. The wheels satisfying a
+    requirements.txt are built once with `pip wheel` in a container of the
+    image they are installed in, so that they match its interpreter and
+    libraries, recorded in a manifest keyed on that image and the content of
+    the requirements, and sent in the docker context of every later build
+    with the same requirements. The least recently used wheels are evicted
+    once the wheelhouse grows beyond `max_size` bytes, when no build is using
+    any wheel.
+    """
+
+    def __init__(self, directory, max_size=None, pip='pip'):
+        """
+        :param directory: wheelhouse directory; created if needed
+        :param max_size: maximum size of the wheels in bytes; None for no limit
+        :param pip: pip executable of the images the wheels are built in
+        """
+        self.directory = directory
+        self.manifests = os.path.join(directory, 'manifests')
+        self.max_size = max_size
+        self.pip = pip
+        self.hits = 0
+        self.misses = 0
+        self.timer = StageTimer()
+        self.lock = None
+        self.logger = logging.getLogger(__name__)
+        try:
+            os.makedirs(self.manifests)
+        except OSError:
+            if not os.path.isdir(self.manifests):
+                raise
+
+    def wheels(self, requirements, client, image):
+        """
+        Finds the wheels satisfying a requirements.txt for an image, building
+        the missing ones in a container of the image. They are not evicted
+        until release() is called.
+        :param requirements: content of a requirements.txt
+        :param client: docker.Client of the daemon having the image
+        :param image: image the wheels are installed in
+        :return: list of paths of the wheels; requirements without a wheel
+            are left to pip install
+        """
+        self.acquire()
+        platform = hashlib.sha1(
+            client.inspect_image(image)['Id']
+        ).hexdigest()[:12]
+        directory = os.path.join(self.directory, platform)
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+        manifest = os.path.join(
+            self.manifests,
+            hashlib.sha1(platform + '\0' + requirements).hexdigest()
+        )
+        names = None
+        if os.path.isfile(manifest):
+            with open(manifest) as f:
+                names = f.read().split()
+        if names is not None and all(
+                os.path.isfile(os.path.join(directory, n)) for n in names):
+            self.hits += len(names)
+        else:
+            names = self.build(requirements, client, image, directory)
+            with open(manifest, 'w') as f:
+                f.write('\n'.join(names))
+
+        paths = [os.path.join(directory, n) for n in names]
+        for path in paths:
+            os.utime(path, None)  # Mark as recently used
+        return paths
+
+    @staticmethod
+    def projects(requirements):
+        """
+        :param requirements: content of a requirements.txt
+        :return: set of the normalised names of the required projects
+        """
+        projects = set()
+        for line in requirements.splitlines():
+            name = re.split(r'[\s<>=!~;\[#]', line.strip(), 1)[0]
+            if name and not name.startswith('-'):
+                projects.add(re.sub(r'[-_.]+', '_', name).lower())
+        return projects
+
+    def build(self, requirements, client, image, directory):
+        """
+        Runs `pip wheel` for a requirements.txt in a container of an image,
+        with the wheels of the required projects already in `directory`, and
+        moves the new wheels into `directory`. If pip fails, e.g. for want of
+        the headers of a library, the wheels it did build are kept.
+        :param requirements: content of a requirements.txt
+        :param client: docker.Client of the daemon having the image
+        :param image: image the wheels are built in
+        :param directory: wheelhouse directory of the image
+        :return: sorted list of the names of the wheels
+        """
+        projects = self.projects(requirements)
+        context = io.BytesIO()
+        with tarfile.open(fileobj=context, mode='w') as tar:
+            info = tarfile.TarInfo('wheels/requirements.txt')
+            info.size = len(requirements)
+            tar.addfile(info, io.BytesIO(requirements))
+            for name in os.listdir(directory):
+                project = name.split('-', 1)[0].lower()
+                if name.endswith('.whl') and project in projects:
+                    tar.add(
+                        os.path.join(directory, name),
+                        arcname='wheels/{}'.format(name)
+                    )
+
+        container = client.create_container(image, command=[
+            self.pip, 'wheel', '--quiet',
+            '--wheel-dir', '/wheels',
+            '--find-links', '/wheels',
+            '-r', '/wheels/requirements.txt',
+        ])
+        names = []
+        try:
+            client.put_archive(container, '/', context.getvalue())
+            with self.timer('wheel'):
+                client.start(container)
+                status = client.wait(container)
+            if status != 0:
+                self.logger.warning(
+                    "pip wheel exited with {} in {}; requirements without a "
+                    "wheel are installed from the index: {}".format(
+                        status, image, client.logs(container)[-2048:]
+                    )
+                )
+            stream, _ = client.get_archive(container, '/wheels')
+            with tarfile.open(fileobj=stream, mode='r|') as tar:
+                for member in tar:
+                    name = os.path.basename(member.name)
+                    if not member.isfile() or not name.endswith('.whl'):
+                        continue
+                    names.append(name)
+                    path = os.path.join(directory, name)
+                    if os.path.isfile(path):
+                        self.hits += 1
+                        continue
+                    self.misses += 1
+                    # Written aside, so that no build sends a partial wheel
+                    fd, tmp = tempfile.mkstemp(dir=directory)
+                    with os.fdopen(fd, 'wb') as f:
+                        shutil.copyfileobj(tar.extractfile(member), f)
+                    os.rename(tmp, path)
+        finally:
+            client.remove_container(container, force=True)
+        return sorted(names)
+
+    def acquire(self):
+        """
+        Holds a shared lock on the wheelhouse, which defers the eviction of
+        wheels until release()
+        """
+        if self.lock is None:
+            self.lock = open(os.path.join(self.directory, 'lock'), 'a')
+            fcntl.flock(self.lock, fcntl.LOCK_SH)
+
+    def release(self):
+        """
+        Releases the lock of acquire(), then evicts wheels if no other build,
+        of this or another process, holds it
+        :return: list of the paths of the evicted wheels
+        """
+        if self.lock is not None:
+            self.lock.close()
+            self.lock = None
+        with open(os.path.join(self.directory, 'lock'), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return []
+            return self.evict()
+
+    def files(self):
+        """
+        :return: list of (path, size, last use) of the wheels
+        """
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith('.whl'):
+                    st = os.stat(os.path.join(root, name))
+                    files.append(
+                        (os.path.join(root, name), st.st_size, st.st_mtime)
+                    )
+        return files
+
+    @property
+    def size(self):
+        """
+        total size of the wheels in bytes
+        """
+        return sum(size for _, size, _ in self.files())
+
+    @property
+    def hit_rate(self):
+        """
+        fraction of the wheels that did not have to be built, or None
+        """
+        if not self.hits + self.misses:
+            return None
+        return float(self.hits) / (self.hits + self.misses)
+
+    def evict(self, keep=()):
+        """
+        Removes the least recently used wheels until the wheelhouse is no
+        larger than max_size
+        :param keep: paths of wheels that must not be evicted
+        :return: list of the paths of the evicted wheels
+        """
+        if self.max_size is None:
+            return []
+        files = sorted(self.files(), key=lambda f: f[2])
+        size = sum(f[1] for f in files)
+        evicted = []
+        for path, file_size, _ in files:
+            if size <= self.max_size:
+                break
+            if path in keep:
+                continue
+            os.remove(path)
+            size -= file_size
+            evicted.append(path)
+        return evicted
+
+    def __str__(self):
+        return "{} wheels, {:.1f} MB, hit rate {}".format(
+            len(self.files()),
+            self.size / 1024.0 / 1024,
+            "{:.0%}".format(self.hit_rate)
+            if self.hit_rate is not None else "n/a",
+        )